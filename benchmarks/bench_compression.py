@@ -0,0 +1,54 @@
+"""
+Compare the CPU cost of precompressing verification pages with the bytes saved.
+
+    python -m benchmarks.bench_compression [--count N]
+
+Generates one certificate for the first course in CERT_DATA, then
+compresses its verification pages (and json record, with
+CERT_VERIFICATION_FORMAT = 'json') --count times with each content
+encoding and level.  brotli is only included if the package is installed.
+"""
+import sys
+import time
+from argparse import ArgumentParser
+
+import settings
+from gen_cert import CertificateGen
+from openedx_certificates.artifacts import COMPRESSIBLE_TYPES, COMPRESSORS, brotli
+
+LEVELS = {
+    'gzip': (1, 6, 9),
+    'br': (4, 9, 11),
+}
+
+
+def main(args=sys.argv[1:]):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=200, help='compressions per encoding and level')
+    args = parser.parse_args(args)
+
+    cert = CertificateGen(list(settings.CERT_DATA.keys())[0])
+    bundle = cert._generate_certificate(student_name='John Smith').finish()
+    pages = [artifact.data for artifact in bundle if artifact.content_type in COMPRESSIBLE_TYPES]
+    if not pages:
+        sys.exit("No verification pages were generated, is CERT_KEY_ID set?")
+    original = sum(len(page) for page in pages)
+    print("{pages} pages, {size} bytes per certificate".format(pages=len(pages), size=original))
+
+    for encoding, levels in sorted(LEVELS.items()):
+        if encoding == 'br' and brotli is None:
+            print("{encoding:>6}: skipped, brotli is not installed".format(encoding=encoding))
+            continue
+        for level in levels:
+            compress = COMPRESSORS[encoding]
+            start = time.perf_counter()
+            for _ in range(args.count):
+                compressed = sum(len(compress(page, level)) for page in pages)
+            elapsed = time.perf_counter() - start
+            print("{encoding:>6} {level:>2}: {ms:7.3f}ms/certificate {size:6d} bytes, {saved:5.1f}% saved".format(
+                encoding=encoding, level=level, ms=elapsed * 1000 / args.count,
+                size=compressed, saved=100.0 * (original - compressed) / original))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark generating and publishing certificates against in-memory storage.
+
+    python -m benchmarks.bench_publish [--count N] [--latency SECONDS] [--error-rate RATE]
+
+Runs the whole generate, sign and upload path offline, with uploads going
+to the 'memory' storage backend, which takes --latency seconds (plus up to
+--jitter more) per object and fails --error-rate of them, to compare:
+
+    serial     - create_and_upload(), one object at a time; skipped when
+                 errors are injected, as it does not retry
+    concurrent - create_and_upload_many() through the upload pool
+    outbox     - create_and_queue(), rendering while the outbox uploads
+
+Uses the first course in CERT_DATA and signs with CERT_KEY_ID if it is set.
+"""
+import sys
+import time
+from argparse import ArgumentParser
+
+import settings
+import gen_cert
+from openedx_certificates.metrics import METRICS
+
+NAMES = ('John Smith', 'Jane Smith', 'Ada Lovelace', 'Grace Hopper', 'Alan Turing')
+
+
+def publish_serial(cert, names):
+    for name in names:
+        cert.create_and_upload(name)
+
+
+def publish_concurrent(cert, names):
+    for job, bundle in cert.create_and_upload_many({'name': name} for name in names):
+        pass
+
+
+def publish_outbox(cert, names):
+    futures = [cert.create_and_queue(name) for name in names]
+    cert.finish_queued()
+    for future in futures:
+        future.result()
+
+
+def main(args=sys.argv[1:]):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=20, help='certificates per strategy')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per uploaded object')
+    parser.add_argument('--jitter', type=float, default=0.02, help='up to this many more seconds per object')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of uploads that fail')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent uploads')
+    args = parser.parse_args(args)
+
+    settings.S3_UPLOAD = True
+    settings.COPY_TO_WEB_ROOT = False
+    settings.CERT_STORAGE = 'memory'
+    settings.CERT_STORAGE_OPTIONS = {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate}
+    settings.CERT_UPLOAD_RETRIES = 5
+
+    cert = gen_cert.CertificateGen(list(settings.CERT_DATA.keys())[0])
+    names = [NAMES[i % len(NAMES)] for i in range(args.count)]
+    strategies = [
+        ('serial', 0, publish_serial),
+        ('concurrent', args.workers, publish_concurrent),
+        ('outbox', args.workers, publish_outbox),
+    ]
+    if args.error_rate:
+        strategies.pop(0)
+    for label, workers, publish in strategies:
+        settings.CERT_UPLOAD_WORKERS = workers
+        gen_cert._upload_pools.clear()
+        gen_cert._outboxes.clear()
+        METRICS.reset()
+        start = time.perf_counter()
+        publish(cert, names)
+        elapsed = time.perf_counter() - start
+        uploads = METRICS.snapshot()['timings'].get('upload.latency', {'count': 0, 'p95': 0.0})
+        print("{label:>12}: {total:8.3f}s total {per:8.2f}ms/certificate "
+              "{objects} objects, p95 upload {p95:.1f}ms".format(
+                  label=label, total=elapsed, per=elapsed * 1000 / args.count,
+                  objects=uploads['count'], p95=uploads['p95'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Compare per-signature latency of certificate signing strategies.
+
+    python -m benchmarks.bench_signing [--count N] [--size BYTES] [--key-file FILE]
+
+"per-certificate" reproduces the original behaviour of building a new
+gnupg.GPG wrapper for every signature; "persistent" reuses one warmed-up
+GPGSigner; "batch" signs all payloads with a single sign_many() call.
+Uses CERT_GPG_DIR and CERT_KEY_ID from settings.
+
+If CERT_SIGNING_KEY_FILE is set (or --key-file is given) the in-process
+PGPy backend is benchmarked as well.
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import gnupg
+
+import settings
+from openedx_certificates.signing import GPGSigner, PGPySigner
+
+
+def sign_per_certificate(payloads):
+    for data in payloads:
+        gpg = gnupg.GPG(homedir=settings.CERT_GPG_DIR)
+        gpg.encoding = 'utf-8'
+        gpg.sign(data=data, default_key=settings.CERT_KEY_ID, clearsign=False, detach=True)
+
+
+def sign_persistent(payloads, signer):
+    for data in payloads:
+        signer.sign(data)
+
+
+def sign_batch(payloads, signer):
+    signer.sign_many(payloads)
+
+
+def report(label, elapsed, count):
+    print("{label:>16}: {total:8.3f}s total {per:8.2f}ms/signature".format(
+        label=label, total=elapsed, per=elapsed * 1000 / count))
+
+
+def main(args=sys.argv[1:]):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=50, help='signatures per strategy')
+    parser.add_argument('--size', type=int, default=80 * 1024, help='payload size in bytes')
+    parser.add_argument('--key-file', default=settings.CERT_SIGNING_KEY_FILE,
+                        help='exported secret key for the in-process backend')
+    args = parser.parse_args(args)
+
+    if not settings.CERT_KEY_ID:
+        sys.exit("CERT_KEY_ID is not set, nothing to benchmark")
+
+    payloads = [os.urandom(args.size) for _ in range(args.count)]
+    signer = GPGSigner(settings.CERT_GPG_DIR, settings.CERT_KEY_ID)
+    signer.warmup()
+
+    strategies = [
+        ('per-certificate', lambda: sign_per_certificate(payloads)),
+        ('persistent', lambda: sign_persistent(payloads, signer)),
+        ('batch', lambda: sign_batch(payloads, signer)),
+    ]
+    if args.key_file:
+        pgpy_signer = PGPySigner(args.key_file, settings.CERT_KEY_ID, settings.CERT_SIGNING_KEY_PASSPHRASE)
+        pgpy_signer.warmup()
+        strategies.append(('in-process', lambda: sign_persistent(payloads, pgpy_signer)))
+
+    for label, run in strategies:
+        start = time.perf_counter()
+        run()
+        report(label, time.perf_counter() - start, args.count)
+
+
+if __name__ == '__main__':
+    main()
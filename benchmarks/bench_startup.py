@@ -0,0 +1,68 @@
+"""
+Benchmark the cost of starting a worker.
+
+    python -m benchmarks.bench_startup [--runs N] [--module gen_cert]
+
+Imports the module in --runs fresh interpreters and reports the median
+of:
+
+    import  - seconds to import it cold, and the resident memory after
+    warmup  - seconds gen_cert.warmup() takes after that, and the
+              resident memory after
+    first   - seconds to render the first certificate, without uploading
+"""
+import json
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+PROBE = """
+import json, resource, sys, time
+
+def rss():
+    # Current resident set size, in KiB
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+start = time.perf_counter()
+module = __import__({module!r})
+result = {{'import': time.perf_counter() - start, 'import_rss': rss()}}
+
+import gen_cert, settings
+start = time.perf_counter()
+gen_cert.warmup()
+result.update({{'warmup': time.perf_counter() - start, 'warmup_rss': rss()}})
+
+start = time.perf_counter()
+cert = gen_cert.CertificateGen(list(settings.CERT_DATA.keys())[0])
+cert.create_and_upload('John Smith', upload=False, copy_to_webroot=False)
+result['first'] = time.perf_counter() - start
+cert.close()
+sys.stdout.write(json.dumps(result))
+"""
+
+
+def probe(module):
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module)],
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    ).stdout
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(args=sys.argv[1:]):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to measure')
+    parser.add_argument('--module', default='gen_cert', help='module whose import is measured')
+    args = parser.parse_args(args)
+
+    results = [probe(args.module) for _ in range(args.runs)]
+    median = {key: statistics.median(result[key] for result in results) for key in results[0]}
+    print("{module}: import {import:.3f}s ({import_rss} KiB), warmup {warmup:.3f}s ({warmup_rss} KiB), "
+          "first certificate {first:.3f}s, median of {runs} runs".format(
+              module=args.module, runs=args.runs, **median))
+
+
+if __name__ == '__main__':
+    main()
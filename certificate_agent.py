@@ -1,13 +1,18 @@
+import gc
 import json
 import logging.config
 import os
+import signal
 import sys
 import time
 from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import FIRST_COMPLETED, wait
 
 import settings
-from gen_cert import CertificateGen
+from gen_cert import CertificateGen, get_cert_signer, get_delete_batch, get_outbox, warmup
+from openedx_certificates.metrics import METRICS, process_memory
 from openedx_certificates.queue_xqueue import XQueuePullManager
+from openedx_certificates.results import ResultCache, submission_key
 
 logging.config.dictConfig(settings.LOGGING)
 log = logging.getLogger('certificates: ' + __name__)
@@ -44,9 +49,110 @@ def parse_args(args=sys.argv[1:]):
         default=settings.CERT_AWS_KEY,
         help='AWS KEY for write access to the S3 bucket',
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=settings.CERT_AGENT_WORKERS,
+        help='number of worker processes to fork after warming up',
+    )
     return parser.parse_args()
 
 
+def error_reply(xqueue_header, username, course_id, e):
+    """Build the reply telling the LMS that generating a certificate failed"""
+    # get as much info as possible about the exception
+    # for the post back to the LMS
+    exc_tb = e.__traceback__
+    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1] if exc_tb else ''
+    error_reason = (
+        "({username} {course_id}) "
+        "{exception_type}: {exception}: "
+        "{file_name}:{line_number}".format(
+            username=username,
+            course_id=course_id,
+            exception_type=type(e),
+            exception=e,
+            file_name=fname,
+            line_number=exc_tb.tb_lineno if exc_tb else '',
+        )
+    )
+
+    log.critical(
+        'An error occurred during certificate generation {reason}'.format(
+            reason=error_reason,
+        )
+    )
+    METRICS.incr('jobs.failed')
+
+    return {
+        'xqueue_header': json.dumps(xqueue_header),
+        'xqueue_body': json.dumps({
+            'error': 'There was an error processing the certificate request: {error}'.format(
+                error=e,
+            ),
+            'username': username,
+            'course_id': course_id,
+            'error_reason': error_reason,
+        }),
+    }
+
+
+def success_reply(xqueue_header, action, username, course_id, download_uuid, verify_uuid, download_url):
+    """Build the reply giving the LMS a generated certificate"""
+    return {
+        'xqueue_header': json.dumps(xqueue_header),
+        'xqueue_body': json.dumps({
+            'action': action,
+            'download_uuid': download_uuid,
+            'verify_uuid': verify_uuid,
+            'username': username,
+            'course_id': course_id,
+            'url': download_url,
+        }),
+    }
+
+
+def send_uploaded_replies(manager, uploading, timeout=0, results=None):
+    """
+    Reply to the LMS for every certificate whose upload has finished
+
+    uploading - list of (job, Future) pairs from CertificateGen.create_and_queue,
+                where job holds the xqueue_header, action, username, course_id
+                and the time the job was received; replied to jobs are removed
+    timeout   - seconds to wait for at least one upload to finish
+    results   - ResultCache to store the result of jobs with a result_key in
+    """
+    if timeout and uploading:
+        wait([future for job, future in uploading], timeout=timeout, return_when=FIRST_COMPLETED)
+    for job, future in [(job, future) for job, future in uploading if future.done()]:
+        uploading.remove((job, future))
+        if future.exception() is not None:
+            xqueue_reply = error_reply(job['xqueue_header'], job['username'], job['course_id'], future.exception())
+            manager.respond(xqueue_reply)
+            # The LMS was told to resubmit it, so it must not be recovered and answered again
+            get_outbox().discard(future)
+            continue
+        published = future.result().as_tuple()
+        if results is not None and job.get('result_key'):
+            results.put(job['result_key'], published)
+        xqueue_reply = success_reply(
+            job['xqueue_header'], job['action'], job['username'], job['course_id'], *published)
+        METRICS.incr('jobs.completed')
+        METRICS.timing('jobs.latency', time.time() - job['received'])
+        log.info("Posting result to the LMS: {0}".format(xqueue_reply))
+        manager.respond(xqueue_reply)
+
+
+def flush_deletes():
+    """Delete the certificates queued for deletion, logging rather than raising any error"""
+    try:
+        get_delete_batch().flush()
+    except Exception:
+        # Left queued for the next flush, or given up on after a few attempts
+        log.exception("Unable to delete certificates")
+        METRICS.incr('delete.flush_errors')
+
+
 def main():
 
     manager = XQueuePullManager(settings.QUEUE_URL, settings.QUEUE_NAME,
@@ -56,11 +162,49 @@ def main():
     last_course = None  # The last course_id we generated for
     cert = None  # A CertificateGen instance for a particular course
 
+    # Load fonts and templates, the signing key and gpg-agent before the first job arrives
+    warmup()
+    if settings.CERT_KEY_ID:
+        get_cert_signer().warmup()
+    last_metrics_log = last_delete_flush = time.time()
+
+    # Certificates still uploading, whose replies are sent once they are
+    # uploaded, including any left in the outbox by a previous run
+    uploading = []
+    if settings.CERT_ASYNC_UPLOAD:
+        uploading.extend(get_outbox().recover())
+    # Results of recent submissions, for answering resubmissions
+    results = ResultCache(settings.CERT_RESULT_CACHE, settings.CERT_RESULT_TTL) if settings.CERT_RESULT_CACHE else None
+
     while True:
 
+        if time.time() - last_metrics_log >= settings.METRICS_LOG_INTERVAL:
+            for name, kib in process_memory().items():
+                METRICS.gauge('memory.{name}_kib'.format(name=name), kib)
+            METRICS.log_summary(log)
+            last_metrics_log = last_delete_flush = time.time()
+            if results is not None:
+                results.purge()
+
+        send_uploaded_replies(manager, uploading, results=results)
+
+        # Deletes are gathered into multi-object requests while jobs keep
+        # coming, but only held in memory for so long
+        if time.time() - last_delete_flush >= settings.CERT_DELETE_FLUSH_INTERVAL:
+            flush_deletes()
+            last_delete_flush = time.time()
+
         if manager.get_length() == 0:
             log.debug("{} has no jobs".format(str(manager)))
-            time.sleep(settings.QUEUE_POLL_FREQUENCY)
+            flush_deletes()
+            last_delete_flush = time.time()
+            if cert is not None:
+                # Nothing left to render while waiting on the last signatures
+                cert.finish_queued()
+            if uploading:
+                send_uploaded_replies(manager, uploading, timeout=settings.QUEUE_POLL_FREQUENCY, results=results)
+            else:
+                time.sleep(settings.QUEUE_POLL_FREQUENCY)
             continue
         else:
             log.debug('queue length: {0}'.format(manager.get_length()))
@@ -79,7 +223,21 @@ def main():
             grade = xqueue_body.get('grade', None)
             issued_date = xqueue_body.get('issued_date', None)
             designation = xqueue_body.get('designation', None)
-            if last_course != course_id:
+            result_key = None
+            if results is not None and action != 'remove':
+                result_key = submission_key(xqueue_body)
+                published = results.get(result_key)
+                if published:
+                    log.info("{username} in {course_id} was already answered, resending the result".format(
+                        username=username, course_id=course_id))
+                    manager.respond(success_reply(xqueue_header, action, username, course_id, *published))
+                    METRICS.incr('jobs.completed')
+                    continue
+            # A new generator is needed for another course, or once the
+            # course's configuration was reloaded with changes
+            if last_course != course_id or cert.stale:
+                if cert is not None:
+                    cert.finish_queued()
                 cert = CertificateGen(
                     course_id,
                     template_pdf,
@@ -89,10 +247,29 @@ def main():
                     issued_date=issued_date,
                 )
                 last_course = course_id
+            if action == 'regen':
+                unchanged = cert.unchanged_certificate(
+                    xqueue_body['delete_download_uuid'],
+                    xqueue_body['delete_verify_uuid'],
+                    name,
+                    grade=grade,
+                    designation=designation,
+                )
+                if unchanged:
+                    manager.respond(success_reply(xqueue_header, action, username, course_id, *unchanged))
+                    METRICS.incr('jobs.completed')
+                    continue
             if action in ['remove', 'regen']:
                 cert.delete_certificate(xqueue_body['delete_download_uuid'],
-                                        xqueue_body['delete_verify_uuid'])
+                                        xqueue_body['delete_verify_uuid'],
+                                        defer=True)
+                if results is not None:
+                    # Resubmissions must not be answered with the deleted certificate
+                    results.invalidate(xqueue_body['delete_download_uuid'], xqueue_body['delete_verify_uuid'])
                 if action in ['remove']:
+                    # Revocations are not left waiting for a batch to fill up
+                    flush_deletes()
+                    last_delete_flush = time.time()
                     continue
 
         except (TypeError, ValueError, KeyError, OSError) as e:
@@ -112,73 +289,103 @@ def main():
                     grade=grade,
                 )
             )
-            (download_uuid,
-             verify_uuid,
-             download_url) = cert.create_and_upload(name.encode('utf-8'), grade=grade, designation=designation)
+            if settings.CERT_ASYNC_UPLOAD:
+                job = {
+                    'xqueue_header': xqueue_header,
+                    'action': action,
+                    'username': username,
+                    'course_id': course_id,
+                    'received': time.time(),
+                    'result_key': result_key,
+                }
+                uploading.append((job, cert.create_and_queue(
+                    name.encode('utf-8'), grade=grade, designation=designation, meta=job)))
+                continue
+
+            with METRICS.timer('jobs.latency'):
+                (download_uuid,
+                 verify_uuid,
+                 download_url) = cert.create_and_upload(name.encode('utf-8'), grade=grade, designation=designation)
 
         except Exception as e:
             # global exception handler, if anything goes wrong
             # during the generation of the pdf we will let the LMS
             # know so it can be re-submitted, the LMS will update
             # the state to error
-
-            # get as much info as possible about the exception
-            # for the post back to the LMS
-
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            error_reason = (
-                "({username} {course_id}) "
-                "{exception_type}: {exception}: "
-                "{file_name}:{line_number}".format(
-                    username=username,
-                    course_id=course_id,
-                    exception_type=exc_type,
-                    exception=e,
-                    file_name=fname,
-                    line_number=exc_tb.tb_lineno,
-                )
-            )
-
-            log.critical(
-                'An error occurred during certificate generation {reason}'.format(
-                    reason=error_reason,
-                )
-            )
-
-            xqueue_reply = {
-                'xqueue_header': json.dumps(xqueue_header),
-                'xqueue_body': json.dumps({
-                    'error': 'There was an error processing the certificate request: {error}'.format(
-                        error=e,
-                    ),
-                    'username': username,
-                    'course_id': course_id,
-                    'error_reason': error_reason,
-                }),
-            }
-            manager.respond(xqueue_reply)
+            manager.respond(error_reply(xqueue_header, username, course_id, e))
             if settings.DEBUG:
                 raise
             else:
                 continue
 
+        if result_key:
+            results.put(result_key, (download_uuid, verify_uuid, download_url))
+
         # post result back to the LMS
-        xqueue_reply = {
-            'xqueue_header': json.dumps(xqueue_header),
-            'xqueue_body': json.dumps({
-                'action': action,
-                'download_uuid': download_uuid,
-                'verify_uuid': verify_uuid,
-                'username': username,
-                'course_id': course_id,
-                'url': download_url,
-            }),
-        }
+        xqueue_reply = success_reply(
+            xqueue_header, action, username, course_id, download_uuid, verify_uuid, download_url)
         log.info("Posting result to the LMS: {0}".format(xqueue_reply))
         manager.respond(xqueue_reply)
+        METRICS.incr('jobs.completed')
+
+
+def run_workers(count):
+    """
+    Warm up once, then fork count workers each running main()
+
+    Fonts, templates and course configuration are loaded before forking and
+    frozen out of the garbage collector's reach, so the workers share those
+    pages with the parent copy-on-write instead of each loading their own;
+    compare the memory.uss_kib and memory.rss_kib metrics of a worker.
+    Workers that exit are replaced.
+    """
+    warmup(courses=list(settings.CERT_DATA))
+    # Collecting would write to every object's header, copying its page
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    log.info("forking {count} workers, parent uses {memory}".format(count=count, memory=process_memory()))
+
+    workers = {}
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                main()
+            except BaseException:
+                log.exception("worker {worker} failed".format(worker=worker))
+            finally:
+                os._exit(1)
+        workers[pid] = worker
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        for worker in range(count):
+            spawn(worker)
+        while True:
+            pid, status = os.wait()
+            worker = workers.pop(pid, None)
+            if worker is not None:
+                log.error("worker {worker} (pid {pid}) exited with status {status}, restarting".format(
+                    worker=worker, pid=pid, status=status))
+                time.sleep(1)
+                spawn(worker)
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
 
 if __name__ == '__main__':
     args = parse_args()
-    main()
+    if args.workers > 1:
+        run_workers(args.workers)
+    else:
+        main()
@@ -1,17 +1,30 @@
 """
 This is a standalone utility for generating certficiates.
 It will use test data in tests/test_data.py for names and courses.
-PDFs by default will be dropped in TMP_GEN_DIR for review
+PDFs by default will be dropped in TMP_GEN_DIR+copy for review, or with
+--archive written straight into a zip or tar file
+
+With --jobs N the certificates are rendered by N processes, each keeping
+one generator per course.
 """
 from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+import collections
 import csv
+import io
+import itertools
+import json
 import logging
 import os
 import random
 import shutil
 import sys
+import tarfile
+import time
+import zipfile
 
-from gen_cert import CertificateGen, S3_CERT_PATH, TARGET_FILENAME, TMP_GEN_DIR
+from gen_cert import CertificateGen, TMP_GEN_DIR, warmup
+from openedx_certificates.storage import LocalStorage
 import settings
 from tests.test_data import NAMES
 import six
@@ -51,7 +64,12 @@ def parse_args(args=sys.argv[1:]):
     parser.add_argument('-l', '--long-course', help='optional long course', default='')
     parser.add_argument('-i', '--issued-date', help='optional issue date')
     parser.add_argument('-T', '--assign-title', help='add random title after name', default=False, action="store_true")
-    parser.add_argument('-f', '--input-file', help='optional input file for names, one name per line')
+    parser.add_argument(
+        '-f',
+        '--input-file',
+        help='optional input file: one name per line, or a .csv (with a header row) or .jsonl\n'
+             'of records with a name and optionally course_id, grade, designation and issued_date',
+    )
     parser.add_argument(
         '-r',
         '--report-file',
@@ -66,97 +84,350 @@ def parse_args(args=sys.argv[1:]):
     )
     parser.add_argument('-G', '--grade-text', help='optional grading label to apply')
     parser.add_argument('-U', '--no-upload', help='skip s3 upload step', default=False, action="store_true")
+    parser.add_argument('-j', '--jobs', help='number of processes rendering certificates', type=int, default=1)
+    parser.add_argument(
+        '-a',
+        '--archive',
+        help='write the pdfs into this .zip, .tar, .tar.gz, .tar.bz2 or .tar.xz file\n'
+             'rather than the TMP_GEN_DIR+copy dir',
+    )
+    parser.add_argument(
+        '-C',
+        '--checkpoint',
+        help='record progress in this file, and resume from it if it exists',
+    )
 
     return parser.parse_args()
 
 
+# Certificates generated together, and handed to a worker at a time with
+# --jobs; with CERT_SIGNING_MODE = 'merkle' a chunk is a whole batch, see
+# chunk_size()
+CHUNK_SIZE = 16
+# Save the checkpoint, and flush the report, after this many certificates
+CHECKPOINT_EVERY = 100
+
+# Per process: where to write the pdfs, None to hand them back to the
+# parent for the archive, and a generator per course and date
+_output = None
+_generators = {}
+
+
+def _forget_generators(course_ids):
+    """Drop the generators of courses whose stanza in cert-data.yml changed"""
+    for key in [key for key in _generators if key[0] in course_ids]:
+        _generators.pop(key).close()
+
+
+if getattr(settings.CERT_DATA, 'on_change', None):
+    settings.CERT_DATA.on_change(_forget_generators)
+
+
+def _get_generator(course, issued_date):
+    key = (course, issued_date)
+    # Asking whether it is stale notices changes to cert-data.yml, which
+    # _forget_generators() hears about
+    if key not in _generators or _generators[key].stale:
+        _generators[key] = CertificateGen(
+            course,
+            args.template_file,
+            aws_id=settings.CERT_AWS_ID,
+            aws_key=settings.CERT_AWS_KEY,
+            long_org=args.long_org,
+            long_course=args.long_course,
+            issued_date=issued_date,
+        )
+    return _generators[key]
+
+
+def create_pdfs(items):
+    """
+    Generate the certificates for a chunk of (course, name, title, grade,
+    issued_date) items and write their pdfs to the copy dir
+
+    The items sharing a generator go through one create_and_upload_many()
+    call, so each pdf is signed while the next one renders, or with
+    CERT_SIGNING_MODE = 'merkle' they share a batch signature.  Returns a
+    (report row, filename, pdf or None) result per item, in order.
+    """
+    results = [None] * len(items)
+    groups = collections.defaultdict(list)
+    for index, (course, name, title, grade, issued_date) in enumerate(items):
+        groups[(course, issued_date)].append({'index': index, 'name': name, 'designation': title, 'grade': grade})
+    for (course, issued_date), jobs in groups.items():
+        cert = _get_generator(course, issued_date)
+        for job, bundle in cert.create_and_upload_many(jobs, upload=not args.no_upload, copy_to_webroot=False):
+            results[job['index']] = _write_pdf(course, job['name'], bundle)
+    return results
+
+
+def _write_pdf(course, name, bundle):
+    filename = '{course}-{name}.pdf'.format(
+        name=name.replace(" ", "-").replace("/", "-"),
+        course=course.replace("/", "-"))
+    row = (name, course, args.long_org, args.long_course, bundle.download_url)
+    if _output is None:
+        return row, filename, bundle.pdf.data
+    _output.upload(filename, bundle.pdf.data, 'application/pdf')
+    return row, filename, None
+
+
+def _init_worker(copy_dir, options):
+    global _output, args
+    _output = LocalStorage(copy_dir) if copy_dir else None
+    args = options
+
+
+class Archive:
+    """
+    Writes files from memory straight into a zip or tar archive
+
+    Nothing is staged on disk, so however many files are added, the only
+    disk used is the archive itself.  The pdfs are already compressed, so
+    zip entries are stored as they are.
+    """
+
+    TAR_MODES = {'.tar': 'w', '.tar.gz': 'w:gz', '.tgz': 'w:gz', '.tar.bz2': 'w:bz2', '.tar.xz': 'w:xz'}
+
+    def __init__(self, path):
+        self.path = path
+        self._zip = self._tar = None
+        if path.endswith('.zip'):
+            self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+            return
+        for extension, mode in self.TAR_MODES.items():
+            if path.endswith(extension):
+                self._tar = tarfile.open(path, mode)
+                return
+        raise ValueError("{path} is not a .zip or .tar file".format(path=path))
+
+    def add(self, name, data):
+        if self._zip is not None:
+            self._zip.writestr(zipfile.ZipInfo(name, date_time=time.localtime()[:6]), data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0o644
+            self._tar.addfile(info, io.BytesIO(data))
+        return '{path}:{name}'.format(path=self.path, name=name)
+
+    def close(self):
+        (self._zip or self._tar).close()
+
+
+def read_records(input_file):
+    """
+    Stream the records in an input file
+
+    A .jsonl file holds a json object per line and a .csv file a row per
+    record under a header row, with a name and optionally a course_id,
+    grade, designation and issued_date; any other file a name per line.
+    """
+    with open(input_file, encoding='utf-8', newline='') as f:
+        if input_file.endswith('.jsonl'):
+            records = (json.loads(line) for line in f if line.strip())
+        elif input_file.endswith('.csv'):
+            records = csv.DictReader(f)
+        else:
+            records = ({'name': line.rstrip('\r\n')} for line in f if line.strip())
+        for record in records:
+            yield record
+
+
+def read_items(course_list):
+    """
+    Yield a (course, name, title, grade, issued_date) item per certificate
+
+    Records without a course_id are generated for every course in course_list.
+    """
+    if args.name:
+        records = [{'name': args.name}]
+    elif args.input_file:
+        records = read_records(args.input_file)
+    else:
+        records = [{'name': name} for name in NAMES]
+    for record in records:
+        for course in [record['course_id']] if record.get('course_id') else course_list:
+            title = record.get('designation')
+            if title is None and args.assign_title:
+                title = random.choice(stanford_cme_titles)[0]
+                print("assigning random title", record['name'], title, file=sys.stderr)
+            yield (
+                course,
+                record['name'],
+                title,
+                record.get('grade') or args.grade_text or None,
+                record.get('issued_date') or args.issued_date,
+            )
+
+
+def count_items(course_list):
+    """Number of items read_items() yields, reading the input without generating anything"""
+    total = 0
+    for record in ([{}] if args.name else read_records(args.input_file) if args.input_file else NAMES):
+        total += 1 if isinstance(record, dict) and record.get('course_id') else len(course_list)
+    return total
+
+
+def chunk_size():
+    """Items per create_pdfs() call, which seals its own merkle batches"""
+    if settings.CERT_SIGNING_MODE == 'merkle':
+        return settings.CERT_MERKLE_BATCH_SIZE
+    return CHUNK_SIZE
+
+
+def generate(items):
+    """Yield the results of create_pdfs() for items in order, with at most a few chunks per worker queued"""
+    if args.jobs <= 1:
+        while True:
+            chunk = list(itertools.islice(items, chunk_size()))
+            if not chunk:
+                return
+            yield from create_pdfs(chunk)
+    pending = collections.deque()
+    with ProcessPoolExecutor(
+        max_workers=args.jobs,
+        initializer=_init_worker,
+        initargs=(_output and _output.root, args),
+    ) as pool:
+        while True:
+            chunk = list(itertools.islice(items, chunk_size()))
+            if chunk:
+                pending.append(pool.submit(create_pdfs, chunk))
+            if pending and (not chunk or len(pending) >= args.jobs * 2):
+                yield from pending.popleft().result()
+            elif not chunk:
+                return
+
+
+def load_checkpoint(path):
+    """Return the saved progress, or None to start from the beginning"""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['input_file'] != args.input_file or checkpoint['report_file'] != args.report_file:
+        sys.exit("{path} is the checkpoint of a run with another input or report file".format(path=path))
+    return checkpoint
+
+
+def save_checkpoint(path, done, report):
+    """Record that the first done items are generated and reported, atomically"""
+    report_offset = None
+    if report is not None:
+        report.flush()
+        os.fsync(report.fileno())
+        report_offset = report.tell()
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({
+            'input_file': args.input_file,
+            'report_file': args.report_file,
+            'done': done,
+            'report_offset': report_offset,
+        }, f)
+    os.replace(tmp, path)
+
+
+def open_report(checkpoint):
+    """Open the report file, dropping anything written after the checkpoint when resuming"""
+    if checkpoint is None or checkpoint['report_offset'] is None:
+        return open(args.report_file, 'w', encoding='utf-8', newline='')
+    report = open(args.report_file, 'r+', encoding='utf-8', newline='')
+    report.truncate(checkpoint['report_offset'])
+    report.seek(checkpoint['report_offset'])
+    return report
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{hours}:{minutes:02d}:{seconds:02d}'.format(hours=hours, minutes=minutes, seconds=seconds)
+
+
 def main():
     """
     Generates some pfds using each template
     for different names for review in a pdf
     viewer.
-    Will copy out the pdfs into the certs/ dir
+    Will write the pdfs into the TMP_GEN_DIR+copy dir,
+    or the --archive file
     """
-    pdf_dir = TMP_GEN_DIR
-    copy_dir = TMP_GEN_DIR + "+copy"
-
-    # Remove files if they exist
-    for d in [pdf_dir, copy_dir]:
-        if os.path.exists(d):
-            shutil.rmtree(d)
+    if args.archive and args.checkpoint:
+        # A partly written archive cannot be appended to reliably
+        sys.exit("--archive cannot be resumed, so it cannot be used with --checkpoint")
+    checkpoint = load_checkpoint(args.checkpoint)
 
-    if not os.path.exists(copy_dir):
-        os.makedirs(copy_dir)
-
-    certificate_data = []
+    archive = None
+    copy_dir = None
+    if args.archive:
+        try:
+            archive = Archive(args.archive)
+        except ValueError as error:
+            sys.exit(str(error))
+    else:
+        copy_dir = TMP_GEN_DIR + "+copy"
+        # Remove files if they exist, unless resuming
+        if checkpoint is None and os.path.exists(copy_dir):
+            shutil.rmtree(copy_dir)
+        os.makedirs(copy_dir, exist_ok=True)
 
     if args.course_id:
         course_list = [args.course_id]
     else:
         course_list = list(settings.CERT_DATA.keys())
 
-    upload_files = not args.no_upload
-
-    for course in course_list:
-        if args.name:
-            name_list = [args.name]
-        elif args.input_file:
-            with open(args.input_file) as f:
-                name_list = [line.rstrip() for line in f.readlines()]
-        else:
-            name_list = NAMES
+    total = count_items(course_list)
+    skip = checkpoint['done'] if checkpoint else 0
+    items = itertools.islice(read_items(course_list), skip, None)
+    if skip:
+        print("Resuming after {skip} of {total} certificates".format(skip=skip, total=total), file=sys.stderr)
 
-        for name in name_list:
-            cert = CertificateGen(
-                course,
-                args.template_file,
-                aws_id=settings.CERT_AWS_ID,
-                aws_key=settings.CERT_AWS_KEY,
-                dir_prefix=pdf_dir,
-                long_org=args.long_org,
-                long_course=args.long_course,
-                issued_date=args.issued_date,
-            )
-            title = None
-            if args.assign_title:
-                title = random.choice(stanford_cme_titles)[0]
-                print("assigning random title", name, title)
-            grade = None
-            if args.grade_text:
-                grade = args.grade_text
-            (download_uuid, verify_uuid,
-                download_url) = cert.create_and_upload(name, upload=upload_files, copy_to_webroot=False,
-                                                       cleanup=False, designation=title, grade=grade)
-            certificate_data.append((name, course, args.long_org, args.long_course, download_url))
-            gen_dir = os.path.join(cert.dir_prefix, S3_CERT_PATH, download_uuid)
-            copy_dest = '{copy_dir}/{course}-{name}.pdf'.format(
-                copy_dir=copy_dir,
-                name=name.replace(" ", "-").replace("/", "-"),
-                course=course.replace("/", "-"))
-
-            try:
-                shutil.copyfile(f'{gen_dir}/{TARGET_FILENAME}',
-                                str(copy_dest))
-            except Exception as msg:
-                # Sometimes we have problems finding or creating the files to be copied;
-                # the following lines help us debug this case
-                print(msg)
-                print("%s\n%s\n%s\n%s\n%s\n%s" % (name, download_uuid, verify_uuid, download_uuid, gen_dir, copy_dest))
-                raise
-            print(f"Created {copy_dest}")
-
-    should_write_report_to_stdout = not args.no_report
+    report = None
     if args.report_file:
         try:
-            with open(args.report_file, 'wb') as file_report:
-                csv_writer = csv.writer(file_report, quoting=csv.QUOTE_ALL)
-                csv_writer.writerows(certificate_data)
-            should_write_report_to_stdout = False
+            report = open_report(checkpoint)
         except OSError as error:
             LOG.error("Unable to open report file: %s", error)
-    if should_write_report_to_stdout:
-        for row in certificate_data:
-            print('\t'.join(row))
+    report_writer = csv.writer(report, quoting=csv.QUOTE_ALL) if report is not None else None
+
+    # Load fonts and templates once, before forking the workers
+    warmup(courses=course_list)
+    _init_worker(copy_dir, args)
+
+    start = time.perf_counter()
+    done = skip
+    finished = False
+    try:
+        for done, (row, filename, data) in enumerate(generate(items), skip + 1):
+            if archive is not None:
+                copy_dest = archive.add(filename, data)
+            else:
+                copy_dest = os.path.join(copy_dir, filename)
+            if report_writer is not None:
+                report_writer.writerow(row)
+            elif not args.no_report:
+                print('\t'.join(str(value) for value in row))
+            rate = (done - skip) / (time.perf_counter() - start)
+            print("Created {dest} [{done}/{total}, {rate:.1f}/s, ETA {eta}]".format(
+                dest=copy_dest, done=done, total=total, rate=rate,
+                eta=_format_seconds((total - done) / rate)), file=sys.stderr)
+            if args.checkpoint and done % CHECKPOINT_EVERY == 0:
+                save_checkpoint(args.checkpoint, done, report)
+        finished = True
+    finally:
+        if args.checkpoint:
+            if finished and os.path.exists(args.checkpoint):
+                # Nothing left to resume; the next run starts afresh
+                os.remove(args.checkpoint)
+            elif not finished:
+                save_checkpoint(args.checkpoint, done, report)
+        if report is not None:
+            report.close()
+        if archive is not None:
+            archive.close()
+
 
 if __name__ == '__main__':
     args = parse_args()
@@ -3,23 +3,23 @@ import copy
 import datetime
 import io
 import itertools
+import json
 import logging.config
 import math
 import os
 import re
-import shutil
-import tempfile
+import threading
+import time
 import uuid
-from functools import reduce
+import weakref
+from concurrent.futures import Future
+from functools import partial, reduce
 from glob import glob
 
-import boto.s3
-import gnupg
 import reportlab.rl_config
 import six
 from PyPDF2 import PdfFileReader, PdfFileWriter
 from bidi.algorithm import get_display
-from boto.s3.key import Key
 from opaque_keys.edx.keys import CourseKey
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
@@ -36,6 +36,15 @@ from six.moves.html_parser import HTMLParser
 
 import arabic_reshaper
 import settings
+from openedx_certificates.artifacts import ArtifactBundle
+from openedx_certificates.manifest import get_manifest, is_uuid, sha256_hex
+from openedx_certificates.merkle import MerkleBatch
+from openedx_certificates.metrics import METRICS
+from openedx_certificates.outbox import Outbox
+from openedx_certificates.signing import SigningPool, get_signer
+from openedx_certificates.storage import DeleteBatch, LocalStorage, UploadPool, get_s3_client, get_storage
+from openedx_certificates.templates import PDF_TEMPLATES, TEMPLATES
+from openedx_certificates.workspace import get_workspace_pool
 
 reportlab.rl_config.warnOnMissingFontGlyphs = 0
 
@@ -44,39 +53,344 @@ RE_ISODATES = re.compile(r"(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})")
 TEMPLATE_DIR = settings.TEMPLATE_DIR
 BUCKET = settings.CERT_BUCKET
 CERT_KEY_ID = settings.CERT_KEY_ID
-logging.config.dictConfig(settings.LOGGING)
 log = logging.getLogger('certificates.' + __name__)
 S3_CERT_PATH = 'downloads'
 S3_VERIFY_PATH = getattr(settings, 'S3_VERIFY_PATH', 'cert')
+S3_BATCH_PATH = S3_VERIFY_PATH + '/batch'
 TARGET_FILENAME = getattr(settings, 'CERT_FILENAME', 'Certificate.pdf')
 TMP_GEN_DIR = getattr(settings, 'TMP_GEN_DIR', '/var/tmp/generated_certs')
 CERTS_ARE_CALLED = getattr(settings, 'CERTS_ARE_CALLED', 'certificate')
 CERTS_ARE_CALLED_PLURAL = getattr(settings, 'CERTS_ARE_CALLED_PLURAL', 'certificates')
+# Part of every certificate's fingerprint; bump it when a change to the
+# rendering code changes how existing certificates would look
+LAYOUT_VERSION = 1
+
+# Per certificate type fields for the validation page
+VERIFICATION_TYPES = {
+    'verified': {
+        'type': 'idverified',
+        'type_name': 'Verified',
+        'explanation': (
+            "An ID verified certificate signifies that an edX user has "
+            "agreed to abide by edX's honor code and completed all of the "
+            "required tasks of this course under its guidelines, as well "
+            "as having their photo ID checked to verify their identity."
+        ),
+        'img': '''
+            <div class="wrapper--img">
+                <img
+                    class="img--idverified"
+                    src="/v2/static/images/logo-idverified.png"
+                    alt="ID Verified Certificate Logo"
+                />
+            </div>
+        ''',
+    },
+    'honor': {
+        'type': 'honorcode',
+        'type_name': 'Honor Code',
+        'explanation': (
+            "An honor code certificate signifies that an edX user has "
+            "agreed to abide by edX's honor code and completed all of the "
+            "required tasks of this course under its guidelines."
+        ),
+        'img': "",
+    },
+}
 
 # reduce logging level for gnupg
 l = logging.getLogger('gnupg')
 l.setLevel('WARNING')
 
-# Register all fonts in the fonts/ dir; there are likely more fonts here than
-# we need, but the performance hit is minimal -- especially since we only do
-# this at import time.
-#
-# While registering fonts, build a table of the Unicode code points in each
-# for use in font_for_string().
+# Fonts, blank pdfs and the logging configuration are only loaded once
+# something needs them, so that importing this module stays cheap; warmup()
+# loads them all up front.
+_init_lock = threading.Lock()
+_logging_configured = False
+
+# Table of the Unicode code points in each registered font, for
+# font_for_string(); filled in by load_fonts()
 FONT_CHARACTER_TABLES = {}
-for font_file in glob(f'{TEMPLATE_DIR}/fonts/*.ttf'):
-    font_name = os.path.basename(os.path.splitext(font_file)[0])
-    ttf = TTFont(font_name, font_file)
-    FONT_CHARACTER_TABLES[font_name] = list(ttf.face.charToGlyph.keys())
-    pdfmetrics.registerFont(TTFont(font_name, font_file))
-
-# These are small, so let's just load them at import time and keep them around
-# so we don't have to keep doing the file I/o
-BLANK_PDFS = {
-    'landscape-A4': PdfFileReader(open(f"{TEMPLATE_DIR}/blank.pdf", "rb")),
-    'landscape-letter': PdfFileReader(open(f"{TEMPLATE_DIR}/blank-letter.pdf", "rb")),
-    'portrait-A4': PdfFileReader(open(f"{TEMPLATE_DIR}/blank-portrait-A4.pdf", "rb")),
+_fonts_loaded = False
+
+BLANK_PDF_FILES = {
+    'landscape-A4': 'blank.pdf',
+    'landscape-letter': 'blank-letter.pdf',
+    'portrait-A4': 'blank-portrait-A4.pdf',
 }
+_blank_pdfs = {}
+
+# Courses warmed up by warmup(), warmed up again when their stanza in
+# cert-data.yml changes
+_warmed_courses = set()
+
+
+def configure_logging():
+    """Configure logging from settings.LOGGING, once per process"""
+    global _logging_configured
+    with _init_lock:
+        if not _logging_configured:
+            logging.config.dictConfig(settings.LOGGING)
+            _logging_configured = True
+
+
+def load_fonts():
+    """
+    Register all fonts in the fonts/ dir, once per process
+
+    There are likely more fonts here than we need, but they are only
+    loaded once.  While registering fonts, build a table of the Unicode
+    code points in each for use in font_for_string().
+    """
+    global _fonts_loaded
+    if _fonts_loaded:
+        return
+    with _init_lock:
+        if _fonts_loaded:
+            return
+        for font_file in glob(f'{TEMPLATE_DIR}/fonts/*.ttf'):
+            font_name = os.path.basename(os.path.splitext(font_file)[0])
+            ttf = TTFont(font_name, font_file)
+            FONT_CHARACTER_TABLES[font_name] = frozenset(ttf.face.charToGlyph)
+            pdfmetrics.registerFont(ttf)
+        _fonts_loaded = True
+
+
+def blank_pdf(layout):
+    """Return the reader for a blank page in layout, one of BLANK_PDF_FILES, read into memory on first use"""
+    reader = _blank_pdfs.get(layout)
+    if reader is None:
+        with open(os.path.join(TEMPLATE_DIR, BLANK_PDF_FILES[layout]), 'rb') as f:
+            reader = _blank_pdfs.setdefault(layout, PdfFileReader(io.BytesIO(f.read())))
+    return reader
+
+
+def warmup(courses=()):
+    """
+    Load everything certificate generation needs, so the first certificate is not slower than the rest
+
+    courses - ids of courses whose pdf and verification page templates to
+              load too, e.g. every course in settings.CERT_DATA before
+              forking workers that then share them
+
+    Returns the seconds each step took, which are also recorded in METRICS.
+    """
+    steps = [
+        ('logging', configure_logging),
+        ('fonts', load_fonts),
+        ('blank_pdfs', lambda: [blank_pdf(layout) for layout in BLANK_PDF_FILES]),
+        ('courses', lambda: [_warm_course(course_id) for course_id in courses]),
+    ]
+    on_change = getattr(settings.CERT_DATA, 'on_change', None)
+    if courses and on_change and not _warmed_courses:
+        on_change(_rewarm_courses)
+    _warmed_courses.update(courses)
+    seconds = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        step()
+        seconds[name] = time.perf_counter() - start
+        METRICS.timing('warmup.' + name, seconds[name])
+    log.info("warmed up in {seconds:.3f}s".format(seconds=sum(seconds.values())))
+    return seconds
+
+
+def _warm_course(course_id):
+    """Load and parse the templates a course's certificates are rendered from into the shared caches"""
+    try:
+        cert = CertificateGen(course_id)
+    except Exception as e:
+        log.warning("Unable to warm up {course_id}: {error}".format(course_id=course_id, error=e))
+        return
+    try:
+        cert.template_pdf.getPage(0).getContents()
+        if settings.CERT_VERIFICATION_FORMAT != 'json':
+            cert._verification_page_templates()
+    finally:
+        cert.close()
+
+
+def _rewarm_courses(course_ids):
+    """Warm up the warmed up courses among those cert-data.yml changed, forgetting removed ones"""
+    for course_id in course_ids & _warmed_courses:
+        if course_id in settings.CERT_DATA:
+            _warm_course(course_id)
+        else:
+            _warmed_courses.discard(course_id)
+
+
+def _signer_config():
+    """Return the (backend, options) pair selected by settings.CERT_SIGNER"""
+    if getattr(settings, 'CERT_SIGNER', 'gpg') == 'pgpy':
+        return 'pgpy', {
+            'key_file': settings.CERT_SIGNING_KEY_FILE,
+            'key_id': CERT_KEY_ID,
+            'passphrase': settings.CERT_SIGNING_KEY_PASSPHRASE,
+        }
+    return 'gpg', {'homedir': settings.CERT_GPG_DIR, 'key_id': CERT_KEY_ID}
+
+
+def get_cert_signer():
+    """Return this worker's certificate signer, as selected by settings.CERT_SIGNER"""
+    backend, options = _signer_config()
+    return get_signer(backend, **options)
+
+
+_signing_pools = {}
+
+
+def get_signing_pool():
+    """Return this process's signing pool, or None if settings.CERT_SIGNING_WORKERS says to sign inline"""
+    workers = getattr(settings, 'CERT_SIGNING_WORKERS', 0)
+    if not workers:
+        return None
+    pid = os.getpid()
+    if pid not in _signing_pools:
+        backend, options = _signer_config()
+        _signing_pools[pid] = SigningPool(
+            backend,
+            options,
+            workers=workers,
+            queue_size=settings.CERT_SIGNING_QUEUE_SIZE,
+            processes=settings.CERT_SIGNING_PROCESSES,
+        )
+    return _signing_pools[pid]
+
+
+def get_cert_storage():
+    """Return the long-lived storage backend certificates are uploaded to, as selected by settings.CERT_STORAGE"""
+    backend = getattr(settings, 'CERT_STORAGE', 's3')
+    if backend != 's3':
+        return get_storage(backend, **settings.CERT_STORAGE_OPTIONS)
+    options = {}
+    if settings.CERT_S3_HOST:
+        options.update(host=settings.CERT_S3_HOST, port=settings.CERT_S3_PORT, is_secure=settings.CERT_S3_SECURE)
+    return get_s3_client(settings.CERT_AWS_ID, settings.CERT_AWS_KEY, BUCKET, **options)
+
+
+_upload_pools = {}
+
+
+def get_upload_pool():
+    """Return this process's upload pool, or None if settings.CERT_UPLOAD_WORKERS says to upload inline"""
+    workers = getattr(settings, 'CERT_UPLOAD_WORKERS', 0)
+    if not workers:
+        return None
+    pid = os.getpid()
+    if pid not in _upload_pools:
+        _upload_pools[pid] = UploadPool(
+            get_cert_storage(),
+            workers=workers,
+            queue_size=settings.CERT_UPLOAD_QUEUE_SIZE,
+            retries=settings.CERT_UPLOAD_RETRIES,
+        )
+    return _upload_pools[pid]
+
+
+def upload_bundle(bundle):
+    """
+    Upload every artifact of a bundle, returning a Future per upload
+
+    Uploads go through this process's upload pool when there is one,
+    otherwise they are made one at a time before this returns.
+    """
+    if settings.CERT_CONTENT_ENCODING:
+        bundle.compress(settings.CERT_CONTENT_ENCODING, settings.CERT_COMPRESSION_LEVEL)
+
+    upload_pool = get_upload_pool()
+    if upload_pool is not None:
+        return upload_pool.submit_bundle(bundle)
+
+    storage = get_cert_storage()
+    uploaded = []
+    for artifact in bundle:
+        future = Future()
+        try:
+            with METRICS.timer('upload.latency'):
+                storage.upload(artifact.key, artifact.stored_data, artifact.content_type, artifact.content_encoding)
+        except Exception as e:
+            future.set_exception(e)
+            return uploaded + [future]
+        log.info("uploaded {size} bytes to {path}".format(size=len(artifact.stored_data), path=artifact.key))
+        future.set_result(artifact.key)
+        uploaded.append(future)
+    return uploaded
+
+
+_delete_batches = {}
+
+
+def get_delete_batch():
+    """Return this process's batch of keys waiting to be deleted from the certificate storage"""
+    pid = os.getpid()
+    if pid not in _delete_batches:
+        _delete_batches[pid] = DeleteBatch(get_cert_storage())
+    return _delete_batches[pid]
+
+
+_outboxes = {}
+
+
+def get_outbox():
+    """Return this process's upload outbox"""
+    pid = os.getpid()
+    if pid not in _outboxes:
+        _outboxes[pid] = Outbox(
+            upload_bundle,
+            capacity=settings.CERT_OUTBOX_CAPACITY,
+            directory=settings.CERT_OUTBOX_DIR or None,
+            uploaders=settings.CERT_OUTBOX_UPLOADERS,
+            on_uploaded=_record_uploaded,
+        )
+    return _outboxes[pid]
+
+
+def record_in_manifest(bundle, record):
+    """Append a published certificate to its course's manifest, given its CertificateGen._manifest_record()"""
+    if not record or not settings.CERT_MANIFEST_DIR:
+        return
+    manifest = get_manifest(settings.CERT_MANIFEST_DIR, record['course_id'], settings.CERT_MANIFEST_COMPACT_EVERY)
+    manifest.append(
+        bundle.verify_uuid,
+        bundle.download_uuid,
+        bundle.pdf.data,
+        record['name'],
+        record['issued'],
+        keys=[artifact.key for artifact in bundle],
+        download_url=bundle.download_url,
+        fingerprint=record['fingerprint'],
+    )
+
+
+def _record_uploaded(bundle, meta):
+    """Outbox hook recording a certificate queued by create_and_queue() in its manifest"""
+    record_in_manifest(bundle, (meta or {}).get('manifest'))
+
+
+def get_workspace():
+    """Borrow a scratch directory from this process's workspace pool, see settings.CERT_WORKSPACE_DIR"""
+    pool = get_workspace_pool(
+        getattr(settings, 'CERT_WORKSPACE_DIR', '') or TMP_GEN_DIR,
+        size=getattr(settings, 'CERT_WORKSPACES', 4),
+        budget=getattr(settings, 'CERT_WORKSPACE_BUDGET', 0) or None,
+        legacy_prefix=TMP_GEN_DIR,
+    )
+    return pool.acquire()
+
+
+def _cert_data_digest(course_id):
+    """Version of the course's configuration, when settings.CERT_DATA tracks it"""
+    digest = getattr(settings.CERT_DATA, 'digest', None)
+    return digest(course_id) if digest else None
+
+
+def _manifest_uuid(download_uuid, verify_uuid):
+    """The uuid to look a certificate up by in its manifest; stanford_cme ones only have 'No Verification'"""
+    return verify_uuid if is_uuid(verify_uuid) else download_uuid
+
+
+# Destinations the json verifier page has been published to by this process
+_verifier_pages_published = set()
 
 
 def prettify_isodate(isoformat_date):
@@ -130,12 +444,13 @@ def font_for_string(fontlist, ustring):
     """
     # TODO: There's probably a way to do this by consulting reportlab that
     #       doesn't require re-loading the font files at all
+    load_fonts()
     ustring = str(ustring)
     if fontlist and not ustring:
         return fontlist[0]
     for fonttuple in fontlist:
         fonttag = fonttuple[0]
-        codepoints = FONT_CHARACTER_TABLES.get(fonttag, [])
+        codepoints = FONT_CHARACTER_TABLES.get(fonttag, frozenset())
         if not codepoints:
             warnstring = "Missing or invalid font specification {fonttag} " \
                          "rendering string '{ustring}'.\nFontlist: {fontlist}".format(
@@ -193,7 +508,8 @@ class CertificateGen:
         course_name  - Human readable course title (ex: Introduction to Curling)
         dir_prefix   - Temporary directory for file generation. Ceritificates
                        and signatures are copied here temporarily before they
-                       are uploaded to S3
+                       are uploaded to S3; by default a workspace is borrowed
+                       until close()
         template_pdf - (optional) Template (filename.pdf) to use for the
                        certificate generation.
         aws_id       - necessary for S3 uploads
@@ -207,17 +523,33 @@ class CertificateGen:
           * TEMPLATEFILE - the template pdf filename to use, equivalent to
                            template_pdf parameter
         """
+        configure_logging()
+        load_fonts()
+        # Without a dir_prefix, borrow a workspace until this generator is
+        # closed or garbage collected
+        self.workspace = None
         if dir_prefix is None:
-            self._ensure_dir(TMP_GEN_DIR)
-            dir_prefix = tempfile.mkdtemp(prefix=TMP_GEN_DIR)
-        self._ensure_dir(dir_prefix)
+            self.workspace = get_workspace()
+            self._release_workspace = weakref.finalize(self, self.workspace.release)
+            dir_prefix = self.workspace.path
+        os.makedirs(os.path.dirname(dir_prefix), exist_ok=True)
         self.dir_prefix = dir_prefix
+        self._inspection = None
+        self.course_id = course_id
+        # Set while create_and_upload_many() is signing in merkle batches
+        self._batch_sign = False
+        self._merkle_batch = None
+        # Certificates from create_and_queue() still waiting on their signature
+        self._queued = collections.deque()
+        # Verification page templates prefilled for this course
+        self._page_templates = {}
 
         self.aws_id = str(aws_id)
         self.aws_key = str(aws_key)
 
         cert_data = settings.CERT_DATA.get(course_id, {})
         self.cert_data = cert_data
+        self._cert_data_digest = _cert_data_digest(course_id)
 
         def interstitial_factory():
             """ Generate default values for interstitial_texts defaultdict """
@@ -257,8 +589,10 @@ class CertificateGen:
             template_pdf_filename = f"{template_prefix}/{template_pdf}"
             if 'verified' in template_pdf:
                 self.template_type = 'verified'
+        self.template_pdf_filename = template_pdf_filename
+        self._template_sha256 = None
         try:
-            self.template_pdf = PdfFileReader(open(template_pdf_filename, "rb"))
+            self.template_pdf = PDF_TEMPLATES.get(template_pdf_filename)
         except IOError as e:
             log.critical("I/O error ({0}): {1} opening {2}".format(e.errno, e.strerror, template_pdf_filename))
             raise
@@ -267,9 +601,123 @@ class CertificateGen:
         self.cert_label_plural = cert_data.get('CERTS_ARE_CALLED_PLURAL', CERTS_ARE_CALLED_PLURAL)
         self.course_association_text = cert_data.get('COURSE_ASSOCIATION_TEXT', 'a course of study')
 
-    def delete_certificate(self, delete_download_uuid, delete_verify_uuid):
-        # TODO remove/archive an existing certificate
-        raise NotImplementedError
+    @property
+    def stale(self):
+        """True if the course's stanza in cert-data.yml changed since this generator was made"""
+        return _cert_data_digest(self.course_id) != self._cert_data_digest
+
+    def fingerprint(self, name, grade=None, designation=None):
+        """
+        Return a digest of everything that goes into rendering a certificate
+
+        Two certificates with the same fingerprint look the same: it covers
+        the student's name, grade and designation, the course's names,
+        date and configuration, the template file, the layout version and
+        the signing key.
+        """
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        if self._template_sha256 is None:
+            with open(self.template_pdf_filename, 'rb') as f:
+                self._template_sha256 = sha256_hex(f.read())
+        inputs = {
+            'layout': [LAYOUT_VERSION, self.template_version],
+            'template': self._template_sha256,
+            # The date as rendered, today's for ROLLING courses
+            'course': [
+                self.course_id, self.long_org, self.long_course, get_cert_date(None, self.issued_date), self.cert_data,
+            ],
+            'key_id': CERT_KEY_ID,
+            'student': [name, grade, designation],
+        }
+        return sha256_hex(json.dumps(inputs, sort_keys=True, default=str))
+
+    def unchanged_certificate(self, download_uuid, verify_uuid, name, grade=None, designation=None):
+        """
+        Look up a published certificate that regenerating would not change
+
+        Returns its (download_uuid, verify_uuid, download_url) if the
+        course's manifest has it, not revoked, with the fingerprint of name,
+        grade and designation; otherwise None, and it needs regenerating.
+        """
+        if not settings.CERT_MANIFEST_DIR:
+            return None
+        manifest = get_manifest(settings.CERT_MANIFEST_DIR, self.course_id, settings.CERT_MANIFEST_COMPACT_EVERY)
+        entry = manifest.lookup(_manifest_uuid(download_uuid, verify_uuid))
+        if (
+            entry is None or entry.get('revoked') or
+            entry['download_uuid'] != download_uuid or (entry['verify_uuid'] or '') != (verify_uuid or '') or
+            entry.get('fingerprint') != self.fingerprint(name, grade, designation)
+        ):
+            return None
+        METRICS.incr('regen.unchanged')
+        log.info("certificate {uuid} is unchanged, keeping it".format(uuid=download_uuid))
+        return download_uuid, verify_uuid, entry['download_url']
+
+    def close(self):
+        """Give the borrowed workspace back, emptying it; dir_prefix must not be used afterwards"""
+        self.finish_queued()
+        if self.workspace is not None:
+            self._release_workspace()
+
+    def delete_certificate(
+        self,
+        delete_download_uuid,
+        delete_verify_uuid,
+        defer=False,
+        upload=settings.S3_UPLOAD,
+        copy_to_webroot=settings.COPY_TO_WEB_ROOT,
+        cert_web_root=settings.CERT_WEB_ROOT,
+    ):
+        """
+        Delete a certificate's download and verification files
+
+        Files are removed from wherever create_and_upload() publishes them
+        to.  With defer, the keys to delete from the certificate storage
+        are only added to get_delete_batch(), to be deleted together with
+        those of other certificates in multi-object delete requests once
+        the batch is full or flushed.
+        """
+        if upload:
+            storage = get_cert_storage()
+            batch = get_delete_batch()
+            batch.add(self._certificate_keys(storage, delete_download_uuid, delete_verify_uuid))
+            if not defer:
+                batch.flush()
+        if copy_to_webroot:
+            webroot = get_storage('local', root=cert_web_root)
+            webroot.delete(self._certificate_keys(webroot, delete_download_uuid, delete_verify_uuid))
+        if settings.CERT_MANIFEST_DIR:
+            manifest = get_manifest(settings.CERT_MANIFEST_DIR, self.course_id, settings.CERT_MANIFEST_COMPACT_EVERY)
+            manifest.revoke(_manifest_uuid(delete_download_uuid, delete_verify_uuid))
+        log.info("deleted certificate {download_uuid} {verify_uuid}".format(
+            download_uuid=delete_download_uuid, verify_uuid=delete_verify_uuid))
+
+    def delete_certificates(self, uuids, **publish_args):
+        """Delete many certificates, given as (download_uuid, verify_uuid) pairs, in as few requests as possible"""
+        for download_uuid, verify_uuid in uuids:
+            self.delete_certificate(download_uuid, verify_uuid, defer=True, **publish_args)
+        get_delete_batch().flush()
+
+    def _certificate_keys(self, storage, download_uuid, verify_uuid):
+        """
+        Return the keys of a certificate's files
+
+        They are recorded in the manifest, if the certificate is in one;
+        otherwise its download and verification prefixes are listed.
+        """
+        if settings.CERT_MANIFEST_DIR:
+            manifest = get_manifest(
+                settings.CERT_MANIFEST_DIR, self.course_id, settings.CERT_MANIFEST_COMPACT_EVERY)
+            entry = manifest.lookup(_manifest_uuid(download_uuid, verify_uuid))
+            if entry and entry.get('keys'):
+                return entry['keys']
+        keys = []
+        for path, cert_uuid in ((S3_CERT_PATH, download_uuid), (S3_VERIFY_PATH, verify_uuid)):
+            # An empty uuid would list every certificate, a placeholder such as 'No Verification' nothing
+            if is_uuid(cert_uuid):
+                keys.extend(storage.list('{path}/{uuid}/'.format(path=path, uuid=cert_uuid)))
+        return keys
 
     def create_and_upload(
         self,
@@ -285,8 +733,10 @@ class CertificateGen:
         name - Full name that will be on the certificate
         upload - Upload to S3 (defaults to True)
 
-        set upload to False if you do not want to upload to S3,
-        this will also keep temporary files that are created.
+        set upload to False if you do not want to upload to S3.
+
+        Certificates are generated in memory; set cleanup to False to
+        also write the generated files below dir_prefix for inspection.
 
         returns a tuple containing the UUIDs for download, verify and
         the full download URL.  If upload is set to False
@@ -297,77 +747,229 @@ class CertificateGen:
         verify_uuid will be None if there is no verification signature
 
         """
-        download_uuid = None
-        verify_uuid = None
-        download_url = None
-        s3_conn = None
-        bucket = None
+        self._ensure_verifier_page(upload, copy_to_webroot, cert_web_root)
+        bundle = self._generate_certificate(student_name=name, grade=grade, designation=designation)
+        published = self._publish(bundle.finish(), upload, cleanup, copy_to_webroot, cert_web_root)
+        self._record_in_manifest(name, bundle, grade, designation)
+        return published
 
-        certificates_path = os.path.join(self.dir_prefix, S3_CERT_PATH)
-        verify_path = os.path.join(self.dir_prefix, S3_VERIFY_PATH)
+    def create_and_queue(
+        self,
+        name,
+        upload=settings.S3_UPLOAD,
+        cleanup=True,
+        copy_to_webroot=settings.COPY_TO_WEB_ROOT,
+        cert_web_root=settings.CERT_WEB_ROOT,
+        grade=None,
+        designation=None,
+        meta=None,
+    ):
+        """
+        Generate a certificate and leave its signing and upload to the background
+
+        Takes the same arguments as create_and_upload, plus meta, which is
+        spooled with the certificate when the outbox is kept on disk and
+        handed back by Outbox.recover() after a restart.
+
+        Returns as soon as the certificate is rendered, with a Future for
+        its ArtifactBundle that is resolved once every file has been
+        uploaded; bundle.as_tuple() gives (download_uuid, verify_uuid,
+        download_url).  With a signing pool the pdf is still being signed
+        while the next one renders: certificates are handed to the outbox
+        by later calls once signed, so call finish_queued() before waiting
+        on the Future of the last one.
+        """
+        self._ensure_verifier_page(upload, copy_to_webroot, cert_web_root)
+        bundle = self._generate_certificate(student_name=name, grade=grade, designation=designation)
+        # Spooled along, so that it is also recorded when recovered after a restart
+        meta = dict(meta or {}, manifest=self._manifest_record(name, grade, designation))
+        published = Future()
+        self._queued.append((bundle, meta, published, (upload, cleanup, copy_to_webroot, cert_web_root)))
+        self._queue_signed()
+        return published
+
+    def finish_queued(self):
+        """Wait for the signatures of every certificate from create_and_queue() and hand them to the outbox"""
+        self._queue_signed(wait=True)
+
+    def _queue_signed(self, wait=False):
+        """Hand the certificates from create_and_queue() that are signed to the outbox, in order"""
+        while self._queued and (wait or self._queued[0][0].ready):
+            bundle, meta, published, (upload, cleanup, copy_to_webroot, cert_web_root) = self._queued.popleft()
+            try:
+                bundle.finish()
+                self._start_publish(bundle, False, cleanup, copy_to_webroot, cert_web_root)
+                if upload:
+                    get_outbox().put(bundle, meta, result=published)
+                    continue
+                _record_uploaded(bundle, meta)
+            except Exception as e:
+                published.set_exception(e)
+                continue
+            published.set_result(bundle)
+
+    def create_and_upload_many(
+        self,
+        jobs,
+        upload=settings.S3_UPLOAD,
+        cleanup=True,
+        copy_to_webroot=settings.COPY_TO_WEB_ROOT,
+        cert_web_root=settings.CERT_WEB_ROOT,
+        batch_sign=None,
+    ):
+        """
+        Generate and publish several certificates, overlapping rendering and signing
+
+        jobs       - iterable of dicts with a 'name' and optionally a 'grade'
+                     and 'designation'
+        batch_sign - sign in merkle batches of CERT_MERKLE_BATCH_SIZE
+                     certificates rather than one signature each; defaults
+                     to CERT_SIGNING_MODE == 'merkle'
+
+        Each pdf is handed to the signing stage as soon as it is rendered
+        and rendering carries on with the next job; with a signing pool
+        configured, its bounded queue stops rendering from running too far
+        ahead of signing.  Signed certificates are handed to the upload
+        pool in the same way, and yielded in order once all of their
+        files are uploaded.
+
+        In batch mode only the root of each batch is signed; every
+        certificate's verification pages carry its inclusion proof and a
+        link to the signed root, which is published under S3_BATCH_PATH.
+
+        yields (job, ArtifactBundle) per job; bundle.as_tuple() gives
+        (download_uuid, verify_uuid, download_url)
+        """
+        if batch_sign is None:
+            batch_sign = getattr(settings, 'CERT_SIGNING_MODE', 'detached') == 'merkle'
+        batch_sign = batch_sign and bool(CERT_KEY_ID)
+        publish_args = (upload, cleanup, copy_to_webroot, cert_web_root)
+        self._ensure_verifier_page(upload, copy_to_webroot, cert_web_root)
+
+        # Jobs waiting on their signature, then jobs waiting on their uploads
+        pending = collections.deque()
+        uploading = collections.deque()
+        try:
+            self._batch_sign = batch_sign
+            for job in jobs:
+                bundle = self._generate_certificate(
+                    student_name=job['name'],
+                    grade=job.get('grade'),
+                    designation=job.get('designation'),
+                )
+                pending.append((job, bundle))
+                if self._merkle_batch is not None and len(self._merkle_batch) >= settings.CERT_MERKLE_BATCH_SIZE:
+                    self._seal_batch(*publish_args)
+                while pending and pending[0][1].ready:
+                    uploading.append(self._start_publish_job(pending.popleft(), publish_args))
+                while uploading and all(f.done() for f in uploading[0][2]):
+                    yield self._finish_publish_job(uploading.popleft())
+            if self._merkle_batch is not None:
+                self._seal_batch(*publish_args)
+            while pending:
+                uploading.append(self._start_publish_job(pending.popleft(), publish_args))
+            while uploading:
+                yield self._finish_publish_job(uploading.popleft())
+        finally:
+            self._batch_sign = False
+            self._merkle_batch = None
+
+    def _start_publish_job(self, pending_job, publish_args):
+        job, bundle = pending_job
+        return job, bundle, self._start_publish(bundle.finish(), *publish_args)
+
+    def _finish_publish_job(self, uploading_job):
+        job, bundle, upload_futures = uploading_job
+        for upload_future in upload_futures:
+            upload_future.result()
+        self._record_in_manifest(job['name'], bundle, job.get('grade'), job.get('designation'))
+        return job, bundle
+
+    def _record_in_manifest(self, name, bundle, grade=None, designation=None):
+        """Append a published certificate to its course's manifest, if manifests are enabled"""
+        record_in_manifest(bundle, self._manifest_record(name, grade, designation))
+
+    def _manifest_record(self, name, grade=None, designation=None):
+        """What record_in_manifest() needs besides the bundle, as json; None if manifests are disabled"""
+        if not settings.CERT_MANIFEST_DIR:
+            return None
+        return {
+            'course_id': self.course_id,
+            'name': name.decode('utf-8') if isinstance(name, bytes) else name,
+            'issued': self.issued_date,
+            'fingerprint': self.fingerprint(name, grade, designation),
+        }
 
-        (download_uuid, verify_uuid, download_url) = self._generate_certificate(student_name=name,
-                                                                                download_dir=certificates_path,
-                                                                                verify_dir=verify_path,
-                                                                                grade=grade,
-                                                                                designation=designation,)
+    def _seal_batch(self, upload, cleanup, copy_to_webroot, cert_web_root):
+        """Sign the current merkle batch's root and publish it"""
+        batch, self._merkle_batch = self._merkle_batch, None
+        root_document, signature = batch.seal(course_id=self.course_id, key_id=CERT_KEY_ID)
+        root_bundle = ArtifactBundle('', batch.batch_id, '', S3_CERT_PATH, S3_BATCH_PATH)
+        root_bundle.add_verification('root.json', root_document, 'application/json')
+        root_bundle.add_verification('root.json.sig', signature, 'application/pgp-signature')
+        self._publish(root_bundle, upload, cleanup, copy_to_webroot, cert_web_root)
+        METRICS.incr('signing.batches')
+        log.info("signed batch {batch_id} of {count} certificates".format(batch_id=batch.batch_id, count=len(batch)))
+
+    def _publish(self, bundle, upload, cleanup, copy_to_webroot, cert_web_root):
+        """Upload and/or copy a finished bundle, returning its uuids and download url"""
+        for upload_future in self._start_publish(bundle, upload, cleanup, copy_to_webroot, cert_web_root):
+            upload_future.result()
+
+        return bundle.as_tuple()
+
+    def _start_publish(self, bundle, upload, cleanup, copy_to_webroot, cert_web_root):
+        """
+        Start publishing a finished bundle
 
+        With an upload pool configured the artifacts are uploaded
+        concurrently and this returns their Futures without waiting.
+        """
         # upload generated certificate and verification files to S3,
-        # or copy them to the web root. Or both.
-        my_certs_path = os.path.join(certificates_path, download_uuid)
-        my_verify_path = os.path.join(verify_path, verify_uuid)
-
-        if upload:
-            s3_conn = boto.connect_s3(settings.CERT_AWS_ID, settings.CERT_AWS_KEY)
-            bucket = s3_conn.get_bucket(BUCKET)
-
-        if upload or copy_to_webroot:
-            for subtree in (my_certs_path, my_verify_path):
-                for dirpath, dirnames, filenames in os.walk(subtree):
-                    for filename in filenames:
-                        local_path = os.path.join(dirpath, filename)
-                        dest_path = os.path.relpath(local_path, start=self.dir_prefix)
-                        publish_dest = os.path.join(cert_web_root, dest_path)
-
-                        if upload:
-                            try:
-                                key = Key(bucket, name=dest_path)
-                                key.set_contents_from_filename(local_path, policy='public-read')
-                            except:
-                                raise
-                            else:
-                                log.info("uploaded {local} to {s3path}".format(local=local_path, s3path=dest_path))
-
-                        if copy_to_webroot:
-                            try:
-                                dirname = os.path.dirname(publish_dest)
-                                if not os.path.exists(dirname):
-                                    os.makedirs(dirname)
-                                shutil.copy(local_path, publish_dest)
-                            except:
-                                raise
-                            else:
-                                log.info("published {local} to {web}".format(local=local_path, web=publish_dest))
-
-        if cleanup:
-            for working_dir in (certificates_path, verify_path):
-                if os.path.exists(working_dir):
-                    shutil.rmtree(working_dir)
-
-        return (download_uuid, verify_uuid, download_url)
+        # or copy them to the web root. Or both. Everything is still in
+        # memory at this point, so publish straight from the bundle.
+        upload_futures = upload_bundle(bundle) if upload else []
+
+        published = {}
+        if copy_to_webroot:
+            webroot = get_storage('local', root=cert_web_root)
+            for artifact in bundle:
+                published[artifact.key] = webroot.upload(artifact.key, artifact.data, artifact.content_type)
+                log.info("published {web}".format(web=published[artifact.key]))
+
+        # Keep a copy of the generated files around for inspection, linked
+        # to the published copy rather than written again where possible
+        if not cleanup and self.workspace is not None and not self.workspace.has_room(bundle.size):
+            log.warning("workspace budget exceeded, not keeping {uuid} for inspection".format(
+                uuid=bundle.download_uuid))
+            METRICS.incr('workspace.over_budget')
+        elif not cleanup:
+            if self.workspace is not None:
+                self.workspace.add_usage(bundle.size)
+            # Not shared, as a workspace is emptied between generators
+            if self._inspection is None:
+                self._inspection = LocalStorage(self.dir_prefix)
+            inspection = self._inspection
+            for artifact in bundle:
+                if artifact.key in published:
+                    path, how = inspection.link(artifact.key, published[artifact.key], artifact.data)
+                    METRICS.incr('publish.' + how)
+                else:
+                    inspection.upload(artifact.key, artifact.data, artifact.content_type)
+
+        return upload_futures
 
     def _generate_certificate(
         self,
         student_name,
-        download_dir,
-        verify_dir,
         filename=TARGET_FILENAME,
         grade=None,
         designation=None,
     ):
         """Generate a certificate PDF, signature and validation html files.
 
-        return (download_uuid, verify_uuid, download_url)
+        return an ArtifactBundle with everything that needs publishing;
+        its signature may still be pending, call finish() before publishing
         """
         versionmap = {
             1: self._generate_v1_certificate,
@@ -380,8 +982,6 @@ class CertificateGen:
         # TODO: we should be taking args, kwargs, and passing those on to our callees
         return versionmap[self.template_version](
             student_name,
-            download_dir,
-            verify_dir,
             filename,
             grade,
             designation,
@@ -390,8 +990,6 @@ class CertificateGen:
     def _generate_v1_certificate(
         self,
         student_name,
-        download_dir,
-        verify_dir,
         filename=TARGET_FILENAME,
         grade=None,
         designation=None,
@@ -403,7 +1001,6 @@ class CertificateGen:
         download_url = "{base_url}/{cert}/{uuid}/{file}".format(
             base_url=settings.CERT_DOWNLOAD_URL,
             cert=S3_CERT_PATH, uuid=download_uuid, file=filename)
-        filename = os.path.join(download_dir, download_uuid, filename)
 
         # This file is overlaid on the template certificate
         overlay_pdf_buffer = io.BytesIO()
@@ -637,33 +1234,21 @@ class CertificateGen:
         # So that we don't have to open the template
         # several times, we open a blank pdf several times instead
         # (much faster)
-        final_certificate = copy.copy(BLANK_PDFS['landscape-A4']).getPage(0)
+        final_certificate = copy.copy(blank_pdf('landscape-A4')).getPage(0)
         final_certificate.mergePage(self.template_pdf.getPage(0))
         final_certificate.mergePage(overlay.getPage(0))
 
         output.addPage(final_certificate)
 
-        self._ensure_dir(filename)
+        bundle = self._bundle_pdf(output, filename, download_uuid, verify_uuid, download_url)
 
-        outputStream = open(filename, "wb")
-        output.write(outputStream)
-        outputStream.close()
+        self._generate_verification_page(student_name, bundle)
 
-        self._generate_verification_page(
-            student_name,
-            filename,
-            verify_dir,
-            verify_uuid,
-            download_url
-        )
-
-        return (download_uuid, verify_uuid, download_url)
+        return bundle
 
     def _generate_v2_certificate(
         self,
         student_name,
-        download_dir,
-        verify_dir,
         filename=TARGET_FILENAME,
         grade=None,
         designation=None,
@@ -682,7 +1267,6 @@ class CertificateGen:
             base_url=settings.CERT_DOWNLOAD_URL,
             cert=S3_CERT_PATH, uuid=download_uuid, file=filename
         )
-        filename = os.path.join(download_dir, download_uuid, filename)
 
         # This file is overlaid on the template certificate
         overlay_pdf_buffer = io.BytesIO()
@@ -934,33 +1518,21 @@ class CertificateGen:
         # several times, we open a blank pdf several times instead
         # (much faster)
 
-        final_certificate = copy.copy(BLANK_PDFS['landscape-letter']).getPage(0)
+        final_certificate = copy.copy(blank_pdf('landscape-letter')).getPage(0)
         final_certificate.mergePage(self.template_pdf.getPage(0))
         final_certificate.mergePage(overlay.getPage(0))
 
         output.addPage(final_certificate)
 
-        self._ensure_dir(filename)
-
-        outputStream = open(filename, "wb")
-        output.write(outputStream)
-        outputStream.close()
+        bundle = self._bundle_pdf(output, filename, download_uuid, verify_uuid, download_url)
 
-        self._generate_verification_page(
-            student_name,
-            filename,
-            verify_dir,
-            verify_uuid,
-            download_url
-        )
+        self._generate_verification_page(student_name, bundle)
 
-        return (download_uuid, verify_uuid, download_url)
+        return bundle
 
     def _generate_mit_pe_certificate(
         self,
         student_name,
-        download_dir,
-        verify_dir,
         filename=TARGET_FILENAME,
         grade=None,
         designation=None,
@@ -979,8 +1551,6 @@ class CertificateGen:
             cert=S3_CERT_PATH, uuid=download_uuid, file=filename
         )
 
-        filename = os.path.join(download_dir, download_uuid, filename)
-
         # This file is overlaid on the template certificate
         overlay_pdf_buffer = io.BytesIO()
         c = canvas.Canvas(overlay_pdf_buffer)
@@ -1072,27 +1642,25 @@ class CertificateGen:
 
         # We need a page to overlay on.
         # So that we don't have to open the template
-        # several times, we open a blank pdf several times instead
+        # several times, we use a blank pdf instead
         # (much faster)
-
-        blank_pdf = PdfFileReader(
-            open(f"{TEMPLATE_DIR}/blank-letter.pdf", "rb")
-        )
-
-        final_certificate = blank_pdf.getPage(0)
+        final_certificate = copy.copy(blank_pdf('landscape-letter')).getPage(0)
         final_certificate.mergePage(self.template_pdf.getPage(0))
         final_certificate.mergePage(overlay.getPage(0))
 
         output.addPage(final_certificate)
 
-        self._ensure_dir(filename)
+        return self._bundle_pdf(output, filename, download_uuid, verify_uuid, download_url)
 
-        outputStream = open(filename, "wb")
-        output.write(outputStream)
-        outputStream.close()
-        return (download_uuid, verify_uuid, download_url)
+    def _bundle_pdf(self, output, filename, download_uuid, verify_uuid, download_url):
+        """Serialize a rendered PdfFileWriter into a new ArtifactBundle"""
+        pdf_buffer = io.BytesIO()
+        output.write(pdf_buffer)
+        bundle = ArtifactBundle(download_uuid, verify_uuid, download_url, S3_CERT_PATH, S3_VERIFY_PATH)
+        bundle.add_pdf(filename, pdf_buffer.getvalue())
+        return bundle
 
-    def _generate_verification_page(self, name, filename, output_dir, verify_uuid, download_url):
+    def _generate_verification_page(self, name, bundle):
         """
         This generates the gpg signature and the
         verification files including
@@ -1100,115 +1668,236 @@ class CertificateGen:
         the user clicks the verification link.
 
         name - full name of the student
-        filename - path on the local filesystem to the certificate pdf
-        output_dir - where to write the verification files
-        verify_uuid - UUID for the verification files
-        download_url - link to the pdf download (for the verifcation page)"""
+        bundle - ArtifactBundle holding the certificate pdf; the
+                 signature and verification pages are added to it
+
+        The pdf is handed to the signing stage straight away; the signature
+        and pages are added once it is signed, when the bundle is finished."""
 
         # Do not do anything if there isn't any GPG Key to sign with
         if not CERT_KEY_ID:
             return
 
-        prefix = ''
-        if self.template_version == 2:
-            prefix = 'v2/'
-        valid_template = prefix + 'valid.html'
-        verify_template = prefix + 'verify.html'
+        if self._batch_sign:
+            # Started by the first certificate that needs signing, so
+            # courses without verification pages seal no empty batches
+            if self._merkle_batch is None:
+                self._merkle_batch = MerkleBatch(uuid.uuid4().hex, get_cert_signer().sign)
+            proof = self._merkle_batch.add(bundle.pdf.data)
+            bundle.defer(proof, partial(self._write_batch_verification_pages, name, bundle))
+            return
 
-        # generate signature
-        signature_filename = os.path.basename(filename) + ".sig"
-        signature_filename = os.path.join(output_dir, verify_uuid, signature_filename)
-        self._ensure_dir(signature_filename)
+        bundle.defer(self._sign_pdf(bundle.pdf), partial(self._write_verification_pages, name, bundle))
+
+    def _sign_pdf(self, pdf):
+        """Submit a pdf artifact for signing, returning a Future for its signature"""
+        pool = get_signing_pool()
+        if pool is not None:
+            return pool.submit(pdf.data)
+        future = Future()
+        with METRICS.timer('signing.latency'):
+            future.set_result(get_cert_signer().sign(pdf.open()))
+        return future
+
+    def _write_verification_pages(self, name, bundle, signed_data):
+        """Add the signature and the verification pages for a signed pdf to the bundle"""
+        if settings.CERT_VERIFICATION_FORMAT == 'json':
+            self._add_verification_record(name, bundle, signature=signed_data.decode('utf-8'))
+            return
 
-        gpg = gnupg.GPG(homedir=settings.CERT_GPG_DIR)
-        gpg.encoding = 'utf-8'
-        with open(filename, 'rb') as f:
-            signed_data = gpg.sign(data=f, default_key=CERT_KEY_ID, clearsign=False, detach=True).data
-        with open(signature_filename, 'wb') as f:
-            f.write(signed_data)
+        signature_filename = bundle.pdf.filename + ".sig"
+        bundle.add_verification(signature_filename, signed_data, 'application/pgp-signature')
 
-        # create the validation page
         signature_download_url = "{verify_url}/{verify_path}/{verify_uuid}/{verify_filename}".format(
             verify_url=settings.CERT_VERIFY_URL,
             verify_path=S3_VERIFY_PATH,
-            verify_uuid=verify_uuid,
-            verify_filename=os.path.basename(signature_filename))
+            verify_uuid=bundle.verify_uuid,
+            verify_filename=signature_filename)
 
-        verify_page_url = "{verify_url}/{verify_path}/{verify_uuid}/verify.html".format(
+        self._add_verification_pages(name, bundle, signed_data, signature_download_url)
+
+    def _write_batch_verification_pages(self, name, bundle, proof):
+        """Add the inclusion proof and the verification pages for a batch-signed pdf to the bundle"""
+        root_url = "{verify_url}/{batch_path}/{batch_id}/root.json".format(
+            verify_url=settings.CERT_VERIFY_URL,
+            batch_path=S3_BATCH_PATH,
+            batch_id=proof.batch_id)
+        if settings.CERT_VERIFICATION_FORMAT == 'json':
+            self._add_verification_record(name, bundle, proof=proof.as_dict(), root_url=root_url)
+            return
+
+        bundle.add_verification('proof.json', proof.to_json(), 'application/json')
+        proof_url = "{verify_url}/{verify_path}/{verify_uuid}/proof.json".format(
             verify_url=settings.CERT_VERIFY_URL,
             verify_path=S3_VERIFY_PATH,
-            verify_uuid=verify_uuid)
+            verify_uuid=bundle.verify_uuid)
+
+        self._add_verification_pages(
+            name,
+            bundle,
+            proof.to_json(),
+            root_url + '.sig',
+            verify_template='verify-batch.html',
+            ROOT_URL=root_url,
+            ROOT_FILE=os.path.basename(root_url),
+            ROOT_HASH=proof.root.hex(),
+            PROOF_URL=proof_url,
+            PROOF_FILE=os.path.basename(proof_url),
+            DOCUMENT_SHA256=proof.document_digest.hex(),
+        )
 
-        type_map = {
-            'verified': {'type': 'idverified', 'type_name': 'Verified'},
-            'honor': {'type': 'honorcode', 'type_name': 'Honor Code'},
-        }
+    def _add_verification_record(self, name, bundle, **fields):
+        """
+        Add the single json verification record for a signed pdf to the bundle
 
-        type_map['verified']['explanation'] = (
-            "An ID verified certificate signifies that an edX user has "
-            "agreed to abide by edX's honor code and completed all of the "
-            "required tasks of this course under its guidelines, as well "
-            "as having their photo ID checked to verify their identity."
+        The record is rendered client-side by the shared verifier page, see
+        publish_verifier_page(). fields holds the signature, or the inclusion
+        proof and batch root url for batch-signed certificates.
+        """
+        type_info = VERIFICATION_TYPES[self.template_type]
+        record = {
+            'version': 1,
+            'certificate_id': bundle.verify_uuid,
+            'name': name,
+            'course': self.course,
+            'course_long': self.long_course,
+            'org': self.org,
+            'org_long': self.long_org,
+            'issued': self.issued_date,
+            'type': type_info['type'],
+            'type_name': type_info['type_name'],
+            'download_url': bundle.download_url,
+            'pdf_file': bundle.pdf.filename,
+            'key_id': CERT_KEY_ID,
+        }
+        record.update(fields)
+        bundle.add_verification(
+            'record.json',
+            json.dumps(record, separators=(',', ':'), sort_keys=True),
+            'application/json',
         )
-        type_map['verified']['img'] = '''
-            <div class="wrapper--img">
-                <img
-                    class="img--idverified"
-                    src="/v2/static/images/logo-idverified.png"
-                    alt="ID Verified Certificate Logo"
-                />
-            </div>
-        '''
-        type_map['honor']['explanation'] = (
-            "An honor code certificate signifies that an edX user has "
-            "agreed to abide by edX's honor code and completed all of the "
-            "required tasks of this course under its guidelines."
+
+    def publish_verifier_page(
+        self,
+        upload=settings.S3_UPLOAD,
+        copy_to_webroot=settings.COPY_TO_WEB_ROOT,
+        cert_web_root=settings.CERT_WEB_ROOT,
+    ):
+        """
+        Publish the static page that renders json verification records
+
+        One page serves every certificate of the deployment, at
+        {CERT_VERIFY_URL}/{S3_VERIFY_PATH}/verifier.html#<verify_uuid>
+        """
+        template = TEMPLATES.get(self._verification_template_path('verifier.html'))
+        page = template.render(
+            CERTS_ARE_CALLED=CERTS_ARE_CALLED.title(),
+            CERTS_ARE_CALLED_PLURAL=CERTS_ARE_CALLED_PLURAL.title(),
+            CERT_KEY_ID=CERT_KEY_ID,
+            VERIFY_URL=settings.CERT_VERIFY_URL,
+            RECORD_PATH='/' + S3_VERIFY_PATH,
         )
-        type_map['honor']['img'] = ""
-
-        with open(f"{TEMPLATE_DIR}/{valid_template}") as f:
-            valid_page = f.read()
-        valid_page = valid_page.format(
-            COURSE=self.course,
-            COURSE_LONG=self.long_course,
-            ORG=self.org,
-            ORG_LONG=self.long_org,
+        bundle = ArtifactBundle('', '', '', S3_CERT_PATH, S3_VERIFY_PATH)
+        bundle.add(S3_VERIFY_PATH + '/verifier.html', page, 'text/html')
+        self._publish(bundle, upload, True, copy_to_webroot, cert_web_root)
+        log.info("published the verifier page")
+
+    def _ensure_verifier_page(self, upload, copy_to_webroot, cert_web_root):
+        """Publish the verifier page once per process and destination when using json records"""
+        if settings.CERT_VERIFICATION_FORMAT != 'json' or not CERT_KEY_ID:
+            return
+        destination = (upload and BUCKET, copy_to_webroot and cert_web_root)
+        if destination not in _verifier_pages_published:
+            self.publish_verifier_page(upload, copy_to_webroot, cert_web_root)
+            _verifier_pages_published.add(destination)
+
+    def _add_verification_pages(self, name, bundle, signature, signature_url, verify_template=None, **verify_fields):
+        """
+        Render valid.html and verify.html into the bundle
+
+        signature       - signature, or inclusion proof, shown on valid.html
+        signature_url   - where the signature file can be downloaded
+        verify_template - template for verify.html, defaults to the one for
+                          this template version
+        verify_fields   - additional fields for the verify.html template
+        """
+        verify_uuid = bundle.verify_uuid
+        verify_page_url = "{verify_url}/{verify_path}/{verify_uuid}/verify.html".format(
+            verify_url=settings.CERT_VERIFY_URL,
+            verify_path=S3_VERIFY_PATH,
+            verify_uuid=verify_uuid)
+        if isinstance(signature, bytes):
+            signature = signature.decode('utf-8')
+
+        valid_page, verify_page = self._verification_page_templates(verify_template)
+
+        # create the validation page
+        bundle.add_verification("valid.html", valid_page.render(
             NAME=name,
             CERTIFICATE_ID=verify_uuid,
-            SIGNATURE=signed_data,
-            SIG_URL=signature_download_url,
+            SIGNATURE=signature,
+            SIG_URL=signature_url,
             VERIFY_URL=verify_page_url,
-            TYPE=type_map[self.template_type]['type'],
-            TYPE_NAME=type_map[self.template_type]['type_name'],
-            ISSUE_DATE=self.issued_date,
-            IMG=type_map[self.template_type]['img'],
-            CERTS_ARE_CALLED=CERTS_ARE_CALLED.title(),
-            CERTS_ARE_CALLED_PLURAL=CERTS_ARE_CALLED_PLURAL.title(),
-            EXPLANATION=type_map[self.template_type]['explanation'],
-        )
+        ))
+
+        bundle.add_verification("verify.html", verify_page.render(
+            NAME=name,
+            SIG_URL=signature_url,
+            SIG_FILE=os.path.basename(signature_url),
+            VERIFY_URL=verify_page_url,
+            PDF_FILE=os.path.basename(bundle.download_url),
+            **verify_fields
+        ))
 
-        with open(os.path.join(output_dir, verify_uuid, "valid.html"), 'w') as f:
-            f.write(valid_page)
+    def _verification_page_templates(self, verify_template=None):
+        """
+        Return the valid.html and verify.html templates with this course's fields filled in
 
-        with open(f"{TEMPLATE_DIR}/{verify_template}") as f:
-            verify_page = f.read().format(
-                NAME=name,
-                SIG_URL=signature_download_url,
-                SIG_FILE=os.path.basename(signature_download_url),
+        The compiled templates come from the shared cache, so the prefilled
+        copies are rebuilt whenever a template file changes on disk.
+        """
+        prefix = ''
+        if self.template_version == 2:
+            prefix = 'v2/'
+        verify_template = verify_template or prefix + 'verify.html'
+        cache_key = verify_template
+        valid_template = TEMPLATES.get(self._verification_template_path(prefix + 'valid.html'))
+        verify_template = TEMPLATES.get(self._verification_template_path(verify_template))
+
+        cached = self._page_templates.get(cache_key)
+        if cached is not None and cached[0] is valid_template and cached[1] is verify_template:
+            return cached[2]
+
+        type_info = VERIFICATION_TYPES[self.template_type]
+        pages = (
+            valid_template.prefill(
+                COURSE=self.course,
+                COURSE_LONG=self.long_course,
+                ORG=self.org,
+                ORG_LONG=self.long_org,
+                TYPE=type_info['type'],
+                TYPE_NAME=type_info['type_name'],
+                ISSUE_DATE=self.issued_date,
+                IMG=type_info['img'],
+                CERTS_ARE_CALLED=CERTS_ARE_CALLED.title(),
+                CERTS_ARE_CALLED_PLURAL=CERTS_ARE_CALLED_PLURAL.title(),
+                EXPLANATION=type_info['explanation'],
+            ),
+            verify_template.prefill(
                 CERT_KEY_ID=CERT_KEY_ID,
                 CERTS_ARE_CALLED=CERTS_ARE_CALLED.title(),
                 CERTS_ARE_CALLED_PLURAL=CERTS_ARE_CALLED_PLURAL.title(),
-                VERIFY_URL=verify_page_url,
-                PDF_FILE=os.path.basename(download_url)
-            )
-
-        with open(os.path.join(output_dir, verify_uuid, "verify.html"), 'w') as f:
-            f.write(verify_page)
+            ),
+        )
+        self._page_templates[cache_key] = (valid_template, verify_template, pages)
+        return pages
 
-    def _ensure_dir(self, f):
-        d = os.path.dirname(f)
-        if not os.path.exists(d):
-            os.makedirs(d)
+    def _verification_template_path(self, template):
+        """Find a verification page template, falling back to the one shipped with this repo"""
+        path = os.path.join(TEMPLATE_DIR, template)
+        if not os.path.exists(path):
+            path = os.path.join(settings.REPO_PATH, settings.TEMPLATE_DATA_SUBDIR, template)
+        return path
 
     def _contains_characters_above(self, string, value):
         """
@@ -1249,8 +1938,6 @@ class CertificateGen:
     def _generate_stanford_SOA(
         self,
         student_name,
-        download_dir,
-        verify_dir,
         filename=TARGET_FILENAME,
         grade=None,
         designation=None,
@@ -1260,8 +1947,6 @@ class CertificateGen:
 
         REQUIRED PARAMETERS:
         student_name  - specifies student name as it must appear on the cert.
-        download_dir  -
-        verify_dir    -
 
         OPTIONAL PARAMETERS:
         filename      - the filename to write out, i.e., 'Certificate.pdf'.
@@ -1285,7 +1970,7 @@ class CertificateGen:
                        TEMPLATEFILE will be used as the template over which
                        to render.
 
-        RETURNS (download_uuid, verify_uuid, download_url)
+        RETURNS an ArtifactBundle holding the pdf and any verification files
         """
 
         verify_me_p = self.cert_data.get('VERIFY', True)
@@ -1295,8 +1980,6 @@ class CertificateGen:
             base_url=settings.CERT_DOWNLOAD_URL,
             cert=S3_CERT_PATH, uuid=download_uuid, file=filename)
 
-        filename = os.path.join(download_dir, download_uuid, filename)
-
         # This file is overlaid on the template certificate
         overlay_pdf_buffer = io.BytesIO()
         c = canvas.Canvas(overlay_pdf_buffer, pagesize=landscape(A4))
@@ -1447,34 +2130,22 @@ class CertificateGen:
 
         # We render the final certificate by merging several rendered pages.
         # It is fastest if the bottom layer is blank and loaded from memory
-        final_certificate = copy.copy(BLANK_PDFS['landscape-A4']).getPage(0)
+        final_certificate = copy.copy(blank_pdf('landscape-A4')).getPage(0)
         final_certificate.mergePage(self.template_pdf.getPage(0))
         final_certificate.mergePage(overlay.getPage(0))
 
         output.addPage(final_certificate)
 
-        self._ensure_dir(filename)
-
-        outputStream = open(filename, "wb")
-        output.write(outputStream)
-        outputStream.close()
+        bundle = self._bundle_pdf(output, filename, download_uuid, verify_uuid, download_url)
 
         if verify_me_p:
-            self._generate_verification_page(
-                student_name,
-                filename,
-                verify_dir,
-                verify_uuid,
-                download_url
-            )
+            self._generate_verification_page(student_name, bundle)
 
-        return (download_uuid, verify_uuid, download_url)
+        return bundle
 
     def _generate_stanford_cme_certificate(
         self,
         student_name,
-        download_dir,
-        verify_dir,
         filename=TARGET_FILENAME,
         grade=None,
         designation=None,
@@ -1484,8 +2155,6 @@ class CertificateGen:
 
         REQUIRED PARAMETERS:
         student_name  - specifies student name as it must appear on the cert.
-        download_dir  -
-        verify_dir    -
 
         OPTIONAL PARAMETERS:
         filename      - the filename to write out, i.e., 'Certificate.pdf'.
@@ -1515,7 +2184,7 @@ class CertificateGen:
                        TEMPLATEFILE will be used as the template over which
                        to render.
 
-        RETURNS (download_uuid, verify_uuid, download_url)
+        RETURNS an ArtifactBundle holding the pdf and any verification files
 
         Note that CME certificates never generate verification URLs; the
         underlying template is expected to embed contact information for
@@ -1533,8 +2202,6 @@ class CertificateGen:
             uuid=download_uuid,
             file=filename,
         )
-        filename = os.path.join(download_dir, download_uuid, filename)
-        self._ensure_dir(filename)
 
         # Manipulate student titles
         gets_md_cert = False
@@ -1654,22 +2321,18 @@ class CertificateGen:
 
         # We render the final certificate by merging several rendered pages.
         # It's fastest if the bottom layer is a blank page loaded from RAM
-        final_certificate = copy.copy(BLANK_PDFS['landscape-letter']).getPage(0)
+        final_certificate = copy.copy(blank_pdf('landscape-letter')).getPage(0)
         final_certificate.mergePage(self.template_pdf.getPage(0))
         final_certificate.mergePage(overlay.getPage(0))
 
         output = PdfFileWriter()
         output.addPage(final_certificate)
-        with open(filename, "wb") as ostream:
-            output.write(ostream)
 
-        return (download_uuid, 'No Verification', download_url)
+        return self._bundle_pdf(output, filename, download_uuid, 'No Verification', download_url)
 
     def _generate_v3_dynamic_certificate(
         self,
         student_name,
-        download_dir,
-        verify_dir,
         filename=TARGET_FILENAME,
         grade=None,
         designation=None,
@@ -1679,8 +2342,6 @@ class CertificateGen:
 
         REQUIRED PARAMETERS:
         student_name  - specifies student name as it must appear on the cert.
-        download_dir  -
-        verify_dir    -
 
         OPTIONAL PARAMETERS:
         filename      - the filename to write out, e.g., 'Statement.pdf'.
@@ -1706,7 +2367,7 @@ class CertificateGen:
                          TEMPLATEFILE will be used as the template over which
                          to render.
 
-        RETURNS (download_uuid, verify_uuid, download_url)
+        RETURNS an ArtifactBundle holding the pdf and any verification files
         """
 
         verify_me_p = self.cert_data.get('VERIFY', True)
@@ -1719,8 +2380,6 @@ class CertificateGen:
             file=filename,
         )
 
-        filename = os.path.join(download_dir, download_uuid, filename)
-
         # This file is overlaid on the template certificate
         overlay_pdf_buffer = io.BytesIO()
         PAGE = canvas.Canvas(overlay_pdf_buffer, pagesize=landscape(A4))
@@ -1955,27 +2614,17 @@ class CertificateGen:
 
         # We render the final certificate by merging several rendered pages.
         # It is fastest if the bottom layer is blank and loaded from memory
-        final_certificate = copy.copy(BLANK_PDFS['landscape-A4']).getPage(0)
+        final_certificate = copy.copy(blank_pdf('landscape-A4')).getPage(0)
         final_certificate.mergePage(self.template_pdf.getPage(0))
         final_certificate.mergePage(overlay.getPage(0))
 
         output.addPage(final_certificate)
 
-        self._ensure_dir(filename)
-
-        outputStream = open(filename, "wb")
-        output.write(outputStream)
-        outputStream.close()
+        bundle = self._bundle_pdf(output, filename, download_uuid, verify_uuid, download_url)
 
         # have to create the verification page seperately from the above
         # conditional because filename must have already been written.
         if verify_me_p:
-            self._generate_verification_page(
-                student_name,
-                filename,
-                verify_dir,
-                verify_uuid,
-                download_url,
-            )
+            self._generate_verification_page(student_name, bundle)
 
-        return (download_uuid, verify_uuid, download_url)
+        return bundle
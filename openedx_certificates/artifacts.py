@@ -0,0 +1,190 @@
+"""
+In-memory containers for the files generated for a single certificate.
+
+A certificate is made of a PDF plus, optionally, a detached signature and
+the verification pages.  Rather than writing each of these to a temporary
+directory, reading them back to sign them and walking the tree to upload
+them, the generators collect them into an ArtifactBundle which is handed to
+the publishing step as-is.  The disk is only touched by the storage
+backends it is published to, e.g. a web root, and by the outbox spool.
+
+Text artifacts can also be stored compressed, see ArtifactBundle.compress().
+"""
+import gzip
+import io
+import logging
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+# Content types worth compressing: the verification pages and records
+COMPRESSIBLE_TYPES = ('text/html', 'application/json')
+
+
+def _gzip(data, level=None):
+    # mtime=0 so the same page always compresses to the same bytes
+    return gzip.compress(data, compresslevel=9 if level is None else level, mtime=0)
+
+
+def _brotli(data, level=None):
+    if brotli is None:
+        raise ImportError("br content encoding requires the brotli package")
+    return brotli.compress(data, quality=11 if level is None else level, mode=brotli.MODE_TEXT)
+
+
+def _unbrotli(data):
+    if brotli is None:
+        raise ImportError("br content encoding requires the brotli package")
+    return brotli.decompress(data)
+
+
+# Content-Encoding -> function(data, level) compressing data
+COMPRESSORS = {
+    'gzip': _gzip,
+    'br': _brotli,
+}
+# Content-Encoding -> function(data) decompressing data
+DECOMPRESSORS = {
+    'gzip': gzip.decompress,
+    'br': _unbrotli,
+}
+
+
+class Artifact:
+    """A single generated file, keyed by its path relative to the bucket root"""
+
+    def __init__(self, key, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.key = key
+        self.data = data
+        self.content_type = content_type or mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        # Compressed copy of data to store instead, see compress()
+        self.content_encoding = None
+        self.encoded_data = None
+
+    @property
+    def filename(self):
+        return self.key.rsplit('/', 1)[-1]
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def open(self):
+        """
+        Return a read-only file-like view of the data
+
+        BytesIO shares the underlying bytes object until it is written to,
+        so this does not copy the artifact.
+        """
+        return io.BytesIO(self.data)
+
+    def compress(self, encoding, level=None):
+        """
+        Keep a copy of the data compressed with a Content-Encoding
+
+        The data itself is unchanged; storage backends that support
+        content encodings store stored_data with that content_encoding.
+        """
+        self.encoded_data = COMPRESSORS[encoding](self.data, level)
+        self.content_encoding = encoding
+
+    @property
+    def stored_data(self):
+        """The bytes to store, compressed if compress() was called"""
+        return self.data if self.encoded_data is None else self.encoded_data
+
+    def __repr__(self):
+        return '<Artifact {key} ({size} bytes)>'.format(key=self.key, size=self.size)
+
+
+class ArtifactBundle:
+    """
+    All of the artifacts generated for one certificate
+
+    download_uuid - UUID of the download prefix
+    verify_uuid   - UUID of the verification prefix, may be empty or
+                    a placeholder for templates that do not verify
+    download_url  - public URL of the certificate pdf
+    """
+
+    def __init__(self, download_uuid, verify_uuid, download_url, download_path='downloads', verify_path='cert'):
+        self.download_uuid = download_uuid
+        self.verify_uuid = verify_uuid
+        self.download_url = download_url
+        self.download_path = download_path
+        self.verify_path = verify_path
+        self.pdf = None
+        self._artifacts = {}
+        self._pending = []
+
+    def add(self, key, data, content_type=None):
+        artifact = Artifact(key, data, content_type)
+        self._artifacts[key] = artifact
+        return artifact
+
+    def add_pdf(self, filename, data):
+        """Add the certificate pdf under the download prefix"""
+        self.pdf = self.add(self.download_key(filename), data, 'application/pdf')
+        return self.pdf
+
+    def add_verification(self, filename, data, content_type=None):
+        """Add a signature or verification page under the verify prefix"""
+        return self.add(self.verify_key(filename), data, content_type)
+
+    def download_key(self, filename):
+        return '/'.join((self.download_path, self.download_uuid, filename))
+
+    def verify_key(self, filename):
+        return '/'.join((self.verify_path, self.verify_uuid, filename))
+
+    def get(self, key):
+        return self._artifacts.get(key)
+
+    def compress(self, encoding, level=None, content_types=COMPRESSIBLE_TYPES):
+        """Compress every artifact of one of content_types, see Artifact.compress()"""
+        for artifact in self:
+            if artifact.content_type in content_types and artifact.content_encoding != encoding:
+                artifact.compress(encoding, level)
+
+    def defer(self, future, callback):
+        """
+        Register a step that is waiting on another stage, e.g. signing
+
+        callback is called with the future's result by finish().
+        """
+        self._pending.append((future, callback))
+
+    @property
+    def ready(self):
+        """True once finish() can complete without blocking"""
+        return all(future.done() for future, callback in self._pending)
+
+    def finish(self):
+        """Wait for any deferred steps and complete the bundle"""
+        while self._pending:
+            future, callback = self._pending.pop(0)
+            callback(future.result())
+        return self
+
+    def as_tuple(self):
+        return (self.download_uuid, self.verify_uuid, self.download_url)
+
+    @property
+    def size(self):
+        return sum(artifact.size for artifact in self)
+
+    def __iter__(self):
+        return iter(list(self._artifacts.values()))
+
+    def __len__(self):
+        return len(self._artifacts)
+
+    def __contains__(self, key):
+        return key in self._artifacts
@@ -0,0 +1,214 @@
+"""
+Course configuration loaded from cert-data.yml.
+
+Parsing a cert-data.yml with thousands of course stanzas in pure Python
+takes a noticeable part of every worker's startup.  CertData parses it
+with libyaml's CSafeLoader when PyYAML was built with it, and keeps the
+result in a pickled index named after the file's sha256, which the next
+process loads instead of parsing the yaml again.  As unpickling can run
+code, an index is only read from a directory owned by this user and
+closed to everyone else, which is created that way if it does not exist.
+
+CertData is a read-only mapping of course id to stanza that notices when
+the file changes, checking at most every `check_interval` seconds, and
+reloads it in place; if the new version does not parse, the previous one
+is kept.  digest(course_id) identifies the current version of
+a course's stanza, so whatever was built from an older one, such as a
+CertificateGen, can tell it is stale.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+from collections.abc import Mapping
+
+import yaml
+
+from openedx_certificates.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+# libyaml's loader is an order of magnitude faster, when available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# Bump when the layout of the index changes
+INDEX_VERSION = 1
+
+
+def default_cache_dir():
+    """Per-user directory for the indexes, as they are unpickled"""
+    return os.path.join(tempfile.gettempdir(), 'cert-data-{uid}'.format(uid=os.getuid()))
+
+
+def private_dir(path):
+    """
+    Create path as a directory only this user can use, if it does not exist
+
+    Returns whether it is one: a real directory, not a symlink, owned by
+    this user and with no permissions for group or others.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def stanza_digest(stanza):
+    return hashlib.sha256(json.dumps(stanza, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class CertData(Mapping):
+    """
+    The courses in a cert-data.yml file, reloaded when it changes
+
+    path           - the yaml file
+    cache_dir      - directory for the pickled indexes, None to always parse
+    check_interval - seconds between checks of the file for changes
+    """
+
+    def __init__(self, path, cache_dir=None, check_interval=1.0, metrics=METRICS):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.check_interval = check_interval
+        self.metrics = metrics
+        self.sha256 = None
+        self._courses = {}
+        self._digests = {}
+        self._stat = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.reload()
+
+    def _current(self):
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            self._checked = now
+            self.reload()
+        return self._courses
+
+    def __getitem__(self, course_id):
+        return self._current()[course_id]
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
+
+    def digest(self, course_id):
+        """Identifies the current stanza for course_id, None if there is none"""
+        self._current()
+        return self._digests.get(course_id)
+
+    def on_change(self, callback):
+        """Call callback(course_ids) with the courses added, changed or removed by every reload"""
+        self._listeners.append(callback)
+
+    def reload(self):
+        """Load the file again if it changed; returns the ids of the courses that changed"""
+        try:
+            changed = self._reload()
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            # A missing, half-written or broken file must not take down
+            # whoever is using the last good version
+            if self.sha256 is None:
+                raise
+            log.error("Unable to reload {path}, keeping the previous version: {error}".format(
+                path=self.path, error=e))
+            self.metrics.incr('config.errors')
+            return set()
+        if changed is not None:
+            log.info("reloaded {path}, {count} courses changed".format(path=self.path, count=len(changed)))
+            self.metrics.incr('config.reloads')
+            for callback in self._listeners:
+                callback(changed)
+        return changed or set()
+
+    def _reload(self):
+        """
+        Load the file if it changed
+
+        Returns the ids of the courses that changed, or None if the file is
+        unchanged or was loaded for the first time.
+        """
+        st = os.stat(self.path)
+        file_id = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            if file_id == self._stat:
+                return None
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+            self._stat = file_id
+            sha256 = hashlib.sha256(raw).hexdigest()
+            if sha256 == self.sha256:
+                return None
+            courses, digests = self._load(raw, sha256)
+            changed = {
+                course_id for course_id in set(digests) | set(self._digests)
+                if digests.get(course_id) != self._digests.get(course_id)
+            }
+            first = self.sha256 is None
+            self._courses, self._digests, self.sha256 = courses, digests, sha256
+        return None if first else changed
+
+    def _index_path(self, sha256):
+        return os.path.join(self.cache_dir, '{name}.{sha256}.pickle'.format(
+            name=os.path.basename(self.path), sha256=sha256))
+
+    def _load(self, raw, sha256):
+        """Return (courses, digests) for the file contents, from the index if there is one"""
+        if self.cache_dir and self._private_cache_dir():
+            try:
+                with open(self._index_path(sha256), 'rb') as f:
+                    version, courses, digests = pickle.load(f)
+                if version == INDEX_VERSION:
+                    self.metrics.incr('config.index_hits')
+                    return courses, digests
+            except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+                pass
+        with self.metrics.timer('config.parse'):
+            courses = yaml.load(raw.decode('utf-8'), Loader=YAML_LOADER) or {}
+        if not isinstance(courses, dict):
+            raise ValueError("{path} is not a mapping of course ids to settings".format(path=self.path))
+        digests = {course_id: stanza_digest(stanza) for course_id, stanza in courses.items()}
+        if self.cache_dir and self._private_cache_dir():
+            try:
+                self._write_index(sha256, courses, digests)
+            except OSError as e:
+                log.warning("Unable to write the index of {path}: {error}".format(path=self.path, error=e))
+        return courses, digests
+
+    def _private_cache_dir(self):
+        """Whether the indexes can be trusted; see private_dir()"""
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_dir)), exist_ok=True)
+            if private_dir(self.cache_dir):
+                return True
+        except OSError as e:
+            log.warning("Unable to use {dir} for indexes: {error}".format(dir=self.cache_dir, error=e))
+            return False
+        log.warning("Not using {dir} for indexes, it must be a directory only this user can access".format(
+            dir=self.cache_dir))
+        return False
+
+    def _write_index(self, sha256, courses, digests):
+        index = self._index_path(sha256)
+        tmp = '{index}.{pid}.tmp'.format(index=index, pid=os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump((INDEX_VERSION, courses, digests), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, index)
+        # Indexes of earlier versions of the file are of no further use
+        for old in glob.glob(self._index_path('*')):
+            if old != index:
+                try:
+                    os.unlink(old)
+                except OSError:
+                    pass
@@ -0,0 +1,266 @@
+"""
+Append-only per-course manifests of issued certificates.
+
+Auditing, revoking or regenerating certificates should not mean listing
+every cert/<uuid>/ prefix in the bucket.  Instead every certificate that is
+published is also appended to a manifest for its course:
+
+    <root>/<course>/log.jsonl          entries appended since the last compaction
+    <root>/<course>/shard-<x>.jsonl    compacted entries, sharded by the
+                                       first hex digit of the verify uuid,
+                                       or download uuid if there is none
+                                       (or only a placeholder, as stanford_cme
+                                       certificates record 'No Verification')
+    <root>/<course>/index.sqlite       verify and download uuid -> entry
+
+An entry records the uuids, the sha256 of the pdf and of the student name
+and the issue date.  Deleting a certificate appends its entry again with
+the time it was revoked.  The log is only ever appended to, one line per write,
+so concurrent agents can share a manifest.  Once it grows past
+compact_every entries it is folded into the shards.  The index can be
+rebuilt from the shards and log at any time.
+
+    python -m openedx_certificates.manifest ROOT COURSE_ID lookup UUID
+    python -m openedx_certificates.manifest ROOT COURSE_ID compact
+    python -m openedx_certificates.manifest ROOT COURSE_ID reindex
+"""
+import collections
+import datetime
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+LOG_FILE = 'log.jsonl'
+INDEX_FILE = 'index.sqlite'
+LOCK_FILE = '.lock'
+SHARD_FILE = 'shard-{prefix}.jsonl'
+COMPACT_EVERY = 10000
+UUID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def sha256_hex(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _now():
+    return datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
+
+
+def is_uuid(value):
+    """Whether value is a real uuid, as opposed to a placeholder such as 'No Verification'"""
+    return isinstance(value, str) and UUID_RE.match(value) is not None
+
+
+def course_dirname(course_id):
+    """Filesystem safe directory name for a course id"""
+    return re.sub(r'[^A-Za-z0-9._-]', '_', str(course_id))
+
+
+class CourseManifest:
+    """
+    The manifest of certificates issued for one course
+
+    root          - directory holding the manifests of every course
+    course_id     - course the certificates belong to
+    compact_every - fold the log into the shards once it holds this many
+                    entries; 0 to only compact explicitly
+    """
+
+    def __init__(self, root, course_id, compact_every=COMPACT_EVERY):
+        self.course_id = str(course_id)
+        self.path = os.path.join(root, course_dirname(course_id))
+        self.compact_every = compact_every
+        os.makedirs(self.path, exist_ok=True)
+        self._local = threading.local()
+        self._log_entries = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _locked(self):
+        """Hold the manifest lock, shared with other processes"""
+        with open(self._file(LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @property
+    def _index(self):
+        """sqlite connection to the index, one per thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._file(INDEX_FILE), timeout=30)
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (uuid TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def _index_entries(self, lines):
+        with self._index as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (uuid, entry) VALUES (?, ?)",
+                [(uuid, line) for line in lines for uuid in self._uuids(json.loads(line))],
+            )
+
+    @staticmethod
+    def _key(entry):
+        """Certificates without a verification page are keyed by their download uuid"""
+        verify_uuid = entry.get('verify_uuid')
+        return verify_uuid if is_uuid(verify_uuid) else entry['download_uuid']
+
+    @staticmethod
+    def _uuids(entry):
+        return [uuid for uuid in (entry.get('verify_uuid'), entry.get('download_uuid')) if is_uuid(uuid)]
+
+    def append(self, verify_uuid, download_uuid, content, name, issued, **extra):
+        """
+        Record an issued certificate
+
+        content - the certificate pdf, stored as its sha256
+        name    - the name on the certificate, stored as its sha256
+        extra   - any additional fields to record
+        """
+        entry = dict(extra)
+        entry.update({
+            'verify_uuid': verify_uuid,
+            'download_uuid': download_uuid,
+            'content_sha256': sha256_hex(content),
+            'name_sha256': sha256_hex(name),
+            'issued': issued,
+            'recorded': _now(),
+        })
+        with self._locked():
+            self._write(entry)
+        return entry
+
+    def revoke(self, uuid):
+        """
+        Record that a certificate was deleted
+
+        Returns its entry, now with a 'revoked' time, or None if it is not
+        in the manifest.
+        """
+        with self._locked():
+            entry = self.lookup(uuid)
+            if entry is None:
+                return None
+            entry['revoked'] = _now()
+            self._write(entry)
+        return entry
+
+    def _write(self, entry):
+        """Append an entry to the log, holding the lock"""
+        line = json.dumps(entry, separators=(',', ':'), sort_keys=True)
+        with open(self._file(LOG_FILE), 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+        self._index_entries([line])
+        if self._log_entries is not None:
+            self._log_entries += 1
+        if self.compact_every and self._count_log() >= self.compact_every:
+            self._compact()
+
+    def lookup(self, uuid):
+        """Return the entry for a verify or download uuid, or None"""
+        row = self._index.execute("SELECT entry FROM entries WHERE uuid = ?", (uuid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __contains__(self, uuid):
+        return self.lookup(uuid) is not None
+
+    def __iter__(self):
+        """Every entry in the manifest, compacted shards first"""
+        for filename in sorted(glob.glob(self._file(SHARD_FILE.format(prefix='*')))) + [self._file(LOG_FILE)]:
+            for line in self._lines(filename):
+                yield json.loads(line)
+
+    @staticmethod
+    def _lines(filename):
+        try:
+            with open(filename, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield line.rstrip('\n')
+        except FileNotFoundError:
+            return
+
+    def _count_log(self):
+        if self._log_entries is None:
+            self._log_entries = sum(1 for _ in self._lines(self._file(LOG_FILE)))
+        return self._log_entries
+
+    def compact(self):
+        """Fold the log into the shards"""
+        with self._locked():
+            self._compact()
+
+    def _compact(self):
+        by_shard = collections.defaultdict(list)
+        for line in self._lines(self._file(LOG_FILE)):
+            by_shard[self._key(json.loads(line))[:1]].append(line)
+        for prefix, lines in by_shard.items():
+            shard = self._file(SHARD_FILE.format(prefix=prefix))
+            # Later entries for the same certificate replace earlier ones
+            entries = collections.OrderedDict()
+            for line in list(self._lines(shard)) + lines:
+                entries[self._key(json.loads(line))] = line
+            tmp = shard + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.writelines(line + '\n' for line in entries.values())
+            os.replace(tmp, shard)
+        open(self._file(LOG_FILE), 'w').close()
+        self._log_entries = 0
+        log.info("compacted {count} manifest entries for {course}".format(
+            count=sum(len(lines) for lines in by_shard.values()), course=self.course_id))
+
+    def reindex(self):
+        """Rebuild the index from the shards and the log"""
+        with self._locked():
+            with self._index as conn:
+                conn.execute("DELETE FROM entries")
+            self._index_entries(json.dumps(entry, separators=(',', ':'), sort_keys=True) for entry in self)
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(root, course_id, compact_every=COMPACT_EVERY):
+    """Return the manifest for a course, shared within the process"""
+    key = (root, str(course_id))
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = CourseManifest(root, course_id, compact_every)
+        return _manifests[key]
+
+
+def main(args=sys.argv[1:]):
+    if len(args) < 3 or args[2] not in ('lookup', 'compact', 'reindex') or (args[2] == 'lookup') != (len(args) == 4):
+        sys.exit("usage: python -m openedx_certificates.manifest ROOT COURSE_ID (lookup UUID|compact|reindex)")
+    manifest = CourseManifest(args[0], args[1], compact_every=0)
+    if args[2] == 'lookup':
+        entry = manifest.lookup(args[3])
+        if entry is None:
+            sys.exit("{uuid} is not in the manifest for {course}".format(uuid=args[3], course=args[1]))
+        print(json.dumps(entry, indent=2, sort_keys=True))
+    elif args[2] == 'compact':
+        manifest.compact()
+    else:
+        manifest.reindex()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Merkle-batched certificate signing.
+
+Instead of one gpg signature per certificate, a batch of certificates is
+hashed into a Merkle tree and only a small root document is signed.  Each
+certificate gets an inclusion proof: the sibling hashes needed to walk from
+its own hash up to the signed root.  Verifying a certificate then means
+checking the root document's signature once and recomputing the path:
+
+    leaf   = sha256(0x00 || sha256(pdf))
+    parent = sha256(0x01 || left || right)
+
+An odd node at the end of a level is carried up unchanged.
+
+To check a certificate against its proof and the batch root document:
+
+    python -m openedx_certificates.merkle Certificate.pdf proof.json root.json
+"""
+import datetime
+import hashlib
+import json
+import sys
+import threading
+from concurrent.futures import Future
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def _sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+def leaf_hash(document_digest):
+    """Tree leaf for a document given the sha256 digest of its contents"""
+    return _sha256(LEAF_PREFIX + document_digest)
+
+
+def node_hash(left, right):
+    return _sha256(NODE_PREFIX + left + right)
+
+
+class MerkleTree:
+    """Binary hash tree over a list of leaf hashes"""
+
+    def __init__(self, leaves):
+        if not leaves:
+            raise ValueError("Cannot build a Merkle tree without leaves")
+        self.levels = [list(leaves)]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                parents.append(level[-1])
+            self.levels.append(parents)
+
+    @property
+    def root(self):
+        return self.levels[-1][0]
+
+    def proof(self, index):
+        """
+        Return the inclusion proof for a leaf
+
+        A list of (side, sibling_hash) pairs from the leaf upwards, where
+        side says whether the sibling sits to the 'left' or 'right'.
+        """
+        path = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                path.append(('left' if sibling < index else 'right', level[sibling]))
+            index //= 2
+        return path
+
+
+def root_from_proof(leaf, path):
+    node = leaf
+    for side, sibling in path:
+        node = node_hash(sibling, node) if side == 'left' else node_hash(node, sibling)
+    return node
+
+
+class InclusionProof:
+    """Where one document sits in a signed batch"""
+
+    def __init__(self, batch_id, index, document_digest, path, root):
+        self.batch_id = batch_id
+        self.index = index
+        self.document_digest = document_digest
+        self.path = path
+        self.root = root
+
+    def verify(self, data):
+        """True if data is the document this proof was issued for"""
+        digest = _sha256(data)
+        return digest == self.document_digest and root_from_proof(leaf_hash(digest), self.path) == self.root
+
+    def as_dict(self):
+        return {
+            'version': 1,
+            'algorithm': 'sha256',
+            'batch_id': self.batch_id,
+            'index': self.index,
+            'document_sha256': self.document_digest.hex(),
+            'path': [[side, sibling.hex()] for side, sibling in self.path],
+            'root': self.root.hex(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    @classmethod
+    def from_dict(cls, proof):
+        return cls(
+            proof['batch_id'],
+            proof['index'],
+            bytes.fromhex(proof['document_sha256']),
+            [(side, bytes.fromhex(sibling)) for side, sibling in proof['path']],
+            bytes.fromhex(proof['root']),
+        )
+
+
+class MerkleBatch:
+    """
+    Collects documents for one signed batch
+
+    batch_id - identifier of the batch, used in the published root path
+    sign     - callable returning a detached signature for a bytes payload
+
+    add() hashes a document and returns a Future; seal() builds the tree,
+    signs the root document once and resolves every Future with that
+    document's InclusionProof.
+    """
+
+    def __init__(self, batch_id, sign):
+        self.batch_id = batch_id
+        self.sign = sign
+        self._digests = []
+        self._futures = []
+        self._lock = threading.Lock()
+        self.sealed = False
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, data):
+        future = Future()
+        digest = _sha256(data)
+        with self._lock:
+            if self.sealed:
+                raise ValueError("Batch {batch_id} is already sealed".format(batch_id=self.batch_id))
+            self._digests.append(digest)
+            self._futures.append(future)
+        return future
+
+    def seal(self, **extra):
+        """
+        Sign the batch root and resolve all pending proofs
+
+        extra - additional fields recorded in the root document
+
+        returns (root_document, signature) as bytes
+        """
+        with self._lock:
+            self.sealed = True
+            digests, futures = list(self._digests), list(self._futures)
+        try:
+            tree = MerkleTree([leaf_hash(digest) for digest in digests])
+            root_document = dict(extra)
+            root_document.update({
+                'version': 1,
+                'algorithm': 'sha256',
+                'batch_id': self.batch_id,
+                'root': tree.root.hex(),
+                'count': len(digests),
+                'sealed': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+            })
+            root_document = json.dumps(root_document, indent=2, sort_keys=True).encode('utf-8')
+            signature = self.sign(root_document)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            raise
+        for index, (digest, future) in enumerate(zip(digests, futures)):
+            future.set_result(InclusionProof(self.batch_id, index, digest, tree.proof(index), tree.root))
+        return root_document, signature
+
+
+def main(args=sys.argv[1:]):
+    if len(args) != 3:
+        sys.exit("usage: python -m openedx_certificates.merkle CERTIFICATE.pdf proof.json root.json")
+    pdf_file, proof_file, root_file = args
+    with open(pdf_file, 'rb') as f:
+        data = f.read()
+    with open(proof_file) as f:
+        proof = InclusionProof.from_dict(json.load(f))
+    with open(root_file) as f:
+        root = json.load(f)
+    if root['root'] != proof.root.hex() or root['batch_id'] != proof.batch_id:
+        sys.exit("The proof does not belong to this batch root")
+    if not proof.verify(data):
+        sys.exit("{pdf} is NOT included in batch {batch_id}".format(pdf=pdf_file, batch_id=proof.batch_id))
+    print("{pdf} is included in batch {batch_id}; check the root's signature with gpg --verify".format(
+        pdf=pdf_file, batch_id=proof.batch_id))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Lightweight in-process metrics for the certificate agent.
+
+Counters, gauges and timings are kept in a process-wide registry and
+periodically written to the log, e.g.:
+
+    from openedx_certificates.metrics import METRICS
+
+    METRICS.incr('jobs.completed')
+    METRICS.gauge('signing.queue_depth', 3)
+    with METRICS.timer('signing.latency'):
+        sign(data)
+"""
+import collections
+import logging
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Number of recent samples kept per timing for percentile estimates
+TIMING_SAMPLES = 1024
+
+
+class Timing:
+    """Running summary of a duration, in seconds"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = collections.deque(maxlen=TIMING_SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'max': self.max,
+        }
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.timings = collections.defaultdict(Timing)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': {name: timing.summary() for name, timing in self.timings.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timings.clear()
+
+    def log_summary(self, logger=log):
+        snapshot = self.snapshot()
+        for name, value in sorted(snapshot['counters'].items()):
+            logger.info("metric {name}={value}".format(name=name, value=value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            logger.info("metric {name}={value}".format(name=name, value=value))
+        for name, summary in sorted(snapshot['timings'].items()):
+            logger.info(
+                "metric {name} count={count} mean={mean:.4f}s p50={p50:.4f}s "
+                "p95={p95:.4f}s max={max:.4f}s".format(name=name, **summary)
+            )
+
+
+def process_memory():
+    """
+    This process's memory use, in KiB
+
+    rss is everything resident; on Linux pss splits shared pages evenly
+    between the processes sharing them and uss only counts the pages no
+    other process shares, i.e. what the process really costs.  Workers
+    forked from a warmed up parent share its pages copy-on-write, which
+    shows as a uss well below their rss.
+    """
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Private_Clean': 'uss', 'Private_Dirty': 'uss'}
+    try:
+        usage = {}
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in fields:
+                    usage[fields[name]] = usage.get(fields[name], 0) + int(value.split()[0])
+        return usage
+    except (OSError, ValueError):
+        # Peak rather than current, but all there is elsewhere
+        return {'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+METRICS = Metrics()
@@ -0,0 +1,250 @@
+"""
+Outbox decoupling certificate rendering from uploading.
+
+Rendered bundles are put in the outbox and the caller carries on with the
+next certificate straight away; uploader threads drain the outbox in the
+background and resolve a Future per bundle once every one of its files is
+uploaded.  Rendering only waits when the outbox is full, so a slow S3
+holds it back by at most `capacity` certificates.
+
+With a directory, each bundle is spooled to disk before put() returns and
+removed once uploaded, together with an arbitrary json-able `meta` dict,
+e.g. the reply to send for the job.  The spooled copy of a bundle whose
+upload failed is kept until the caller discard()s it, typically once it
+has reported the failure.  Bundles left over by a previous process,
+because it crashed or nobody discarded them, are re-queued by recover().
+An `on_uploaded(bundle, meta)` hook runs for every bundle once it is
+uploaded, recovered ones included, before its Future is resolved.
+"""
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import uuid
+from concurrent.futures import Future
+from functools import partial
+
+from openedx_certificates.artifacts import ArtifactBundle
+from openedx_certificates.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+SPOOL_INDEX = 'bundle.json'
+
+
+def _fsync(path):
+    """Flush a file or directory to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _when_all_done(futures, callback):
+    """Call callback() once every future is done"""
+    if not futures:
+        callback()
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            last = not remaining[0]
+        if last:
+            callback()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+class Outbox:
+    """
+    Bounded queue of bundles waiting to be uploaded
+
+    uploader    - callable taking a bundle and returning a Future per upload
+    capacity    - number of bundles queued or uploading before put() blocks
+    directory   - spool bundles to this directory until they are uploaded;
+                  by default they are only held in memory
+    uploaders   - number of threads submitting bundles to the uploader
+    on_uploaded - (optional) called with each bundle and its meta once
+                  the bundle is uploaded
+    """
+
+    def __init__(self, uploader, capacity=256, directory=None, uploaders=2, on_uploaded=None, metrics=METRICS):
+        self.uploader = uploader
+        self.on_uploaded = on_uploaded
+        self.capacity = capacity
+        self.directory = directory
+        self.metrics = metrics
+        self._slots = threading.BoundedSemaphore(capacity)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._depth = 0
+        # Spooled copies of the bundles whose upload failed, by their Future
+        self._failed = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._threads = [
+            threading.Thread(target=self._drain, name='outbox-uploader-{i}'.format(i=i), daemon=True)
+            for i in range(uploaders)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        """Number of bundles queued or uploading"""
+        return self._depth
+
+    def _update_depth(self, delta):
+        with self._lock:
+            self._depth += delta
+            self.metrics.gauge('outbox.depth', self._depth)
+
+    def put(self, bundle, meta=None, result=None):
+        """
+        Queue a finished bundle for upload
+
+        Blocks while the outbox is full.  Returns a Future resolved with
+        the bundle once all of its files are uploaded, which is result if
+        the caller already handed one out.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.metrics.incr('outbox.backpressure')
+            with self.metrics.timer('outbox.blocked'):
+                self._slots.acquire()
+        try:
+            spool = self._spool(bundle, meta) if self.directory else None
+        except Exception:
+            self._slots.release()
+            raise
+        return self._enqueue(bundle, meta, spool, result)
+
+    def _enqueue(self, bundle, meta, spool, result=None):
+        if result is None:
+            result = Future()
+        self._update_depth(1)
+        self._queue.put((bundle, meta, spool, result))
+        return result
+
+    def recover(self):
+        """
+        Re-queue the bundles spooled by a previous process
+
+        returns a list of (meta, Future) pairs
+        """
+        if not self.directory:
+            return []
+        recovered = []
+        for entry in sorted(os.listdir(self.directory)):
+            spool = os.path.join(self.directory, entry)
+            if entry.endswith('.tmp'):
+                # Never completely written, so never acknowledged to anyone
+                shutil.rmtree(spool, ignore_errors=True)
+                continue
+            try:
+                bundle, meta = self._load(spool)
+            except (OSError, ValueError, KeyError) as e:
+                log.error("Unable to recover outbox entry {spool}: {error}".format(spool=spool, error=e))
+                continue
+            self._slots.acquire()
+            recovered.append((meta, self._enqueue(bundle, meta, spool)))
+        if recovered:
+            log.info("recovered {count} bundles from the outbox".format(count=len(recovered)))
+        return recovered
+
+    def discard(self, result):
+        """Remove the spooled copy of a bundle whose upload failed, given the Future put() returned"""
+        with self._lock:
+            spool = self._failed.pop(result, None)
+        if spool:
+            shutil.rmtree(spool, ignore_errors=True)
+
+    def _spool(self, bundle, meta):
+        """Write a bundle to the spool directory, atomically and durably"""
+        spool = os.path.join(self.directory, uuid.uuid4().hex)
+        tmp = spool + '.tmp'
+        os.makedirs(tmp)
+        artifacts = []
+        for i, artifact in enumerate(bundle):
+            filename = str(i)
+            with open(os.path.join(tmp, filename), 'wb') as f:
+                f.write(artifact.data)
+                f.flush()
+                os.fsync(f.fileno())
+            artifacts.append({'key': artifact.key, 'content_type': artifact.content_type, 'file': filename})
+        index = {
+            'bundle': [bundle.download_uuid, bundle.verify_uuid, bundle.download_url],
+            'pdf': bundle.pdf.key if bundle.pdf is not None else None,
+            'artifacts': artifacts,
+            'meta': meta,
+        }
+        with open(os.path.join(tmp, SPOOL_INDEX), 'w') as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync(tmp)
+        os.rename(tmp, spool)
+        _fsync(self.directory)
+        return spool
+
+    @staticmethod
+    def _load(spool):
+        with open(os.path.join(spool, SPOOL_INDEX)) as f:
+            index = json.load(f)
+        bundle = ArtifactBundle(*index['bundle'])
+        for artifact in index['artifacts']:
+            with open(os.path.join(spool, artifact['file']), 'rb') as f:
+                bundle.add(artifact['key'], f.read(), artifact['content_type'])
+        if index.get('pdf'):
+            bundle.pdf = bundle.get(index['pdf'])
+        return bundle, index['meta']
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            bundle, meta, spool, result = item
+            try:
+                futures = self.uploader(bundle)
+            except Exception as e:
+                futures = [Future()]
+                futures[0].set_exception(e)
+            _when_all_done(futures, partial(self._finish, bundle, meta, spool, result, futures))
+
+    def _finish(self, bundle, meta, spool, result, futures):
+        self._update_depth(-1)
+        self._slots.release()
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            # Keep the spooled copy until discard(), or for recover()
+            if spool:
+                with self._lock:
+                    self._failed[result] = spool
+            self.metrics.incr('outbox.failed')
+            result.set_exception(errors[0])
+            return
+        if self.on_uploaded is not None:
+            try:
+                self.on_uploaded(bundle, meta)
+            except Exception:
+                # It is uploaded all the same
+                log.exception("on_uploaded failed for bundle {uuid}".format(uuid=bundle.download_uuid))
+                self.metrics.incr('outbox.hook_errors')
+        if spool:
+            shutil.rmtree(spool, ignore_errors=True)
+        self.metrics.incr('outbox.uploaded')
+        result.set_result(bundle)
+
+    def close(self, wait=True):
+        """Stop the uploader threads once the queued bundles are submitted"""
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,105 @@
+"""
+Results of recent xqueue submissions, for answering duplicates.
+
+The LMS resubmits a request when it does not hear back in time, and every
+resubmission used to produce another certificate.  ResultCache remembers
+the result of each submission in a sqlite file, keyed by a hash of its
+canonical json body, for `ttl` seconds; a duplicate arriving within that
+window gets the original result back instead of a new certificate.
+Results naming a certificate are invalidate()d when it is deleted, so a
+later submission does not get the uuids of a certificate that is gone.
+
+Hits, misses, stores and invalidations are counted in metrics under the 'results.' prefix.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from openedx_certificates.manifest import is_uuid
+from openedx_certificates.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def submission_key(body):
+    """Hash of a submission body that does not depend on how its json was written"""
+    canonical = json.dumps(body, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Results of submissions, by submission_key(), expiring after ttl seconds
+
+    Safe to share between threads and between processes using the same file.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, metrics=METRICS):
+        self.path = path
+        self.ttl = ttl
+        self.metrics = metrics
+        self._local = threading.local()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.purge()
+
+    @property
+    def _db(self):
+        """sqlite connection, one per thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL, stored REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """Return the result stored for key within the last ttl seconds, or None"""
+        row = self._db.execute(
+            "SELECT result FROM results WHERE key = ? AND stored >= ?", (key, time.time() - self.ttl)).fetchone()
+        if row is None:
+            self.metrics.incr('results.misses')
+            return None
+        self.metrics.incr('results.hits')
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        """Store the json-able result of the submission with key"""
+        with self._db as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, result, stored) VALUES (?, ?, ?)",
+                (key, json.dumps(result), time.time()))
+        self.metrics.incr('results.stored')
+
+    def invalidate(self, download_uuid, verify_uuid=None):
+        """
+        Drop the results naming a certificate, once it is deleted
+
+        Results are (download_uuid, verify_uuid, download_url); placeholder
+        verify uuids such as 'No Verification' are not matched on.
+        """
+        with self._db as conn:
+            dropped = conn.execute(
+                "DELETE FROM results WHERE json_extract(result, '$[0]') = ?", (download_uuid,)).rowcount
+            if is_uuid(verify_uuid):
+                dropped += conn.execute(
+                    "DELETE FROM results WHERE json_extract(result, '$[1]') = ?", (verify_uuid,)).rowcount
+        if dropped:
+            self.metrics.incr('results.invalidated', dropped)
+        return dropped
+
+    def purge(self):
+        """Drop expired results"""
+        with self._db as conn:
+            purged = conn.execute("DELETE FROM results WHERE stored < ?", (time.time() - self.ttl,)).rowcount
+        if purged:
+            log.info("purged {count} expired results".format(count=purged))
+        return purged
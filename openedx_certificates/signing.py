@@ -0,0 +1,288 @@
+"""
+Detached signatures for generated certificates.
+
+Building a gnupg.GPG wrapper is not free: it probes the gpg binary and
+checks the home directory on every instantiation, and the first signature
+made with a key also has to start gpg-agent and load the keyring.  Doing
+that once per certificate is a large fixed share of the time it takes to
+produce one, so workers keep a single long-lived signer around instead.
+
+Two backends are available, selected with settings.CERT_SIGNER:
+
+  gpg  - signs through the gpg binary using the keyring in CERT_GPG_DIR
+  pgpy - signs in-process with PGPy, loading an exported secret key once
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from openedx_certificates.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+
+class GPGSigner:
+    """
+    Long-lived wrapper around a gnupg.GPG instance
+
+    homedir - gpg home directory holding the signing keyring
+    key_id  - id of the key used to sign certificates
+
+    The gnupg wrapper is created lazily and kept for the life of the
+    signer; call warmup() up front to start gpg-agent and load the keyring
+    before the first certificate is signed.
+    """
+
+    def __init__(self, homedir, key_id):
+        self.homedir = homedir
+        self.key_id = key_id
+        self._gpg = None
+        self._lock = threading.Lock()
+
+    @property
+    def gpg(self):
+        if self._gpg is None:
+            with self._lock:
+                if self._gpg is None:
+                    # Imported here so that importing gen_cert does not pay for it
+                    import gnupg
+                    gpg = gnupg.GPG(homedir=self.homedir)
+                    gpg.encoding = 'utf-8'
+                    self._gpg = gpg
+        return self._gpg
+
+    def warmup(self):
+        """Make a throwaway signature so gpg-agent and the keyring are loaded"""
+        start = time.time()
+        self.sign(b'warmup')
+        log.info("gpg signer for key {key} warmed up in {elapsed:.3f}s".format(
+            key=self.key_id, elapsed=time.time() - start))
+
+    def sign(self, data):
+        """
+        Return an ASCII-armored detached signature for data
+
+        data - bytes or a binary file-like object
+        """
+        signed_data = self.gpg.sign(data=data, default_key=self.key_id, clearsign=False, detach=True).data
+        if not signed_data:
+            log.critical("gpg returned an empty signature using key {key}".format(key=self.key_id))
+        return signed_data
+
+    def sign_many(self, payloads):
+        """
+        Sign several payloads in one call, returning signatures in order
+
+        gpg refuses to combine --detach-sign with --multifile, so each
+        payload still gets its own gpg process, but they all share this
+        signer's wrapper, agent and unlocked key.
+        """
+        return [self.sign(data) for data in payloads]
+
+
+class PGPySigner:
+    """
+    In-process signer producing the same ASCII-armored detached signatures
+
+    key_file   - secret key exported with `gpg --armor --export-secret-keys`
+    key_id     - (optional) id of the signing key; when given it must match
+                 the primary key or one of its subkeys
+    passphrase - (optional) passphrase if the exported key is protected
+
+    The key is parsed once, on first use or in warmup(), and kept in memory
+    for the life of the signer.  A protected key is unlocked around each
+    signature, one at a time, as PGPy locks it again afterwards.
+    """
+
+    def __init__(self, key_file, key_id=None, passphrase=None):
+        # PGPy pulls in cryptography, so it is only imported by those signing with it
+        try:
+            import pgpy
+        except ImportError:
+            raise ImportError("The pgpy signing backend requires the PGPy package")
+        self.pgpy = pgpy
+        self.key_file = key_file
+        self.key_id = key_id
+        self.passphrase = passphrase
+        self._key = None
+        self._lock = threading.Lock()
+        self._unlock_lock = threading.Lock()
+
+    @property
+    def key(self):
+        if self._key is None:
+            with self._lock:
+                if self._key is None:
+                    self._key = self._load_key()
+        return self._key
+
+    def _load_key(self):
+        key, _ = self.pgpy.PGPKey.from_file(self.key_file)
+        if key.is_public:
+            raise ValueError("{key_file} does not contain a secret key".format(key_file=self.key_file))
+
+        if self.key_id:
+            wanted = self.key_id.upper()
+            candidates = [key] + list(key.subkeys.values())
+            matches = [k for k in candidates if str(k.fingerprint).replace(' ', '').endswith(wanted)]
+            if not matches:
+                raise ValueError("{key_file} does not contain key {key_id}".format(
+                    key_file=self.key_file, key_id=self.key_id))
+            key = matches[0]
+
+        if key.is_protected:
+            # Fail now rather than on the first certificate if the passphrase is wrong
+            with key.unlock(self.passphrase):
+                pass
+
+        log.info("loaded signing key {fingerprint} from {key_file}".format(
+            fingerprint=key.fingerprint, key_file=self.key_file))
+        return key
+
+    def warmup(self):
+        """Load the key and make a throwaway signature"""
+        start = time.time()
+        self.sign(b'warmup')
+        log.info("pgpy signer for {key_file} warmed up in {elapsed:.3f}s".format(
+            key_file=self.key_file, elapsed=time.time() - start))
+
+    def sign(self, data):
+        """
+        Return an ASCII-armored detached signature for data
+
+        data - bytes or a binary file-like object
+        """
+        if hasattr(data, 'read'):
+            data = data.read()
+        key = self.key
+        if not key.is_protected:
+            return str(key.sign(data)).encode('ascii')
+        with self._unlock_lock, key.unlock(self.passphrase):
+            return str(key.sign(data)).encode('ascii')
+
+    def sign_many(self, payloads):
+        """Sign several payloads, returning signatures in order"""
+        return [self.sign(data) for data in payloads]
+
+
+SIGNER_BACKENDS = {
+    'gpg': GPGSigner,
+    'pgpy': PGPySigner,
+}
+
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def get_signer(backend='gpg', **options):
+    """
+    Return the signer for this worker process, creating it on first use
+
+    backend - one of SIGNER_BACKENDS
+    options - passed on to the backend's constructor
+
+    Signers are cached per process so that workers forked from a parent
+    build their own signer rather than sharing the parent's.
+    """
+    cache_key = (os.getpid(), backend, tuple(sorted(options.items())))
+    signer = _signers.get(cache_key)
+    if signer is None:
+        with _signers_lock:
+            signer = _signers.get(cache_key)
+            if signer is None:
+                signer = SIGNER_BACKENDS[backend](**options)
+                _signers[cache_key] = signer
+    return signer
+
+
+def _sign_in_worker(backend, options, data):
+    """Sign data with this worker's signer, returning (signature, seconds)"""
+    start = time.perf_counter()
+    signature = get_signer(backend, **dict(options)).sign(data)
+    return signature, time.perf_counter() - start
+
+
+class SigningPool:
+    """
+    Signing stage running on its own pool of worker threads or processes
+
+    backend    - signer backend, as for get_signer()
+    options    - signer options, as for get_signer()
+    workers    - number of signatures made concurrently
+    queue_size - number of pdfs allowed to wait for a free worker; once the
+                 queue is full submit() blocks, so rendering cannot run
+                 arbitrarily far ahead of signing
+    processes  - run workers in separate processes rather than threads
+
+    Queue depth, signature latency (time spent signing) and wait time
+    (from submission to signature) are recorded in metrics under the
+    'signing.' prefix.
+    """
+
+    def __init__(self, backend='gpg', options=None, workers=2, queue_size=16, processes=False, metrics=METRICS):
+        self.backend = backend
+        self.options = tuple(sorted((options or {}).items()))
+        self.workers = workers
+        self.queue_size = queue_size
+        self.metrics = metrics
+        executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._executor = executor_class(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    @property
+    def queue_depth(self):
+        """Number of submitted pdfs not yet picked up by a worker"""
+        return max(0, self._in_flight - self.workers)
+
+    def _update_in_flight(self, delta):
+        with self._lock:
+            self._in_flight += delta
+            self.metrics.gauge('signing.queue_depth', self.queue_depth)
+
+    def submit(self, data):
+        """
+        Queue data for signing and return a Future for its signature
+
+        Blocks while the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.metrics.incr('signing.backpressure')
+            with self.metrics.timer('signing.blocked'):
+                self._slots.acquire()
+
+        self._update_in_flight(1)
+        result = Future()
+        try:
+            future = self._executor.submit(_sign_in_worker, self.backend, self.options, data)
+        except Exception:
+            self._update_in_flight(-1)
+            self._slots.release()
+            raise
+        future.add_done_callback(partial(self._signed, result, time.perf_counter()))
+        return result
+
+    def _signed(self, result, submitted, future):
+        self._update_in_flight(-1)
+        self._slots.release()
+        self.metrics.timing('signing.wait', time.perf_counter() - submitted)
+        try:
+            signature, seconds = future.result()
+        except Exception as e:
+            self.metrics.incr('signing.errors')
+            result.set_exception(e)
+        else:
+            self.metrics.incr('signing.signatures')
+            self.metrics.timing('signing.latency', seconds)
+            result.set_result(signature)
+
+    def sign(self, data):
+        """Sign data through the pool and wait for the signature"""
+        return self.submit(data).result()
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,532 @@
+"""
+Storage backends certificates are published to.
+
+Every backend has the same small interface,
+
+    storage = get_storage('s3', aws_id=..., aws_key=..., bucket_name=...)
+    storage.upload('downloads/<uuid>/Certificate.pdf', data, 'application/pdf')
+    storage.upload('cert/<uuid>/valid.html', gzipped, 'text/html', content_encoding='gzip')
+
+and is selected by name:
+
+    s3     - S3Client, a bucket on S3 or any S3 compatible service
+    local  - LocalStorage, files below a directory such as the web root,
+             written atomically
+    memory - MemoryStorage, a dict, with optional latency and error
+             injection for benchmarks and soak tests
+
+Connecting to S3 and validating the bucket for every certificate costs a
+TLS handshake and a bucket HEAD per certificate.  S3Client keeps one boto
+connection per thread, whose connection pool keeps HTTP connections alive
+between requests, and a bucket handle that is only validated once.  If a
+request fails at the connection level, the connection is dropped and the
+request is retried once on a fresh one.  host, port and is_secure can
+point it at any S3 compatible service, e.g. a local stand-in for tests.
+boto is only imported once an S3Client is used, so that importing this
+module, and gen_cert, does not pay for it.
+
+UploadPool sends objects to a backend concurrently on a bounded pool of
+threads, retrying failed objects with exponential backoff.
+
+Every backend can also list() the keys below a prefix and delete() up to
+DELETE_BATCH_SIZE keys at once, which S3 does in a single multi-object
+delete request.  DeleteBatch gathers the keys of many certificates into
+as few of those requests as possible.
+"""
+import collections
+import http.client
+import io
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from openedx_certificates.artifacts import DECOMPRESSORS
+from openedx_certificates.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+# Errors after which the connection is discarded and the request retried
+CONNECTION_ERRORS = (socket.error, http.client.HTTPException)
+# Most keys S3 accepts in one multi-object delete request
+DELETE_BATCH_SIZE = 1000
+# Times a delete request is tried before its keys are given up on
+DELETE_ATTEMPTS = 3
+# Keys given up on that DeleteBatch.failed remembers
+DELETE_FAILED_KEPT = 10000
+
+
+class S3Client:
+    """
+    Thread-safe S3 client for one bucket
+
+    aws_id, aws_key - credentials
+    bucket_name     - bucket every key is written to
+    host, port      - S3 endpoint, defaults to AWS
+    is_secure       - use https
+    """
+
+    def __init__(self, aws_id, aws_key, bucket_name, host=None, port=None, is_secure=True):
+        self.aws_id = aws_id
+        self.aws_key = aws_key
+        self.bucket_name = bucket_name
+        self.connect_options = {'is_secure': is_secure}
+        if host:
+            # S3 compatible services generally only support path style urls
+            from boto.s3.connection import OrdinaryCallingFormat
+            self.connect_options.update(host=host, calling_format=OrdinaryCallingFormat())
+        if port:
+            self.connect_options['port'] = port
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._validated = False
+        self.connections = 0
+
+    def _connect(self):
+        import boto
+        conn = boto.connect_s3(self.aws_id, self.aws_key, **self.connect_options)
+        with self._lock:
+            # Only the first connection checks that the bucket exists
+            validate, self._validated = not self._validated, True
+            self.connections += 1
+        try:
+            bucket = conn.get_bucket(self.bucket_name, validate=validate)
+        except Exception:
+            with self._lock:
+                self._validated = False
+            raise
+        self._local.conn, self._local.bucket = conn, bucket
+        return bucket
+
+    @property
+    def bucket(self):
+        """This thread's bucket handle, connecting if needed"""
+        bucket = getattr(self._local, 'bucket', None)
+        return bucket if bucket is not None else self._connect()
+
+    def reset(self):
+        """Drop this thread's connection, the next request reconnects"""
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = self._local.bucket = None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _call(self, method, *args, **kwargs):
+        """Run method(bucket, ...), reconnecting once if the connection fails"""
+        try:
+            return method(self.bucket, *args, **kwargs)
+        except CONNECTION_ERRORS as e:
+            log.warning("S3 connection failed, reconnecting: {error}".format(error=e))
+            self.reset()
+            return method(self.bucket, *args, **kwargs)
+
+    @staticmethod
+    def _upload(bucket, key_name, data, content_type, content_encoding, policy):
+        headers = {'Content-Type': content_type}
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+        from boto.s3.key import Key
+        key = Key(bucket, name=key_name)
+        key.set_contents_from_file(io.BytesIO(data), headers=headers, policy=policy)
+        return key
+
+    def upload(self, key_name, data, content_type, content_encoding=None, policy='public-read'):
+        """Write data to key_name, served with the given Content-Type and Content-Encoding"""
+        return self._call(self._upload, key_name, data, content_type, content_encoding, policy)
+
+    def list(self, prefix):
+        """Return the names of the keys below prefix"""
+        return self._call(lambda bucket: [key.name for key in bucket.list(prefix=prefix)])
+
+    def delete(self, key_names):
+        """
+        Delete up to DELETE_BATCH_SIZE keys in one request
+
+        Returns the names of the keys that could not be deleted; keys that
+        do not exist count as deleted.
+        """
+        result = self._call(lambda bucket: bucket.delete_keys(key_names, quiet=True))
+        for error in result.errors:
+            log.error("deleting {key} failed: {code} {message}".format(
+                key=error.key, code=error.code, message=error.message))
+        return [error.key for error in result.errors]
+
+
+# Extensions of precompressed files, as used by nginx's gzip_static and brotli_static
+ENCODING_EXTENSIONS = {
+    'gzip': '.gz',
+    'br': '.br',
+}
+
+
+class LocalStorage:
+    """
+    Publishes objects as files below root, mirroring the bucket layout
+
+    Files are written to a temporary name and renamed into place, so a web
+    server never serves a partially written file.  link() places a copy of
+    a file that was already published elsewhere without writing its data
+    again, by hardlinking or reflinking it when possible.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key_name):
+        return os.path.join(self.root, *key_name.split('/'))
+
+    def _tmp_path(self, key_name):
+        """Return (destination, temporary path next to it) for a key"""
+        dest = self.path(key_name)
+        dirname = os.path.dirname(dest)
+        os.makedirs(dirname, exist_ok=True)
+        return dest, os.path.join(dirname, '.{name}.{pid}.{thread}.tmp'.format(
+            name=os.path.basename(dest), pid=os.getpid(), thread=threading.get_ident()))
+
+    def _commit(self, tmp, dest):
+        try:
+            os.replace(tmp, dest)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return dest
+
+    def upload(self, key_name, data, content_type=None, content_encoding=None):
+        """
+        Write data to the file for key_name
+
+        Compressed data is written next to it with the extension web servers
+        look for precompressed files under, e.g. valid.html.gz for gzip, and
+        decompressed to the file itself for clients that do not accept the
+        encoding, as nginx's gzip_static and brotli_static expect both.
+        """
+        if content_encoding:
+            self._write(key_name, DECOMPRESSORS[content_encoding](data))
+            return self._write(key_name + ENCODING_EXTENSIONS[content_encoding], data)
+        return self._write(key_name, data)
+
+    def _write(self, key_name, data):
+        dest, tmp = self._tmp_path(key_name)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        return self._commit(tmp, dest)
+
+    def link(self, key_name, source, data):
+        """
+        Publish the file at source under key_name
+
+        Hardlinks it if both are on the same filesystem, reflinks it if the
+        filesystem supports that, and otherwise writes data.  Precompressed
+        copies next to source are published along with it.
+
+        Returns (path, how) where how is 'hardlink', 'reflink' or 'write'.
+        """
+        for extension in ENCODING_EXTENSIONS.values():
+            if os.path.exists(source + extension):
+                self._link(key_name + extension, source + extension)
+        return self._link(key_name, source, data)
+
+    def _link(self, key_name, source, data=None):
+        dest, tmp = self._tmp_path(key_name)
+        try:
+            os.link(source, tmp)
+            return self._commit(tmp, dest), 'hardlink'
+        except OSError:
+            pass
+        if _reflink(source, tmp):
+            return self._commit(tmp, dest), 'reflink'
+        if data is None:
+            with open(source, 'rb') as f:
+                data = f.read()
+        return self._write(key_name, data), 'write'
+
+    def list(self, prefix):
+        top = self.path(prefix.rstrip('/'))
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            rel = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            keys.extend(
+                filename if rel == '.' else rel + '/' + filename
+                for filename in filenames if not filename.startswith('.')
+            )
+        return sorted(keys)
+
+    def delete(self, key_names):
+        """Delete the files for key_names, with their precompressed copies and any emptied directories"""
+        for key_name in key_names:
+            dest = self.path(key_name)
+            for path in [dest] + [dest + extension for extension in ENCODING_EXTENSIONS.values()]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            self._remove_empty_dirs(os.path.dirname(dest))
+        return []
+
+    def _remove_empty_dirs(self, dirname):
+        root = os.path.abspath(self.root)
+        while os.path.abspath(dirname) != root:
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                # Not empty, or already gone
+                return
+            dirname = os.path.dirname(dirname)
+
+
+# ioctl to share a file's extents with another file, on btrfs, xfs and others
+FICLONE = 0x40049409
+
+
+def _reflink(source, dest):
+    """Make dest a copy-on-write clone of source, returning False if that is not supported"""
+    try:
+        import fcntl
+        with open(source, 'rb') as src, open(dest, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (ImportError, OSError):
+        if os.path.exists(dest):
+            os.unlink(dest)
+        return False
+
+
+class MemoryStorage:
+    """
+    Keeps objects in a dict, for benchmarks and tests
+
+    latency    - seconds each request takes
+    jitter     - up to this many more seconds, at random
+    error_rate - fraction of requests failing with a connection error
+    seed       - seed for the latency and error randomness
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.objects = {}
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self.jitter * self._random.random()
+            fail = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise socket.error('injected storage error')
+
+    def upload(self, key_name, data, content_type=None, content_encoding=None):
+        self._request()
+        with self._lock:
+            self.objects[key_name] = (bytes(data), content_type, content_encoding)
+        return key_name
+
+    def list(self, prefix):
+        self._request()
+        with self._lock:
+            return sorted(key for key in self.objects if key.startswith(prefix))
+
+    def delete(self, key_names):
+        self._request()
+        with self._lock:
+            for key_name in key_names:
+                self.objects.pop(key_name, None)
+        return []
+
+
+STORAGE_BACKENDS = {
+    's3': S3Client,
+    'local': LocalStorage,
+    'memory': MemoryStorage,
+}
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(backend='s3', **options):
+    """
+    Return the storage for a backend and options, shared by every thread of the process
+
+    Storages are not shared with forked children, which get their own.
+    """
+    key = (os.getpid(), backend, tuple(sorted(options.items())))
+    with _storages_lock:
+        if key not in _storages:
+            _storages[key] = STORAGE_BACKENDS[backend](**options)
+        return _storages[key]
+
+
+def get_s3_client(aws_id, aws_key, bucket_name, **options):
+    """Return the S3 client for a bucket, see get_storage()"""
+    return get_storage('s3', aws_id=aws_id, aws_key=aws_key, bucket_name=bucket_name, **options)
+
+
+class UploadPool:
+    """
+    Uploads objects concurrently on a bounded pool of threads
+
+    client     - storage backend to upload to
+    workers    - number of concurrent uploads
+    queue_size - number of objects allowed to wait for a free worker; once
+                 the queue is full submit() blocks
+    retries    - number of times a failed object is retried
+    backoff    - seconds before the first retry, doubled for each retry
+
+    Per-object latency, bytes, retries and errors are recorded in metrics
+    under the 'upload.' prefix.
+    """
+
+    def __init__(self, client, workers=8, queue_size=64, retries=3, backoff=0.5, metrics=METRICS):
+        self.client = client
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, key_name, data, content_type, content_encoding=None):
+        """
+        Queue an object for upload and return a Future for it
+
+        Blocks while the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            self.metrics.incr('upload.backpressure')
+            with self.metrics.timer('upload.blocked'):
+                self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload, key_name, data, content_type, content_encoding)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def submit_bundle(self, bundle):
+        """Queue every artifact of an ArtifactBundle, returning their Futures"""
+        return [
+            self.submit(artifact.key, artifact.stored_data, artifact.content_type, artifact.content_encoding)
+            for artifact in bundle
+        ]
+
+    def _upload(self, key_name, data, content_type, content_encoding):
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                self.client.upload(key_name, data, content_type, content_encoding)
+            except Exception as e:
+                if attempt == self.retries:
+                    self.metrics.incr('upload.errors')
+                    log.error("upload of {key} failed after {attempts} attempts: {error}".format(
+                        key=key_name, attempts=attempt + 1, error=e))
+                    raise
+                self.metrics.incr('upload.retries')
+                log.warning("upload of {key} failed, retrying: {error}".format(key=key_name, error=e))
+                time.sleep(self.backoff * 2 ** attempt)
+            else:
+                seconds = time.perf_counter() - start
+                self.metrics.timing('upload.latency', seconds)
+                self.metrics.incr('upload.objects')
+                self.metrics.incr('upload.bytes', len(data))
+                log.info("uploaded {size} bytes to {key} in {seconds:.3f}s".format(
+                    size=len(data), key=key_name, seconds=seconds))
+                return key_name
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class DeleteBatch:
+    """
+    Gathers keys to delete into multi-object delete requests
+
+    client     - storage backend to delete from
+    batch_size - keys per request, at most DELETE_BATCH_SIZE
+    attempts   - times a request that raises is tried, on successive
+                 add()s and flush()es, before its keys are given up on
+
+    Keys are deleted once batch_size of them have been added, and the rest
+    by flush().  Requests and deleted objects are counted in metrics under
+    the 'delete.' prefix.
+    """
+
+    def __init__(self, client, batch_size=DELETE_BATCH_SIZE, attempts=DELETE_ATTEMPTS, metrics=METRICS):
+        self.client = client
+        self.batch_size = min(batch_size, DELETE_BATCH_SIZE)
+        self.attempts = attempts
+        self.metrics = metrics
+        self._keys = []
+        self._failed_attempts = 0
+        self._lock = threading.Lock()
+        # The latest keys the backend failed to delete or that were given up on
+        self.failed = collections.deque(maxlen=DELETE_FAILED_KEPT)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key_names):
+        """Queue keys for deletion, deleting full batches straight away"""
+        with self._lock:
+            self._keys.extend(key_names)
+            while len(self._keys) >= self.batch_size:
+                self._delete_queued(self.batch_size)
+
+    def add_prefix(self, prefix):
+        """Queue every key below prefix for deletion"""
+        if not prefix.rstrip('/'):
+            raise ValueError("refusing to delete everything in the bucket")
+        self.add(self.client.list(prefix))
+
+    def flush(self):
+        """Delete the keys still queued"""
+        with self._lock:
+            if self._keys:
+                self._delete_queued(len(self._keys))
+
+    def _delete_queued(self, count):
+        """Delete the first count keys queued, holding the lock"""
+        key_names = self._keys[:count]
+        try:
+            self._delete(key_names)
+        except Exception:
+            self._failed_attempts += 1
+            if self._failed_attempts < self.attempts:
+                raise
+            log.error("giving up on deleting {count} objects after {attempts} attempts".format(
+                count=len(key_names), attempts=self._failed_attempts))
+            self.metrics.incr('delete.dropped', len(key_names))
+            self.failed.extend(key_names)
+            del self._keys[:count]
+            self._failed_attempts = 0
+            raise
+        del self._keys[:count]
+        self._failed_attempts = 0
+
+    def _delete(self, key_names):
+        with self.metrics.timer('delete.latency'):
+            failed = self.client.delete(key_names)
+        self.metrics.incr('delete.requests')
+        self.metrics.incr('delete.objects', len(key_names) - len(failed))
+        if failed:
+            self.metrics.incr('delete.errors', len(failed))
+            self.failed.extend(failed)
+        log.info("deleted {count} objects".format(count=len(key_names) - len(failed)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
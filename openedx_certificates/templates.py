@@ -0,0 +1,176 @@
+"""
+Compiled, cached str.format templates for the verification pages.
+
+The verification pages are rendered for every certificate from the same
+handful of html templates.  Rather than reading each template from disk and
+running str.format over the whole document every time, a template is parsed
+once into a list of segments, literal text and field names, and cached until
+the file's mtime changes.  Fields that are the same for every certificate of
+a course can be filled in ahead of time with prefill(), leaving only the
+per-certificate fields to be substituted at render time:
+
+    template = TEMPLATES.get(os.path.join(TEMPLATE_DIR, 'valid.html'))
+    course_page = template.prefill(COURSE='CS50', ORG='HarvardX')
+    html = course_page.render(NAME='John Smith', ...)
+
+Templates use the same syntax, and the same '{{' / '}}' escapes, as
+str.format; fields with a conversion or format spec are supported but are
+formatted with format() at render time.
+
+Certificate pdf templates are cached too, by PDF_TEMPLATES: one parsed
+PdfFileReader per template file, shared by every generator using it.
+"""
+import collections
+import io
+import mmap
+import os
+import string
+import threading
+
+from PyPDF2 import PdfFileReader
+
+_formatter = string.Formatter()
+
+
+class CompiledTemplate:
+    """
+    A str.format template split into segments
+
+    segments - list of literal strings and (field_name, conversion,
+               format_spec) tuples
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.fields = frozenset(segment[0] for segment in segments if not isinstance(segment, str))
+
+    @classmethod
+    def compile(cls, text):
+        segments = []
+        for literal, field_name, format_spec, conversion in _formatter.parse(text):
+            if literal:
+                segments.append(literal)
+            if field_name is not None:
+                segments.append((field_name, conversion, format_spec))
+        return cls(cls._merge(segments))
+
+    @staticmethod
+    def _merge(segments):
+        """Join runs of adjacent literal segments"""
+        merged = []
+        for segment in segments:
+            if isinstance(segment, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += segment
+            else:
+                merged.append(segment)
+        return merged
+
+    @staticmethod
+    def _format(value, conversion, format_spec):
+        if conversion:
+            value = _formatter.convert_field(value, conversion)
+        if format_spec:
+            return format(value, format_spec)
+        return value if isinstance(value, str) else str(value)
+
+    def prefill(self, **fields):
+        """Return a new template with the given fields substituted in"""
+        segments = []
+        for segment in self.segments:
+            if not isinstance(segment, str) and segment[0] in fields:
+                segment = self._format(fields[segment[0]], segment[1], segment[2])
+            segments.append(segment)
+        return CompiledTemplate(self._merge(segments))
+
+    def render(self, **fields):
+        """
+        Substitute the remaining fields, as str.format would
+
+        Raises KeyError for a field that has not been given, like str.format.
+        """
+        return ''.join(
+            segment if isinstance(segment, str) else self._format(fields[segment[0]], segment[1], segment[2])
+            for segment in self.segments
+        )
+
+
+class TemplateCache:
+    """Compiled templates keyed by path, reloaded when a file's mtime changes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates = {}
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._templates.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, encoding='utf-8') as f:
+            template = CompiledTemplate.compile(f.read())
+        with self._lock:
+            self._templates[path] = (mtime, template)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+TEMPLATES = TemplateCache()
+
+
+class PdfTemplateCache:
+    """
+    Parsed pdf templates keyed by path, reloaded when a file's mtime changes
+
+    Each template is memory-mapped rather than read, and its file closed
+    as soon as it is mapped; the mapping goes away with the last reader
+    using it.  The max_entries most recently used templates are kept.
+
+    A reader, and the page objects it has parsed, is shared by every
+    generator for the same template, so it must not be used from several
+    threads at once.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._readers = collections.OrderedDict()
+
+    def get(self, path):
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._readers.get(path)
+            if cached is not None and cached[0] == version:
+                self._readers.move_to_end(path)
+                return cached[1]
+        reader = PdfFileReader(self._map(path))
+        # Parse the page tree now, rather than in whichever generator is first
+        reader.getNumPages()
+        with self._lock:
+            self._readers[path] = (version, reader)
+            self._readers.move_to_end(path)
+            while len(self._readers) > self.max_entries:
+                self._readers.popitem(last=False)
+        return reader
+
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as f:
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files, and filesystems that cannot be mapped
+                return io.BytesIO(f.read())
+
+    def __len__(self):
+        return len(self._readers)
+
+    def clear(self):
+        with self._lock:
+            self._readers.clear()
+
+
+PDF_TEMPLATES = PdfTemplateCache()
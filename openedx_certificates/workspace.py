@@ -0,0 +1,211 @@
+"""
+Pool of scratch directories for certificate generators.
+
+Generators used to get a fresh tempfile.mkdtemp() each, which was never
+removed.  Instead they now borrow a workspace from a per-process pool below
+a root directory, which may be on a tmpfs such as /dev/shm.  A released
+workspace is emptied and kept for the next generator, up to `size` of
+them; beyond that it is removed.
+
+Workspaces are named ws-<pid>-<n>, so directories left behind by a process
+that is no longer running can be purged when the next pool starts; nothing
+else below root is touched.  Old directories left by the previous
+mkdtemp(prefix=legacy_prefix) scheme are purged too, matched by that prefix.
+
+The bytes written to workspaces are accounted against an optional budget;
+callers check has_room() before writing optional files such as inspection
+copies.  Usage is reported in metrics under the 'workspace.' prefix.
+"""
+import itertools
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+from openedx_certificates.metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+WORKSPACE_NAME = re.compile(r'^ws-(?P<pid>\d+)-\d+$')
+# What tempfile.mkdtemp() appends to its prefix
+MKDTEMP_SUFFIX = r'[a-z0-9_]{8}'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Workspace:
+    """A scratch directory borrowed from a WorkspacePool"""
+
+    def __init__(self, pool, path):
+        self.pool = pool
+        self.path = path
+        self.used = 0
+
+    def has_room(self, size):
+        """True if writing size more bytes stays within the pool's budget"""
+        return self.pool.has_room(size)
+
+    def add_usage(self, size):
+        self.pool._account(self, size)
+
+    def release(self):
+        self.pool.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class WorkspacePool:
+    """
+    Reusable scratch directories below root
+
+    root        - directory holding the workspaces, created if needed
+    size        - number of empty workspaces kept for reuse
+    budget      - bytes that may be accounted to workspaces at once,
+                  None for no limit
+    legacy_prefix - prefix generators passed to tempfile.mkdtemp() before
+                  workspaces, whose directories are purged once stale
+    stale_after - seconds after which a pre-workspace mkdtemp() directory
+                  is considered abandoned
+    """
+
+    def __init__(self, root, size=4, budget=None, legacy_prefix=None, stale_after=24 * 60 * 60, metrics=METRICS):
+        self.root = root
+        self.size = size
+        self.budget = budget
+        self.legacy_prefix = legacy_prefix
+        self.stale_after = stale_after
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._free = []
+        self._in_use = set()
+        self._used = 0
+        self._names = itertools.count()
+        os.makedirs(root, exist_ok=True)
+        self.purge_stale()
+
+    @property
+    def used(self):
+        """Bytes accounted to workspaces in use"""
+        return self._used
+
+    def purge_stale(self):
+        """Remove workspaces of dead processes and abandoned mkdtemp() directories"""
+        purged = 0
+        for entry in os.listdir(self.root):
+            match = WORKSPACE_NAME.match(entry)
+            if match and int(match.group('pid')) != os.getpid() and not _pid_alive(int(match.group('pid'))):
+                purged += self._purge(os.path.join(self.root, entry))
+        if self.legacy_prefix:
+            # mkdtemp(prefix='/var/tmp/generated_certs') made /var/tmp/generated_certsXXXXXXXX
+            parent, name = os.path.split(self.legacy_prefix)
+            legacy_name = re.compile('^' + re.escape(name) + MKDTEMP_SUFFIX + '$')
+            now = time.time()
+            try:
+                entries = os.listdir(parent or '.')
+            except FileNotFoundError:
+                entries = []
+            for entry in entries:
+                path = os.path.join(parent, entry)
+                try:
+                    stale = legacy_name.match(entry) and now - os.path.getmtime(path) > self.stale_after
+                except OSError:
+                    continue
+                if stale:
+                    purged += self._purge(path)
+        if purged:
+            log.info("purged {count} stale workspaces from {root}".format(count=purged, root=self.root))
+            self.metrics.incr('workspace.purged', purged)
+        return purged
+
+    @staticmethod
+    def _purge(path):
+        if not os.path.isdir(path) or os.path.islink(path):
+            return 0
+        shutil.rmtree(path, ignore_errors=True)
+        return 1
+
+    def _update_gauges(self):
+        self.metrics.gauge('workspace.in_use', len(self._in_use))
+        self.metrics.gauge('workspace.free', len(self._free))
+        self.metrics.gauge('workspace.bytes', self._used)
+
+    def acquire(self):
+        """Borrow an empty workspace"""
+        with self._lock:
+            if self._free:
+                workspace = self._free.pop()
+            else:
+                path = os.path.join(self.root, 'ws-{pid}-{n}'.format(pid=os.getpid(), n=next(self._names)))
+                workspace = Workspace(self, path)
+                self.metrics.incr('workspace.created')
+            self._in_use.add(workspace)
+            self._update_gauges()
+        # It may have been removed from under us, e.g. by a tmp cleaner
+        os.makedirs(workspace.path, exist_ok=True)
+        return workspace
+
+    def release(self, workspace):
+        """Empty a workspace and return it to the pool"""
+        with self._lock:
+            if workspace not in self._in_use:
+                return
+            self._in_use.discard(workspace)
+            self._used -= workspace.used
+            workspace.used = 0
+            keep = len(self._free) < self.size
+            if keep:
+                self._free.append(workspace)
+            self._update_gauges()
+        if keep:
+            self._empty(workspace.path)
+        else:
+            shutil.rmtree(workspace.path, ignore_errors=True)
+
+    @staticmethod
+    def _empty(path):
+        try:
+            entries = os.listdir(path)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            entry = os.path.join(path, entry)
+            if os.path.isdir(entry) and not os.path.islink(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                os.unlink(entry)
+
+    def has_room(self, size):
+        return self.budget is None or self._used + size <= self.budget
+
+    def _account(self, workspace, size):
+        with self._lock:
+            workspace.used += size
+            self._used += size
+            self._update_gauges()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_workspace_pool(root, **options):
+    """Return this process's workspace pool below root"""
+    key = (os.getpid(), root)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = WorkspacePool(root, **options)
+        return _pools[key]
@@ -6,10 +6,10 @@ Settings file for the certificate agent
 import json
 import os
 
-import yaml
 from path import path
 
 from logsettings import get_logger_config
+from openedx_certificates.config import CertData, default_cache_dir
 
 ROOT_PATH = path(__file__).dirname()
 REPO_PATH = ROOT_PATH
@@ -26,6 +26,12 @@ if 'CERT_PRIVATE_DIR' in os.environ:
 # if you are using custom templates and custom cert config
 TEMPLATE_DATA_SUBDIR = 'template_data'
 CERT_DATA_FILE = 'cert-data.yml'
+# The parsed CERT_DATA_FILE is cached below CERT_DATA_CACHE_DIR, a per-user
+# temporary directory if empty, and reloaded when the file changes, which
+# is checked for at most every CERT_DATA_CHECK_INTERVAL seconds.  The cache
+# is only used if the directory is owned by the agent's user and mode 0700
+CERT_DATA_CACHE_DIR = ''
+CERT_DATA_CHECK_INTERVAL = 5
 
 # DEFAULTS
 DEBUG = False
@@ -48,6 +54,40 @@ CERT_KEY_ID = 'FEF8D954'
 # or leave blank to skip gpg signing
 # CERT_KEY_ID = ''
 
+# Signing backend: 'gpg' shells out to the gpg binary using CERT_GPG_DIR,
+# 'pgpy' signs in-process (requires PGPy) using the ASCII-armored secret key
+# exported to CERT_SIGNING_KEY_FILE, e.g. with
+#   gpg --armor --export-secret-keys $CERT_KEY_ID > signing-key.asc
+CERT_SIGNER = 'gpg'
+CERT_SIGNING_KEY_FILE = ''
+CERT_SIGNING_KEY_PASSPHRASE = None
+# Sign on a separate pool of this many workers (threads, or processes if
+# CERT_SIGNING_PROCESSES is set); 0 signs inline. Up to
+# CERT_SIGNING_QUEUE_SIZE rendered pdfs may wait for a free signing worker.
+CERT_SIGNING_WORKERS = 0
+CERT_SIGNING_QUEUE_SIZE = 16
+CERT_SIGNING_PROCESSES = False
+# 'detached' signs every certificate; 'merkle' signs bulk runs of
+# create_pdfs.py in batches of up to CERT_MERKLE_BATCH_SIZE certificates,
+# signing only each batch's Merkle root and publishing an inclusion proof
+# with every certificate. The agent always signs every certificate, as it
+# answers each submission on its own.
+CERT_SIGNING_MODE = 'detached'
+CERT_MERKLE_BATCH_SIZE = 1024
+# 'html' publishes valid.html, verify.html and a detached signature for every
+# certificate; 'json' publishes a single record.json per certificate which
+# is rendered by the one static verifier page, see publish_verifier_page()
+CERT_VERIFICATION_FORMAT = 'html'
+# Directory of the per-course manifests of issued certificates, see
+# openedx_certificates/manifest.py; empty to not keep manifests
+CERT_MANIFEST_DIR = ''
+CERT_MANIFEST_COMPACT_EVERY = 10000
+# sqlite file remembering the result of every submission for CERT_RESULT_TTL
+# seconds, so that the LMS resubmitting a request gets the same certificate
+# back rather than a new one; empty to disable
+CERT_RESULT_CACHE = ''
+CERT_RESULT_TTL = 24 * 60 * 60
+
 # Specify the default name of the certificate PDF
 CERT_FILENAME = 'Certificate.pdf'
 
@@ -58,6 +98,44 @@ CERT_AWS_ID = None
 CERT_AWS_KEY = None
 # Update this with your bucket name
 CERT_BUCKET = 'verify-test.edx.org'
+# Where certificates are uploaded to: 's3', 'local' or 'memory', see
+# openedx_certificates/storage.py. CERT_STORAGE_OPTIONS are passed to the
+# 'local' and 'memory' backends, e.g. {"root": "/srv/certs"} or
+# {"latency": 0.05, "error_rate": 0.01} to soak test the agent offline.
+CERT_STORAGE = 's3'
+CERT_STORAGE_OPTIONS = {}
+# Point uploads at an S3 compatible service other than AWS, e.g. a local
+# stand-in; empty to use AWS
+CERT_S3_HOST = ''
+CERT_S3_PORT = None
+CERT_S3_SECURE = True
+# Number of objects uploaded concurrently, 0 to upload one at a time;
+# uploads wait for a free worker once CERT_UPLOAD_QUEUE_SIZE are queued
+CERT_UPLOAD_WORKERS = 8
+CERT_UPLOAD_QUEUE_SIZE = 64
+CERT_UPLOAD_RETRIES = 3
+# Store the verification pages and records compressed, served with this
+# Content-Encoding: 'gzip', 'br' (needs the brotli package), or '' for none.
+# CERT_COMPRESSION_LEVEL of None uses the best compression.  The 'local'
+# storage writes both valid.html and valid.html.gz (or .br), for nginx's
+# gzip_static on (or brotli_static on).
+CERT_CONTENT_ENCODING = ''
+CERT_COMPRESSION_LEVEL = None
+# Let the agent render the next certificate while the last ones upload,
+# replying to the queue once a certificate's uploads are confirmed. At most
+# CERT_OUTBOX_CAPACITY certificates wait in the outbox, which is spooled
+# to CERT_OUTBOX_DIR if set so pending uploads survive a restart.
+CERT_ASYNC_UPLOAD = False
+CERT_OUTBOX_CAPACITY = 256
+CERT_OUTBOX_DIR = ''
+CERT_OUTBOX_UPLOADERS = 2
+# Generators without a dir_prefix borrow a scratch directory below
+# CERT_WORKSPACE_DIR (TMP_GEN_DIR if empty; a tmpfs such as /dev/shm works
+# well), of which CERT_WORKSPACES are kept for reuse. Inspection copies are
+# skipped once the workspaces hold CERT_WORKSPACE_BUDGET bytes, 0 for no limit.
+CERT_WORKSPACE_DIR = ''
+CERT_WORKSPACES = 4
+CERT_WORKSPACE_BUDGET = 0
 CERT_WEB_ROOT = '/var/tmp'
 # when set to true this will copy the generated certificate
 # to the CERT_WEB_ROOT. This is not something you want to do
@@ -82,6 +160,15 @@ CERT_VERIFY_URL = ''
 
 # This is how long in seconds the cert agent will sleep before polling the queue again.
 QUEUE_POLL_FREQUENCY = 5
+# How often, in seconds, the cert agent writes its metrics to the log
+METRICS_LOG_INTERVAL = 300
+# Longest time, in seconds, the cert agent holds the deletes of regenerated
+# certificates before sending them; removed ones are deleted straight away
+CERT_DELETE_FLUSH_INTERVAL = 30
+# Number of agent processes pulling from the queue. With more than one, the
+# agent loads every course's fonts and templates once and then forks the
+# workers, which share them copy-on-write.
+CERT_AGENT_WORKERS = 1
 
 # load settings from env.json and auth.json
 if os.path.isfile(ENV_ROOT / "env.json"):
@@ -91,9 +178,43 @@ if os.path.isfile(ENV_ROOT / "env.json"):
     QUEUE_NAME = ENV_TOKENS.get('QUEUE_NAME', 'test-pull')
     QUEUE_URL = ENV_TOKENS.get('QUEUE_URL', 'https://stage-xqueue.edx.org')
     QUEUE_POLL_FREQUENCY = ENV_TOKENS.get('QUEUE_POLL_FREQUENCY', QUEUE_POLL_FREQUENCY)
+    METRICS_LOG_INTERVAL = ENV_TOKENS.get('METRICS_LOG_INTERVAL', METRICS_LOG_INTERVAL)
+    CERT_DELETE_FLUSH_INTERVAL = ENV_TOKENS.get('CERT_DELETE_FLUSH_INTERVAL', CERT_DELETE_FLUSH_INTERVAL)
+    CERT_AGENT_WORKERS = ENV_TOKENS.get('CERT_AGENT_WORKERS', CERT_AGENT_WORKERS)
     CERT_GPG_DIR = ENV_TOKENS.get('CERT_GPG_DIR', CERT_GPG_DIR)
     CERT_KEY_ID = ENV_TOKENS.get('CERT_KEY_ID', CERT_KEY_ID)
+    CERT_SIGNER = ENV_TOKENS.get('CERT_SIGNER', CERT_SIGNER)
+    CERT_SIGNING_KEY_FILE = ENV_TOKENS.get('CERT_SIGNING_KEY_FILE', CERT_SIGNING_KEY_FILE)
+    CERT_SIGNING_WORKERS = ENV_TOKENS.get('CERT_SIGNING_WORKERS', CERT_SIGNING_WORKERS)
+    CERT_SIGNING_QUEUE_SIZE = ENV_TOKENS.get('CERT_SIGNING_QUEUE_SIZE', CERT_SIGNING_QUEUE_SIZE)
+    CERT_SIGNING_PROCESSES = ENV_TOKENS.get('CERT_SIGNING_PROCESSES', CERT_SIGNING_PROCESSES)
+    CERT_SIGNING_MODE = ENV_TOKENS.get('CERT_SIGNING_MODE', CERT_SIGNING_MODE)
+    CERT_MERKLE_BATCH_SIZE = ENV_TOKENS.get('CERT_MERKLE_BATCH_SIZE', CERT_MERKLE_BATCH_SIZE)
+    CERT_VERIFICATION_FORMAT = ENV_TOKENS.get('CERT_VERIFICATION_FORMAT', CERT_VERIFICATION_FORMAT)
+    CERT_DATA_CACHE_DIR = ENV_TOKENS.get('CERT_DATA_CACHE_DIR', CERT_DATA_CACHE_DIR)
+    CERT_DATA_CHECK_INTERVAL = ENV_TOKENS.get('CERT_DATA_CHECK_INTERVAL', CERT_DATA_CHECK_INTERVAL)
+    CERT_MANIFEST_DIR = ENV_TOKENS.get('CERT_MANIFEST_DIR', CERT_MANIFEST_DIR)
+    CERT_MANIFEST_COMPACT_EVERY = ENV_TOKENS.get('CERT_MANIFEST_COMPACT_EVERY', CERT_MANIFEST_COMPACT_EVERY)
+    CERT_RESULT_CACHE = ENV_TOKENS.get('CERT_RESULT_CACHE', CERT_RESULT_CACHE)
+    CERT_RESULT_TTL = ENV_TOKENS.get('CERT_RESULT_TTL', CERT_RESULT_TTL)
     CERT_BUCKET = ENV_TOKENS.get('CERT_BUCKET', CERT_BUCKET)
+    CERT_STORAGE = ENV_TOKENS.get('CERT_STORAGE', CERT_STORAGE)
+    CERT_STORAGE_OPTIONS = ENV_TOKENS.get('CERT_STORAGE_OPTIONS', CERT_STORAGE_OPTIONS)
+    CERT_S3_HOST = ENV_TOKENS.get('CERT_S3_HOST', CERT_S3_HOST)
+    CERT_S3_PORT = ENV_TOKENS.get('CERT_S3_PORT', CERT_S3_PORT)
+    CERT_S3_SECURE = ENV_TOKENS.get('CERT_S3_SECURE', CERT_S3_SECURE)
+    CERT_UPLOAD_WORKERS = ENV_TOKENS.get('CERT_UPLOAD_WORKERS', CERT_UPLOAD_WORKERS)
+    CERT_UPLOAD_QUEUE_SIZE = ENV_TOKENS.get('CERT_UPLOAD_QUEUE_SIZE', CERT_UPLOAD_QUEUE_SIZE)
+    CERT_UPLOAD_RETRIES = ENV_TOKENS.get('CERT_UPLOAD_RETRIES', CERT_UPLOAD_RETRIES)
+    CERT_CONTENT_ENCODING = ENV_TOKENS.get('CERT_CONTENT_ENCODING', CERT_CONTENT_ENCODING)
+    CERT_COMPRESSION_LEVEL = ENV_TOKENS.get('CERT_COMPRESSION_LEVEL', CERT_COMPRESSION_LEVEL)
+    CERT_ASYNC_UPLOAD = ENV_TOKENS.get('CERT_ASYNC_UPLOAD', CERT_ASYNC_UPLOAD)
+    CERT_OUTBOX_CAPACITY = ENV_TOKENS.get('CERT_OUTBOX_CAPACITY', CERT_OUTBOX_CAPACITY)
+    CERT_OUTBOX_DIR = ENV_TOKENS.get('CERT_OUTBOX_DIR', CERT_OUTBOX_DIR)
+    CERT_OUTBOX_UPLOADERS = ENV_TOKENS.get('CERT_OUTBOX_UPLOADERS', CERT_OUTBOX_UPLOADERS)
+    CERT_WORKSPACE_DIR = ENV_TOKENS.get('CERT_WORKSPACE_DIR', CERT_WORKSPACE_DIR)
+    CERT_WORKSPACES = ENV_TOKENS.get('CERT_WORKSPACES', CERT_WORKSPACES)
+    CERT_WORKSPACE_BUDGET = ENV_TOKENS.get('CERT_WORKSPACE_BUDGET', CERT_WORKSPACE_BUDGET)
     CERT_FILENAME = ENV_TOKENS.get('CERT_FILENAME', CERT_FILENAME)
     CERT_URL = ENV_TOKENS.get('CERT_URL', '')
     CERT_DOWNLOAD_URL = ENV_TOKENS.get('CERT_DOWNLOAD_URL', "")
@@ -135,6 +256,7 @@ if os.path.isfile(ENV_ROOT / "auth.json"):
     QUEUE_AUTH_PASS = ENV_TOKENS.get('QUEUE_AUTH_PASS', '')
     CERT_AWS_KEY = ENV_TOKENS.get('CERT_AWS_KEY', CERT_AWS_KEY)
     CERT_AWS_ID = ENV_TOKENS.get('CERT_AWS_ID', CERT_AWS_ID)
+    CERT_SIGNING_KEY_PASSPHRASE = ENV_TOKENS.get('CERT_SIGNING_KEY_PASSPHRASE', CERT_SIGNING_KEY_PASSPHRASE)
     DEFAULT_ORG = ENV_TOKENS.get('DEFAULT_ORG', DEFAULT_ORG)
 
 
@@ -143,5 +265,8 @@ if os.path.isfile(ENV_ROOT / "auth.json"):
 
 TEMPLATE_DIR = os.path.join(CERT_PRIVATE_DIR, TEMPLATE_DATA_SUBDIR)
 
-with open(os.path.join(CERT_PRIVATE_DIR, CERT_DATA_FILE), encoding='utf-8') as f:
-    CERT_DATA = yaml.load(f.read())
+CERT_DATA = CertData(
+    os.path.join(CERT_PRIVATE_DIR, CERT_DATA_FILE),
+    cache_dir=CERT_DATA_CACHE_DIR or default_cache_dir(),
+    check_interval=CERT_DATA_CHECK_INTERVAL,
+)
@@ -0,0 +1,31 @@
+import gzip
+
+from nose.tools import assert_equal, assert_is_none, assert_true
+
+from openedx_certificates.artifacts import ArtifactBundle
+from openedx_certificates.metrics import Metrics
+from openedx_certificates.storage import MemoryStorage, UploadPool
+
+
+def test_bundle_compression():
+    """Only text artifacts are compressed, and are stored with their Content-Encoding."""
+    bundle = ArtifactBundle('download', 'verify', 'http://example.com/Certificate.pdf')
+    pdf = bundle.add_pdf('Certificate.pdf', b'%PDF' * 100)
+    page = bundle.add_verification('valid.html', '<html>' + '<p>valid</p>' * 100 + '</html>')
+    bundle.compress('gzip')
+
+    assert_is_none(pdf.content_encoding)
+    assert_equal(pdf.stored_data, pdf.data)
+    assert_equal(page.content_encoding, 'gzip')
+    assert_true(len(page.stored_data) < page.size)
+    assert_equal(gzip.decompress(page.stored_data), page.data)
+
+    storage = MemoryStorage()
+    pool = UploadPool(storage, workers=2, metrics=Metrics())
+    try:
+        for future in pool.submit_bundle(bundle):
+            future.result(5)
+    finally:
+        pool.close()
+    assert_equal(storage.objects[page.key], (page.stored_data, 'text/html', 'gzip'))
+    assert_equal(storage.objects[pdf.key], (pdf.data, 'application/pdf', None))
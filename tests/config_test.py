@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_true
+
+from openedx_certificates.config import CertData
+from openedx_certificates.metrics import Metrics
+
+CERT_DATA = """
+org/one/run:
+  LONG_ORG: Org One
+org/two/run:
+  LONG_ORG: Org Two
+"""
+
+
+def test_cert_data_index_and_reload():
+    """cert-data.yml is loaded from its index once parsed, and reloaded when it changes."""
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, 'cert-data.yml')
+        cache_dir = os.path.join(root, 'cache')
+        with open(path, 'w') as f:
+            f.write(CERT_DATA)
+
+        metrics = Metrics()
+        cert_data = CertData(path, cache_dir=cache_dir, check_interval=0, metrics=metrics)
+        assert_equal(cert_data['org/one/run'], {'LONG_ORG': 'Org One'})
+        assert_equal(metrics.timings['config.parse'].count, 1)
+        assert_equal(len(os.listdir(cache_dir)), 1)
+
+        second = CertData(path, cache_dir=cache_dir, check_interval=0, metrics=metrics)
+        assert_equal(dict(second), dict(cert_data))
+        assert_equal(metrics.counters['config.index_hits'], 1)
+
+        changed = []
+        cert_data.on_change(changed.append)
+        two = cert_data.digest('org/two/run')
+        with open(path, 'w') as f:
+            f.write(CERT_DATA.replace('Org One', 'Org 1') + "org/three/run: {}\n")
+        assert_equal(cert_data['org/one/run'], {'LONG_ORG': 'Org 1'})
+        assert_equal(changed, [{'org/one/run', 'org/three/run'}])
+        assert_equal(cert_data.digest('org/two/run'), two)
+        # Only the index of the current version is kept
+        assert_equal(len(os.listdir(cache_dir)), 1)
+        assert_true(os.listdir(cache_dir)[0].startswith('cert-data.yml.' + cert_data.sha256))
+
+        # A broken save keeps the previous version
+        sha256 = cert_data.sha256
+        with open(path, 'w') as f:
+            f.write("org/one/run: [\n")
+        assert_equal(cert_data['org/one/run'], {'LONG_ORG': 'Org 1'})
+        assert_equal(cert_data.sha256, sha256)
+        assert_equal(metrics.counters['config.errors'], 1)
+
+        # As does one that is not a mapping, or the file going missing during a deploy
+        with open(path, 'w') as f:
+            f.write("- org/one/run\n")
+        assert_equal(cert_data['org/one/run'], {'LONG_ORG': 'Org 1'})
+        os.unlink(path)
+        assert_equal(cert_data['org/one/run'], {'LONG_ORG': 'Org 1'})
+        assert_equal(metrics.counters['config.errors'], 3)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_cert_data_untrusted_cache_dir():
+    """Indexes are neither read from nor written to a directory others can write to."""
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, 'cert-data.yml')
+        cache_dir = os.path.join(root, 'cache')
+        with open(path, 'w') as f:
+            f.write(CERT_DATA)
+        os.mkdir(cache_dir)
+        os.chmod(cache_dir, 0o777)
+
+        metrics = Metrics()
+        CertData(path, cache_dir=cache_dir, check_interval=0, metrics=metrics)
+        CertData(path, cache_dir=cache_dir, check_interval=0, metrics=metrics)
+        assert_equal(metrics.timings['config.parse'].count, 2)
+        assert_equal(os.listdir(cache_dir), [])
+    finally:
+        shutil.rmtree(root)
@@ -1,6 +1,8 @@
+import json
 import os
 import shutil
 import tempfile
+import threading
 
 import gnupg
 import six.moves.urllib.error
@@ -8,10 +10,12 @@ import six.moves.urllib.parse
 import six.moves.urllib.request
 from unittest.mock import patch
 from nose.plugins.skip import SkipTest
-from nose.tools import assert_false, assert_true
+from nose.tools import assert_equal, assert_false, assert_true
 
 import settings
-from gen_cert import S3_CERT_PATH, S3_VERIFY_PATH, CertificateGen
+from gen_cert import S3_BATCH_PATH, S3_CERT_PATH, S3_VERIFY_PATH, CertificateGen, get_outbox, get_signing_pool
+from openedx_certificates.merkle import InclusionProof
+from openedx_certificates.signing import SIGNER_BACKENDS
 from .test_data import NAMES
 
 CERT_FILENAME = settings.CERT_FILENAME
@@ -78,12 +82,214 @@ def test_creates_default_dir(gen_dir):
         gen = CertificateGen(list(settings.CERT_DATA.keys())[0])
         assert_true(os.path.exists(gen.dir_prefix))
     finally:
-        if os.path.exists(gen_dir):
-            shutil.rmtree(gen_dir)
         if gen:
             # Avoid catastrophy
             assert_true(gen.dir_prefix.startswith(gen_dir))
-            shutil.rmtree(gen.dir_prefix)
+            gen.close()
+        if os.path.exists(gen_dir):
+            shutil.rmtree(gen_dir)
+
+
+def test_cert_gen_in_memory():
+    """Generating without uploading or publishing should leave the working directory untouched."""
+    cert = CertificateGen(list(settings.CERT_DATA.keys())[0])
+    try:
+        cert.create_and_upload('John Smith', upload=False, copy_to_webroot=False, cleanup=True)
+        assert_true(os.listdir(cert.dir_prefix) == [])
+    finally:
+        shutil.rmtree(cert.dir_prefix)
+
+
+@patch('settings.CERT_SIGNING_WORKERS', 2)
+@patch('gen_cert._signing_pools', {})
+def test_cert_gen_many():
+    """Batch generation through a signing pool publishes every certificate, in order."""
+    tmpdir = tempfile.mkdtemp()
+    cert = CertificateGen(list(settings.CERT_DATA.keys())[0])
+    jobs = [{'name': name} for name in ('John Smith', 'Jane Smith', 'Ada Lovelace', 'Guido van Rossum')]
+    try:
+        results = list(cert.create_and_upload_many(jobs, upload=False, copy_to_webroot=True, cert_web_root=tmpdir))
+        assert_equal([job for job, bundle in results], jobs)
+        for job, bundle in results:
+            download_uuid, verify_uuid, download_url = bundle.as_tuple()
+            download_files = os.listdir(os.path.join(tmpdir, S3_CERT_PATH, download_uuid))
+            assert_equal(download_files, [CERT_FILENAME])
+            if settings.CERT_KEY_ID:
+                verify_files = os.listdir(os.path.join(tmpdir, S3_VERIFY_PATH, verify_uuid))
+                assert_equal(set(verify_files), {'valid.html', 'verify.html', CERT_FILESIG})
+    finally:
+        get_signing_pool().close()
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(cert.dir_prefix)
+
+
+class HeldSigner:
+    """Test signer holding every signature until the gate is opened"""
+    gate = threading.Event()
+
+    def __init__(self, **options):
+        pass
+
+    def sign(self, data):
+        self.gate.wait(5)
+        return b'-----BEGIN PGP SIGNATURE-----'
+
+
+@patch.dict(SIGNER_BACKENDS, {'held': HeldSigner})
+@patch('gen_cert._signer_config', lambda: ('held', {}))
+@patch('settings.CERT_SIGNING_WORKERS', 1)
+@patch('gen_cert._signing_pools', {})
+def test_create_and_queue_signs_in_background():
+    """create_and_queue returns once the pdf is rendered, and publishes it once signed."""
+    if not settings.CERT_KEY_ID:
+        raise SkipTest
+    tmpdir = tempfile.mkdtemp()
+    cert = CertificateGen(list(settings.CERT_DATA.keys())[0])
+    HeldSigner.gate.clear()
+    try:
+        futures = [
+            cert.create_and_queue(name, upload=False, copy_to_webroot=True, cert_web_root=tmpdir)
+            for name in ('John Smith', 'Jane Smith')
+        ]
+        assert_false(any(future.done() for future in futures))
+        HeldSigner.gate.set()
+        cert.finish_queued()
+        for future in futures:
+            bundle = future.result(5)
+            verify_files = os.listdir(os.path.join(tmpdir, S3_VERIFY_PATH, bundle.verify_uuid))
+            assert_equal(set(verify_files), {'valid.html', 'verify.html', CERT_FILESIG})
+    finally:
+        HeldSigner.gate.set()
+        get_signing_pool().close()
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(cert.dir_prefix)
+
+
+@patch('settings.CERT_MERKLE_BATCH_SIZE', 3)
+def test_cert_gen_merkle_batches():
+    """In merkle mode each batch root is signed once and every certificate carries its inclusion proof."""
+    if not settings.CERT_KEY_ID:
+        raise SkipTest
+    tmpdir = tempfile.mkdtemp()
+    cert = CertificateGen(list(settings.CERT_DATA.keys())[0])
+    jobs = [{'name': name} for name in ('John Smith', 'Jane Smith', 'Ada Lovelace', 'Guido van Rossum')]
+    try:
+        results = list(cert.create_and_upload_many(
+            jobs, upload=False, copy_to_webroot=True, cert_web_root=tmpdir, batch_sign=True))
+        assert_equal([job for job, bundle in results], jobs)
+        batches = os.listdir(os.path.join(tmpdir, S3_BATCH_PATH))
+        assert_equal(len(batches), 2)
+        for batch_id in batches:
+            batch_files = os.listdir(os.path.join(tmpdir, S3_BATCH_PATH, batch_id))
+            assert_equal(set(batch_files), {'root.json', 'root.json.sig'})
+        for job, bundle in results:
+            download_uuid, verify_uuid, download_url = bundle.as_tuple()
+            verify_dir = os.path.join(tmpdir, S3_VERIFY_PATH, verify_uuid)
+            assert_equal(set(os.listdir(verify_dir)), {'valid.html', 'verify.html', 'proof.json'})
+            with open(os.path.join(verify_dir, 'proof.json')) as f:
+                proof = InclusionProof.from_dict(json.load(f))
+            with open(os.path.join(tmpdir, S3_CERT_PATH, download_uuid, CERT_FILENAME), 'rb') as f:
+                assert_true(proof.verify(f.read()))
+            assert_true(proof.batch_id in batches)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(cert.dir_prefix)
+
+
+def test_cert_gen_merkle_without_verification():
+    """Courses without verification pages seal no batch in merkle mode."""
+    tmpdir = tempfile.mkdtemp()
+    cert = CertificateGen('edX/DemoX_v3/Demo_Course_v3')
+    cert.cert_data = dict(cert.cert_data, VERIFY=False)
+    try:
+        results = list(cert.create_and_upload_many(
+            [{'name': 'John Smith'}], upload=False, copy_to_webroot=True, cert_web_root=tmpdir, batch_sign=True))
+        download_uuid, verify_uuid, download_url = results[0][1].as_tuple()
+        assert_equal(verify_uuid, '')
+        assert_true(os.path.exists(os.path.join(tmpdir, S3_CERT_PATH, download_uuid, CERT_FILENAME)))
+        assert_false(os.path.exists(os.path.join(tmpdir, S3_BATCH_PATH)))
+    finally:
+        shutil.rmtree(tmpdir)
+        cert.close()
+
+
+@patch('settings.CERT_VERIFICATION_FORMAT', 'json')
+@patch('gen_cert._verifier_pages_published', set())
+def test_cert_gen_json_record():
+    """The json verification format publishes one record per certificate and a shared verifier page."""
+    if not settings.CERT_KEY_ID:
+        raise SkipTest
+    tmpdir = tempfile.mkdtemp()
+    cert = CertificateGen(list(settings.CERT_DATA.keys())[0])
+    try:
+        for name in ('John Smith', 'Jane Smith'):
+            (download_uuid, verify_uuid, download_url) = cert.create_and_upload(
+                name, upload=False, copy_to_webroot=True, cert_web_root=tmpdir)
+            verify_dir = os.path.join(tmpdir, S3_VERIFY_PATH, verify_uuid)
+            assert_equal(os.listdir(verify_dir), ['record.json'])
+            with open(os.path.join(verify_dir, 'record.json')) as f:
+                record = json.load(f)
+            assert_equal(record['name'], name)
+            assert_equal(record['certificate_id'], verify_uuid)
+            assert_true(record['signature'].startswith('-----BEGIN PGP SIGNATURE-----'))
+        assert_true(os.path.isfile(os.path.join(tmpdir, S3_VERIFY_PATH, 'verifier.html')))
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(cert.dir_prefix)
+
+
+def test_regen_keeps_unchanged_certificates():
+    """Regenerating keeps a certificate whose fingerprint is unchanged, until it is deleted."""
+    tmpdir = tempfile.mkdtemp()
+    cert = CertificateGen(list(settings.CERT_DATA.keys())[0], issued_date='ROLLING')
+    try:
+        with patch.object(settings, 'CERT_MANIFEST_DIR', os.path.join(tmpdir, 'manifests')):
+            published = cert.create_and_upload(
+                'John Smith', upload=False, copy_to_webroot=True, cert_web_root=tmpdir, grade='0.9')
+            download_uuid, verify_uuid, download_url = published
+            assert_equal(cert.unchanged_certificate(download_uuid, verify_uuid, 'John Smith', grade='0.9'), published)
+            assert_equal(cert.unchanged_certificate(download_uuid, verify_uuid, 'John Smith', grade='1.0'), None)
+            assert_equal(cert.unchanged_certificate(download_uuid, verify_uuid, 'Jane Smith', grade='0.9'), None)
+            # Certificates of rolling courses carry the day they are rendered on
+            with patch('gen_cert.get_cert_date', return_value='January 2nd, 2099'):
+                assert_equal(cert.unchanged_certificate(download_uuid, verify_uuid, 'John Smith', grade='0.9'), None)
+
+            cert.delete_certificate(download_uuid, verify_uuid, upload=False, copy_to_webroot=True,
+                                    cert_web_root=tmpdir)
+            assert_false(os.path.exists(os.path.join(tmpdir, S3_CERT_PATH, download_uuid)))
+            assert_equal(cert.unchanged_certificate(download_uuid, verify_uuid, 'John Smith', grade='0.9'), None)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(cert.dir_prefix)
+
+
+def test_recovered_certificates_are_recorded():
+    """Certificates left in the outbox by a previous run reach the manifest once uploaded."""
+    tmpdir = tempfile.mkdtemp()
+    cert = CertificateGen(list(settings.CERT_DATA.keys())[0])
+
+    def failing_upload(bundle):
+        raise IOError('S3 unavailable')
+
+    try:
+        with patch.object(settings, 'CERT_MANIFEST_DIR', os.path.join(tmpdir, 'manifests')), \
+                patch.object(settings, 'CERT_OUTBOX_DIR', os.path.join(tmpdir, 'outbox')):
+            with patch.dict('gen_cert._outboxes', clear=True), patch('gen_cert.upload_bundle', failing_upload):
+                queued = cert.create_and_queue('John Smith', grade='0.9', meta={'username': 'john'})
+                assert_true(isinstance(queued.exception(5), IOError))
+                get_outbox().close()
+
+            with patch.dict('gen_cert._outboxes', clear=True), patch('gen_cert.upload_bundle', lambda bundle: []):
+                [(meta, recovered)] = get_outbox().recover()
+                bundle = recovered.result(5)
+                get_outbox().close()
+            assert_equal(meta['username'], 'john')
+            published = (bundle.download_uuid, bundle.verify_uuid, bundle.download_url)
+            assert_equal(cert.unchanged_certificate(
+                bundle.download_uuid, bundle.verify_uuid, 'John Smith', grade='0.9'), published)
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(cert.dir_prefix)
 
 
 def test_cert_names():
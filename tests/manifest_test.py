@@ -0,0 +1,55 @@
+import shutil
+import tempfile
+import uuid
+
+from nose.tools import assert_equal, assert_false, assert_is_none, assert_true
+
+from openedx_certificates.manifest import CourseManifest, sha256_hex
+
+
+def test_manifest_lookup_and_compaction():
+    """Entries can be looked up by either uuid before and after the log is compacted."""
+    root = tempfile.mkdtemp()
+    try:
+        manifest = CourseManifest(root, 'org/course/run', compact_every=5)
+        issued = [(uuid.uuid4().hex, uuid.uuid4().hex) for _ in range(7)]
+        for i, (verify_uuid, download_uuid) in enumerate(issued):
+            manifest.append(verify_uuid, download_uuid, b'pdf %d' % i, 'Student %d' % i, '2024-01-01')
+
+        # The first five were compacted into shards, the last two are still in the log
+        assert_equal(manifest._count_log(), 2)
+        assert_equal(len(list(manifest)), 7)
+        for i, (verify_uuid, download_uuid) in enumerate(issued):
+            entry = manifest.lookup(verify_uuid)
+            assert_equal(entry, manifest.lookup(download_uuid))
+            assert_equal(entry['content_sha256'], sha256_hex(b'pdf %d' % i))
+            assert_equal(entry['name_sha256'], sha256_hex('Student %d' % i))
+        assert_is_none(manifest.lookup(uuid.uuid4().hex))
+
+        reopened = CourseManifest(root, 'org/course/run', compact_every=0)
+        reopened.reindex()
+        assert_true(issued[0][0] in reopened)
+        reopened.compact()
+        assert_equal(len(list(reopened)), 7)
+        assert_false(reopened._count_log())
+    finally:
+        shutil.rmtree(root)
+
+
+def test_manifest_placeholder_verify_uuid():
+    """Certificates recorded with 'No Verification' are kept apart, by their download uuid."""
+    root = tempfile.mkdtemp()
+    try:
+        manifest = CourseManifest(root, 'org/cme/run', compact_every=0)
+        downloads = [uuid.uuid4().hex for _ in range(2)]
+        for i, download_uuid in enumerate(downloads):
+            manifest.append('No Verification', download_uuid, b'pdf %d' % i, 'Student %d' % i, '2024-01-01')
+        assert_is_none(manifest.lookup('No Verification'))
+
+        manifest.compact()
+        manifest.reindex()
+        assert_equal(len(list(manifest)), 2)
+        for i, download_uuid in enumerate(downloads):
+            assert_equal(manifest.lookup(download_uuid)['name_sha256'], sha256_hex('Student %d' % i))
+    finally:
+        shutil.rmtree(root)
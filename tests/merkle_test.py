@@ -0,0 +1,33 @@
+from nose.tools import assert_equal, assert_false, assert_raises, assert_true
+
+from openedx_certificates.merkle import InclusionProof, MerkleBatch
+
+
+def test_merkle_batch_proofs():
+    """Every document in a sealed batch has a proof against the one signed root."""
+    signed = []
+    batch = MerkleBatch('batch', lambda data: signed.append(data) or b'signature')
+    documents = [str(i).encode('ascii') * 100 for i in range(7)]
+    futures = [batch.add(document) for document in documents]
+    assert_false(any(future.done() for future in futures))
+
+    root_document, signature = batch.seal(course_id='org/course/run')
+    assert_equal(signed, [root_document])
+    assert_equal(signature, b'signature')
+    assert_raises(ValueError, batch.add, b'late')
+
+    for document, future in zip(documents, futures):
+        proof = InclusionProof.from_dict(future.result().as_dict())
+        assert_true(proof.verify(document))
+        assert_false(proof.verify(document + b' '))
+    assert_false(futures[0].result().verify(documents[1]))
+
+
+def test_merkle_batch_signing_failure():
+    """A failed root signature fails every pending proof rather than leaving them hanging."""
+    def sign(data):
+        raise RuntimeError('gpg unavailable')
+    batch = MerkleBatch('batch', sign)
+    future = batch.add(b'certificate')
+    assert_raises(RuntimeError, batch.seal)
+    assert_raises(RuntimeError, future.result, 0)
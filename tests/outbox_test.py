@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future
+
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from openedx_certificates.artifacts import ArtifactBundle
+from openedx_certificates.metrics import Metrics
+from openedx_certificates.outbox import Outbox
+
+
+def make_bundle(i):
+    bundle = ArtifactBundle('download{i}'.format(i=i), 'verify{i}'.format(i=i), 'http://example.com/{i}'.format(i=i))
+    bundle.add_pdf('Certificate.pdf', b'%PDF ' + str(i).encode('ascii'))
+    bundle.add_verification('valid.html', '<html>')
+    return bundle
+
+
+class GatedUploader:
+    """Holds every upload until released, failing those listed in fail"""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.uploads = []
+        self.lock = threading.Lock()
+
+    def __call__(self, bundle):
+        futures = [Future() for _ in bundle]
+        with self.lock:
+            self.uploads.append((bundle, futures))
+        return futures
+
+    def release(self):
+        with self.lock:
+            uploads, self.uploads = self.uploads, []
+        for bundle, futures in uploads:
+            for artifact, future in zip(bundle, futures):
+                if bundle.download_uuid in self.fail:
+                    future.set_exception(IOError('S3 unavailable'))
+                else:
+                    future.set_result(artifact.key)
+
+
+def test_outbox_bounds_pending_uploads():
+    """put() returns straight away until the outbox is full, and resolves once uploaded."""
+    uploader = GatedUploader()
+    metrics = Metrics()
+    outbox = Outbox(uploader, capacity=2, metrics=metrics)
+    try:
+        first, second = outbox.put(make_bundle(1)), outbox.put(make_bundle(2))
+        blocked = []
+        producer = threading.Thread(target=lambda: blocked.append(outbox.put(make_bundle(3))))
+        producer.start()
+        producer.join(0.2)
+        assert_true(producer.is_alive())
+        assert_true(not first.done() and not second.done())
+
+        uploader.release()
+        assert_equal(first.result(5).download_uuid, 'download1')
+        producer.join(5)
+        while not blocked[0].done():
+            uploader.release()
+        assert_equal(blocked[0].result(5).download_uuid, 'download3')
+        assert_equal(metrics.snapshot()['counters']['outbox.backpressure'], 1)
+    finally:
+        uploader.release()
+        outbox.close()
+
+
+def test_outbox_spool_recovery():
+    """Bundles whose upload failed stay spooled and are re-queued by the next outbox."""
+    spool = tempfile.mkdtemp()
+    try:
+        uploader = GatedUploader(fail={'download2'})
+        outbox = Outbox(uploader, directory=spool)
+        ok = outbox.put(make_bundle(1), meta={'username': 'one'})
+        failed = outbox.put(make_bundle(2), meta={'username': 'two'})
+        assert_equal(len(os.listdir(spool)), 2)
+        while not (ok.done() and failed.done()):
+            uploader.release()
+        assert_raises(IOError, failed.result)
+        outbox.close()
+        assert_equal(len(os.listdir(spool)), 1)
+
+        uploader = GatedUploader()
+        uploaded = []
+        outbox = Outbox(uploader, directory=spool, on_uploaded=lambda bundle, meta: uploaded.append(meta))
+        recovered = outbox.recover()
+        assert_equal([meta for meta, future in recovered], [{'username': 'two'}])
+        while not recovered[0][1].done():
+            uploader.release()
+        bundle = recovered[0][1].result()
+        assert_equal(bundle.as_tuple(), make_bundle(2).as_tuple())
+        assert_equal(bundle.get('downloads/download2/Certificate.pdf').data, b'%PDF 2')
+        assert_equal(bundle.pdf.data, b'%PDF 2')
+        assert_equal(uploaded, [{'username': 'two'}])
+        outbox.close()
+        assert_equal(os.listdir(spool), [])
+
+        # Once the failure has been reported, the spooled copy can go
+        uploader = GatedUploader(fail={'download3'})
+        outbox = Outbox(uploader, directory=spool)
+        failed = outbox.put(make_bundle(3))
+        while not failed.done():
+            uploader.release()
+        outbox.discard(failed)
+        outbox.close()
+        assert_equal(os.listdir(spool), [])
+    finally:
+        shutil.rmtree(spool)
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from unittest.mock import patch
+
+from nose.tools import assert_equal, assert_is_none
+
+from openedx_certificates.metrics import Metrics
+from openedx_certificates.results import ResultCache, submission_key
+
+
+def test_result_cache():
+    """A resubmitted body gets the stored result back until it expires."""
+    root = tempfile.mkdtemp()
+    try:
+        metrics = Metrics()
+        cache = ResultCache(os.path.join(root, 'results.sqlite'), ttl=60, metrics=metrics)
+        key = submission_key({'username': 'jsmith', 'course_id': 'org/course/run', 'grade': '0.9'})
+        assert_equal(key, submission_key({'grade': '0.9', 'course_id': 'org/course/run', 'username': 'jsmith'}))
+        assert_is_none(cache.get(key))
+
+        cache.put(key, ('download', 'verify', 'https://example.com/Certificate.pdf'))
+        assert_equal(cache.get(key), ['download', 'verify', 'https://example.com/Certificate.pdf'])
+        assert_equal(metrics.counters['results.hits'], 1)
+        assert_equal(metrics.counters['results.misses'], 1)
+
+        with patch('openedx_certificates.results.time.time', return_value=time.time() + 61):
+            assert_is_none(cache.get(key))
+            assert_equal(cache.purge(), 1)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_result_cache_invalidated_by_remove():
+    """Once a certificate is removed, submitting the same body again does not get its uuids back."""
+    root = tempfile.mkdtemp()
+    try:
+        metrics = Metrics()
+        cache = ResultCache(os.path.join(root, 'results.sqlite'), ttl=60, metrics=metrics)
+        download_uuid, verify_uuid = uuid.uuid4().hex, uuid.uuid4().hex
+        generate = submission_key({'action': 'generate', 'username': 'jsmith', 'course_id': 'org/course/run'})
+        other = submission_key({'action': 'generate', 'username': 'asmith', 'course_id': 'org/course/run'})
+        cache.put(generate, (download_uuid, verify_uuid, 'https://example.com/Certificate.pdf'))
+        cache.put(other, (uuid.uuid4().hex, 'No Verification', 'https://example.com/Other.pdf'))
+
+        assert_equal(cache.invalidate(download_uuid, verify_uuid), 1)
+        assert_is_none(cache.get(generate))
+        assert_equal(cache.invalidate(uuid.uuid4().hex, 'No Verification'), 0)
+        assert_equal(cache.get(other)[1], 'No Verification')
+        assert_equal(metrics.counters['results.invalidated'], 1)
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import threading
+import warnings
+from unittest.mock import patch
+
+import gnupg
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal, assert_is, assert_is_not, assert_raises, assert_true
+
+import settings
+from openedx_certificates.metrics import Metrics
+from openedx_certificates.signing import SIGNER_BACKENDS, PGPySigner, SigningPool, get_signer
+
+try:
+    import pgpy
+except ImportError:
+    pgpy = None
+
+
+class GatedSigner:
+    """Test signer that reverses its payload once the gate is opened"""
+    gate = threading.Event()
+
+    def __init__(self, **options):
+        pass
+
+    def sign(self, data):
+        self.gate.wait(5)
+        return data[::-1]
+
+
+def test_get_signer_is_reused():
+    """Workers should keep one signer per key rather than building one per certificate."""
+    signer = get_signer('gpg', homedir='/tmp/gpg-home', key_id='ABCDEF01')
+    assert_is(signer, get_signer('gpg', homedir='/tmp/gpg-home', key_id='ABCDEF01'))
+    assert_is_not(signer, get_signer('gpg', homedir='/tmp/gpg-home', key_id='10FEDCBA'))
+
+
+@patch('gnupg.GPG')
+def test_sign_many_reuses_gpg(mock_gpg):
+    """Batch signing returns signatures in order from a single gpg wrapper."""
+    mock_gpg.return_value.sign.side_effect = lambda data, **kwargs: type('Result', (), {'data': data[::-1]})
+    signer = get_signer('gpg', homedir='/tmp/other-gpg-home', key_id='ABCDEF01')
+    assert_equal(signer.sign_many([b'ab', b'cd']), [b'ba', b'dc'])
+    assert_equal(mock_gpg.call_count, 1)
+
+
+@patch.dict(SIGNER_BACKENDS, {'gated': GatedSigner})
+def test_signing_pool_backpressure():
+    """The signing pool blocks producers once its queue is full and reports its depth."""
+    metrics = Metrics()
+    pool = SigningPool('gated', workers=1, queue_size=1, metrics=metrics)
+    GatedSigner.gate.clear()
+    try:
+        futures = [pool.submit(b'one'), pool.submit(b'two')]
+        assert_equal(pool.queue_depth, 1)
+        assert_equal(metrics.snapshot()['gauges']['signing.queue_depth'], 1)
+
+        producer = threading.Thread(target=lambda: futures.append(pool.submit(b'three')))
+        producer.start()
+        producer.join(0.2)
+        assert_true(producer.is_alive())
+
+        GatedSigner.gate.set()
+        producer.join(5)
+        assert_equal([f.result(5) for f in futures], [b'eno', b'owt', b'eerht'])
+    finally:
+        GatedSigner.gate.set()
+        pool.close()
+
+    snapshot = metrics.snapshot()
+    assert_equal(snapshot['counters']['signing.signatures'], 3)
+    assert_equal(snapshot['counters']['signing.backpressure'], 1)
+    assert_equal(snapshot['timings']['signing.latency']['count'], 3)
+
+
+def test_pgpy_signature():
+    """The in-process backend produces armored detached signatures over the exact payload."""
+    if pgpy is None:
+        raise SkipTest
+    from pgpy.constants import KeyFlags, PubKeyAlgorithm
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        key = pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, 2048)
+        key.add_uid(pgpy.PGPUID.new('Certificate Signing'), usage={KeyFlags.Sign})
+        with tempfile.NamedTemporaryFile('w', suffix='.asc', delete=False) as f:
+            f.write(str(key))
+        try:
+            signer = PGPySigner(f.name, key_id=key.fingerprint.keyid)
+            signature = signer.sign(b'certificate')
+        finally:
+            os.remove(f.name)
+
+        assert_true(signature.startswith(b'-----BEGIN PGP SIGNATURE-----'))
+        parsed = pgpy.PGPSignature.from_blob(signature)
+        assert_true(key.pubkey.verify(b'certificate', parsed))
+        assert_true(not key.pubkey.verify(b'forged certificate', parsed))
+
+
+def test_pgpy_signature_protected_key():
+    """A passphrase protected key is unlocked for each signature and locked again afterwards."""
+    if pgpy is None:
+        raise SkipTest
+    from pgpy.constants import HashAlgorithm, KeyFlags, PubKeyAlgorithm, SymmetricKeyAlgorithm
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        key = pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, 2048)
+        key.add_uid(pgpy.PGPUID.new('Certificate Signing'), usage={KeyFlags.Sign})
+        key.protect('passphrase', SymmetricKeyAlgorithm.AES256, HashAlgorithm.SHA256)
+        with tempfile.NamedTemporaryFile('w', suffix='.asc', delete=False) as f:
+            f.write(str(key))
+        try:
+            assert_raises(pgpy.errors.PGPDecryptionError, PGPySigner(f.name, passphrase='wrong').warmup)
+            signer = PGPySigner(f.name, passphrase='passphrase')
+            signatures = signer.sign_many([b'one', b'two'])
+        finally:
+            os.remove(f.name)
+
+        assert_true(not signer.key.is_unlocked)
+        for payload, signature in zip([b'one', b'two'], signatures):
+            assert_true(key.pubkey.verify(payload, pgpy.PGPSignature.from_blob(signature)))
+
+
+def test_pgpy_signature_verifies_with_gpg():
+    """gnupg's verify_file accepts signatures from the in-process backend, as it does in test_cert_gen."""
+    if pgpy is None:
+        raise SkipTest
+    from pgpy.constants import HashAlgorithm, KeyFlags, PubKeyAlgorithm
+
+    homedir = tempfile.mkdtemp()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        key = pgpy.PGPKey.new(PubKeyAlgorithm.RSAEncryptOrSign, 2048)
+        key.add_uid(pgpy.PGPUID.new('Certificate Signing'), usage={KeyFlags.Sign}, hashes=[HashAlgorithm.SHA256])
+    with tempfile.NamedTemporaryFile('w', suffix='.asc', delete=False) as f:
+        f.write(str(key))
+    payload = os.urandom(4096)
+    with tempfile.NamedTemporaryFile(suffix='.sig', delete=False) as sig:
+        sig.write(PGPySigner(f.name).sign(payload))
+    try:
+        gpg = gnupg.GPG(homedir=homedir)
+        gpg.import_keys(str(key.pubkey))
+        with tempfile.TemporaryFile() as data:
+            data.write(payload)
+            data.seek(0)
+            v = gpg.verify_file(data, sig.name)
+        assert_true(v.valid)
+        assert_equal(v.fingerprint, str(key.fingerprint).replace(' ', ''))
+    finally:
+        os.remove(f.name)
+        os.remove(sig.name)
+        shutil.rmtree(homedir)
\ No newline at end of file
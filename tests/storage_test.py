@@ -0,0 +1,230 @@
+import gzip
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from nose.tools import assert_equal, assert_is, assert_raises, assert_true
+
+from openedx_certificates.artifacts import ArtifactBundle
+from openedx_certificates.metrics import Metrics
+from openedx_certificates.storage import DeleteBatch, LocalStorage, MemoryStorage, S3Client, UploadPool, get_storage
+
+
+class S3StandIn(BaseHTTPRequestHandler):
+    """Just enough of the S3 REST api, path style, to upload objects"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _reply(self, headers=()):
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', self.path))
+        self._reply()
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(('PUT', self.path))
+        self.server.objects[self.path] = (body, self.headers['Content-Type'])
+        self._reply([('ETag', '"{md5}"'.format(md5=hashlib.md5(body).hexdigest()))])
+
+    def log_message(self, *args):
+        pass
+
+
+def test_s3_client_reuses_connection():
+    """Uploads share one keep-alive connection and validate the bucket only once."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), S3StandIn)
+    server.connections, server.requests, server.objects = 0, [], {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = S3Client('id', 'key', 'certs', host='127.0.0.1', port=server.server_port, is_secure=False)
+        for i in range(5):
+            client.upload('downloads/{i}/Certificate.pdf'.format(i=i), b'%PDF' * i, 'application/pdf')
+
+        assert_equal([method for method, path in server.requests], ['HEAD'] + ['PUT'] * 5)
+        assert_equal(server.connections, 1)
+        assert_equal(server.objects['/certs/downloads/3/Certificate.pdf'], (b'%PDF' * 3, 'application/pdf'))
+
+        # A connection level failure drops the connection and retries on a new one
+        failing = [socket.error('connection reset')]
+
+        def upload(bucket, *args):
+            if failing:
+                raise failing.pop()
+            return original(bucket, *args)
+        original = S3Client._upload
+        with patch.object(S3Client, '_upload', staticmethod(upload)):
+            client.upload('cert/0/valid.html', b'<html>', 'text/html')
+        assert_equal(client.connections, 2)
+        assert_equal(server.objects['/certs/cert/0/valid.html'], (b'<html>', 'text/html'))
+        assert_equal(server.requests[-1], ('PUT', '/certs/cert/0/valid.html'))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class FlakyClient:
+    """Records uploads, failing the first attempt at every key ending in .sig"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = self.max_active = 0
+        self.attempts = []
+        self.uploaded = {}
+        self.gate = threading.Barrier(4, timeout=5)
+
+    def upload(self, key_name, data, content_type, content_encoding=None):
+        with self.lock:
+            self.attempts.append(key_name)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            first_attempt = self.attempts.count(key_name) == 1
+        try:
+            if first_attempt:
+                # Hold every first attempt until all four artifacts are in flight
+                self.gate.wait()
+            if key_name.endswith('.sig') and first_attempt:
+                raise socket.error('connection reset')
+            self.uploaded[key_name] = data
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def test_upload_pool_concurrent_with_retries():
+    """A bundle's artifacts upload concurrently, and failed objects are retried."""
+    client = FlakyClient()
+    metrics = Metrics()
+    pool = UploadPool(client, workers=4, queue_size=4, retries=2, backoff=0, metrics=metrics)
+    bundle = ArtifactBundle('download', 'verify', 'http://example.com/Certificate.pdf')
+    bundle.add_pdf('Certificate.pdf', b'%PDF')
+    for filename in ('Certificate.pdf.sig', 'valid.html', 'verify.html'):
+        bundle.add_verification(filename, filename)
+    try:
+        for future in pool.submit_bundle(bundle):
+            future.result(5)
+    finally:
+        pool.close()
+
+    assert_equal(set(client.uploaded), {artifact.key for artifact in bundle})
+    assert_equal(client.max_active, 4)
+    snapshot = metrics.snapshot()
+    assert_equal(snapshot['counters']['upload.objects'], 4)
+    assert_equal(snapshot['counters']['upload.retries'], 1)
+    assert_equal(snapshot['timings']['upload.latency']['count'], 4)
+    assert_true('upload.errors' not in snapshot['counters'])
+
+
+def test_storage_backends():
+    """The local and memory backends store objects under their keys; memory can inject errors."""
+    root = tempfile.mkdtemp()
+    try:
+        local = get_storage('local', root=root)
+        assert_is(local, get_storage('local', root=root))
+        local.upload('cert/abc/valid.html', b'<html>', 'text/html')
+        with open(os.path.join(root, 'cert', 'abc', 'valid.html'), 'rb') as f:
+            assert_equal(f.read(), b'<html>')
+    finally:
+        shutil.rmtree(root)
+
+    failing = get_storage('memory', error_rate=1.0)
+    assert_raises(socket.error, failing.upload, 'downloads/abc/Certificate.pdf', b'%PDF', 'application/pdf')
+
+    memory = get_storage('memory', error_rate=0.5, seed=1)
+    pool = UploadPool(memory, workers=2, retries=20, backoff=0, metrics=Metrics())
+    try:
+        for future in [pool.submit('cert/{i}/valid.html'.format(i=i), b'<html>', 'text/html') for i in range(10)]:
+            future.result(5)
+    finally:
+        pool.close()
+    assert_equal(len(memory.objects), 10)
+    assert_true(memory.requests > 10)
+
+
+def test_local_storage_links_published_files():
+    """A second local copy of a published file is hardlinked rather than written again."""
+    root = tempfile.mkdtemp()
+    try:
+        webroot = LocalStorage(os.path.join(root, 'webroot'))
+        inspection = LocalStorage(os.path.join(root, 'inspection'))
+        published = webroot.upload('downloads/abc/Certificate.pdf', b'%PDF', 'application/pdf')
+        path, how = inspection.link('downloads/abc/Certificate.pdf', published, b'%PDF')
+        assert_equal(how, 'hardlink')
+        assert_true(os.path.samefile(path, published))
+
+        # Republishing replaces the file atomically, leaving the old link intact
+        webroot.upload('downloads/abc/Certificate.pdf', b'%PDF-1.4', 'application/pdf')
+        with open(path, 'rb') as f:
+            assert_equal(f.read(), b'%PDF')
+        assert_equal(os.listdir(os.path.dirname(published)), ['Certificate.pdf'])
+
+        with patch('os.link', side_effect=OSError('cross-device link')):
+            with patch('openedx_certificates.storage._reflink', return_value=False):
+                path, how = inspection.link('cert/abc/valid.html', published, b'<html>')
+        assert_equal(how, 'write')
+        with open(path, 'rb') as f:
+            assert_equal(f.read(), b'<html>')
+    finally:
+        shutil.rmtree(root)
+
+
+def test_delete_batch():
+    """Deletes are gathered into requests of at most batch_size keys, and remove local files with their copies."""
+    storage = MemoryStorage()
+    for i in range(5):
+        storage.upload('downloads/{i}/Certificate.pdf'.format(i=i), b'%PDF', 'application/pdf')
+        storage.upload('cert/{i}/valid.html'.format(i=i), b'<html>', 'text/html')
+    metrics = Metrics()
+    with DeleteBatch(storage, batch_size=4, metrics=metrics) as batch:
+        for i in range(5):
+            batch.add_prefix('downloads/{i}/'.format(i=i))
+            batch.add(['cert/{i}/valid.html'.format(i=i)])
+        assert_raises(ValueError, batch.add_prefix, '/')
+    assert_equal(storage.objects, {})
+    assert_equal(metrics.counters['delete.objects'], 10)
+    assert_equal(metrics.counters['delete.requests'], 3)
+
+    # A request that keeps failing is retried by the next flushes, then given up on
+    failing = MemoryStorage(error_rate=1)
+    batch = DeleteBatch(failing, batch_size=4, attempts=2, metrics=metrics)
+    batch.add(['cert/abc/valid.html'])
+    assert_raises(socket.error, batch.flush)
+    assert_equal(len(batch), 1)
+    assert_raises(socket.error, batch.flush)
+    assert_equal(len(batch), 0)
+    assert_equal(list(batch.failed), ['cert/abc/valid.html'])
+    assert_equal(metrics.counters['delete.dropped'], 1)
+
+    root = tempfile.mkdtemp()
+    try:
+        local = LocalStorage(root)
+        # Compressed pages are also written plain, for clients not accepting the encoding
+        local.upload('cert/abc/valid.html', gzip.compress(b'<html>'), 'text/html', content_encoding='gzip')
+        local.upload('cert/def/valid.html', b'<html>', 'text/html')
+        assert_equal(local.list('cert/abc/'), ['cert/abc/valid.html', 'cert/abc/valid.html.gz'])
+        with open(local.path('cert/abc/valid.html'), 'rb') as f:
+            assert_equal(f.read(), b'<html>')
+        copy = LocalStorage(os.path.join(root, 'copy'))
+        copy.link('cert/abc/valid.html', local.path('cert/abc/valid.html'), b'<html>')
+        assert_equal(copy.list('cert/'), ['cert/abc/valid.html', 'cert/abc/valid.html.gz'])
+        shutil.rmtree(copy.root)
+        local.delete(['cert/abc/valid.html'])
+        assert_equal(local.list('cert/'), ['cert/def/valid.html'])
+        assert_equal(os.listdir(os.path.join(root, 'cert')), ['def'])
+        local.delete(['cert/def/valid.html'])
+        assert_equal(os.listdir(root), [])
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,75 @@
+import glob
+import os
+import shutil
+import string
+import tempfile
+
+from nose.tools import assert_equal, assert_is, assert_is_not
+
+import settings
+from openedx_certificates.templates import CompiledTemplate, PdfTemplateCache, TemplateCache
+
+
+def test_compiled_template_matches_format():
+    """Prefilled and rendered templates produce exactly what str.format does."""
+    for template in ('valid.html', 'verify.html', 'v2/valid.html', 'v2/verify.html'):
+        path = os.path.join(settings.TEMPLATE_DIR, template)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            text = f.read()
+        fields = {
+            name: '<{name}>'.format(name=name)
+            for _, name, _, _ in string.Formatter().parse(text) if name is not None
+        }
+        course_fields = dict(list(fields.items())[::2])
+        job_fields = {name: value for name, value in fields.items() if name not in course_fields}
+        compiled = CompiledTemplate.compile(text).prefill(**course_fields)
+        assert_equal(compiled.fields, frozenset(job_fields))
+        assert_equal(compiled.render(**job_fields), text.format(**fields))
+
+
+def test_template_cache_reloads_on_change():
+    """Templates are compiled once and reloaded when the file's mtime changes."""
+    cache = TemplateCache()
+    with tempfile.NamedTemporaryFile('w', suffix='.html', delete=False) as f:
+        f.write('Hello {NAME}, {{braces}}')
+    try:
+        template = cache.get(f.name)
+        assert_is(cache.get(f.name), template)
+        assert_equal(template.render(NAME='Ada'), 'Hello Ada, {braces}')
+
+        with open(f.name, 'w') as rewrite:
+            rewrite.write('Goodbye {NAME}')
+        stat = os.stat(f.name)
+        os.utime(f.name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        reloaded = cache.get(f.name)
+        assert_is_not(reloaded, template)
+        assert_equal(reloaded.render(NAME='Ada'), 'Goodbye Ada')
+    finally:
+        os.remove(f.name)
+
+
+def test_pdf_template_cache_shares_readers():
+    """Pdf templates are parsed once per file version, keeping the most recently used."""
+    cache = PdfTemplateCache(max_entries=2)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i, template in enumerate(sorted(glob.glob(os.path.join(settings.TEMPLATE_DIR, '*.pdf')))[:3]):
+            paths.append(os.path.join(tmpdir, '{i}.pdf'.format(i=i)))
+            shutil.copy(template, paths[-1])
+        reader = cache.get(paths[0])
+        assert_is(cache.get(paths[0]), reader)
+        assert_equal(reader.getNumPages(), 1)
+
+        stat = os.stat(paths[0])
+        os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        assert_is_not(cache.get(paths[0]), reader)
+
+        cache.get(paths[1])
+        cache.get(paths[2])
+        assert_equal(len(cache), 2)
+        assert_equal(list(cache._readers), paths[1:])
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equal, assert_false, assert_true
+
+from openedx_certificates.metrics import Metrics
+from openedx_certificates.workspace import WorkspacePool
+
+
+def test_workspace_pool():
+    """Workspaces are emptied and reused, stale ones purged and usage kept within the budget."""
+    parent = tempfile.mkdtemp()
+    root = os.path.join(parent, 'workspaces')
+    try:
+        # Left behind by a process that is gone, and by the old mkdtemp(prefix=...) scheme
+        legacy_prefix = os.path.join(parent, 'generated_certs')
+        dead = os.path.join(root, 'ws-999999999-0')
+        legacy = legacy_prefix + 'abc_1234'
+        # Other programs' directories, e.g. on a shared /dev/shm
+        unrelated = [os.path.join(root, 'downloads'), os.path.join(root, 'xyz_5678'), os.path.join(parent, 'abc_1234')]
+        old = time.time() - 2 * 24 * 60 * 60
+        for path in [dead, legacy] + unrelated:
+            os.makedirs(path)
+            os.utime(path, (old, old))
+
+        metrics = Metrics()
+        pool = WorkspacePool(root, size=1, budget=100, legacy_prefix=legacy_prefix, metrics=metrics)
+        assert_false(os.path.exists(dead))
+        assert_false(os.path.exists(legacy))
+        for path in unrelated:
+            assert_true(os.path.exists(path))
+
+        first, second = pool.acquire(), pool.acquire()
+        assert_true(first.path != second.path)
+        with open(os.path.join(first.path, 'Certificate.pdf'), 'w') as f:
+            f.write('pdf')
+        first.add_usage(60)
+        assert_true(second.has_room(40))
+        assert_false(second.has_room(41))
+        assert_equal(metrics.snapshot()['gauges']['workspace.bytes'], 60)
+
+        # Only one workspace is kept for reuse, emptied
+        first.release()
+        second.release()
+        assert_equal(pool.used, 0)
+        assert_false(os.path.exists(second.path))
+        assert_equal(pool.acquire().path, first.path)
+        assert_equal(os.listdir(first.path), [])
+    finally:
+        shutil.rmtree(parent)